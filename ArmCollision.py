@@ -0,0 +1,120 @@
+import numpy as np
+
+from ArmKinematics import ArmKinematics
+
+GROUND_Z = -245  # floor height below joint 2 axis (mm)
+PLATFORM_Z = -115  # base platform top below joint 2 axis (mm)
+# base platform in arm frame (x to the right, y forward at joint 1 zero angle): min x, max x, min y, max y (mm),
+# the arm is mounted 143 mm in front of the center of 580 x 380 mm platform
+PLATFORM_BOX = (-190, 190, -433, 147)
+LINK_RADII = (40, 35, 45)  # capsule radii of links after joints 2, 3 and of the gripper (mm)
+COLUMN_RADIUS = 60  # capsule radius of the arm mount and joint 1 housing (mm)
+
+
+class ArmCollision:
+    """
+    Self and ground collision check of arm poses\n
+    Links after joints 2, 3 and the gripper are capsules around the segments of ArmKinematics.forward_3d,
+    the arm mount is a vertical capsule from the platform to joint 2 axis, the platform is a box down to the floor.
+    Link pairs with a common joint are not checked. Capsules are checked against the box at points along
+    the segment (sample_step apart). All functions take arrays, so a trajectory or a whole grid of poses
+    is checked in one call
+    """
+
+    def __init__(self, kinematics=None, /, margin=10.0, ground_z=GROUND_Z, platform_z=PLATFORM_Z,
+                 platform_box=PLATFORM_BOX, link_radii=LINK_RADII, column_radius=COLUMN_RADIUS, sample_step=20.0):
+        """
+        :param kinematics: ArmKinematics, default link lengths if None
+        :param margin: clearance (mm) poses must keep to be collision free
+        :param ground_z: floor height relative to joint 2 axis (mm)
+        :param platform_z: base platform top relative to joint 2 axis (mm)
+        :param platform_box: (min x, max x, min y, max y) of the platform in arm frame (mm)
+        :param link_radii: capsule radii of links after joints 2, 3 and of the gripper (mm)
+        :param column_radius: capsule radius of the arm mount (mm)
+        :param sample_step: distance between points of links checked against the platform (mm)
+        """
+        self.kinematics = kinematics or ArmKinematics()
+        self.margin = margin
+        self.ground_z = ground_z
+        self.platform_z = platform_z
+        self.box_low = np.array([platform_box[0], platform_box[2], ground_z], dtype=float)
+        self.box_high = np.array([platform_box[1], platform_box[3], platform_z], dtype=float)
+        self.link_radii = np.array(link_radii, dtype=float)
+        self.column_radius = column_radius
+        self.column = np.array([[0, 0, platform_z], [0, 0, 0]], dtype=float)
+        longest = max(self.kinematics.m2_len, self.kinematics.m3_len, self.kinematics.m4_len)
+        self.samples = np.linspace(0, 1, int(np.ceil(longest / sample_step)) + 1)
+
+    def clearance(self, m1, m2, m3, m4):
+        """
+        :param m1: joint 1 angles (degrees), array
+        :param m2: joint 2 angles (degrees), array broadcastable with m1
+        :param m3: joint 3 angles (degrees), array broadcastable with m1
+        :param m4: joint 4 angles (degrees), array broadcastable with m1
+        :return: (..., ) smallest distance (mm) between the arm and itself, the platform and the floor,
+            negative if they intersect
+        """
+        points = self.kinematics.forward_3d(m1, m2, m3, m4)
+        start, end = points[..., :-1, :], points[..., 1:, :]
+        radii = self.link_radii
+
+        # floor, the lowest point of a capsule is at one of its ends
+        out = (np.minimum(start[..., 2], end[..., 2]) - radii - self.ground_z).min(axis=-1)
+
+        # platform, points along every link
+        along = start[..., None, :] + (end - start)[..., None, :] * self.samples[:, None]
+        outside = np.maximum(self.box_low - along, 0) + np.maximum(along - self.box_high, 0)
+        box = np.sqrt((outside ** 2).sum(axis=-1)).min(axis=-1) - radii
+        out = np.minimum(out, box.min(axis=-1))
+
+        # arm mount against links after joint 3 and the gripper, link after joint 2 against the gripper
+        column = segment_distance(self.column[0], self.column[1], start[..., 1:, :], end[..., 1:, :])
+        out = np.minimum(out, (column - radii[1:] - self.column_radius).min(axis=-1))
+        links = segment_distance(start[..., 0, :], end[..., 0, :], start[..., 2, :], end[..., 2, :])
+        return np.minimum(out, links - radii[0] - radii[2])
+
+    def free(self, m1, m2, m3, m4):
+        """
+        :return: (..., ) bool mask of poses keeping margin clearance, arguments as in clearance
+        """
+        return self.clearance(m1, m2, m3, m4) > self.margin
+
+    def check_trajectory(self, trajectory, /, dt=0.02):
+        """
+        Checks ArmTrajectory sampled every dt
+        :param trajectory: ArmTrajectory
+        :param dt: sampling period (s)
+        :return: True if trajectory is collision free, time (s) of the first collision or None
+        """
+        times = np.append(np.arange(0, trajectory.duration, dt), trajectory.duration)
+        pos = trajectory.sample(times)[0]
+        free = self.free(pos[:, 0], pos[:, 1], pos[:, 2], pos[:, 3])
+        if free.all():
+            return True, None
+        return False, float(times[np.argmin(free)])
+
+
+def segment_distance(p1, q1, p2, q2):
+    """
+    Distance between segments p1 q1 and p2 q2
+    :param p1: (..., 3) start of the first segments
+    :param q1: (..., 3) end of the first segments
+    :param p2: (..., 3) start of the second segments
+    :param q2: (..., 3) end of the second segments
+    :return: (..., ) distances
+    """
+    d1, d2, r = q1 - p1, q2 - p2, p1 - p2
+    a = (d1 * d1).sum(axis=-1)
+    e = (d2 * d2).sum(axis=-1)
+    b = (d1 * d2).sum(axis=-1)
+    c = (d1 * r).sum(axis=-1)
+    f = (d2 * r).sum(axis=-1)
+    denom = a * e - b * b
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # closest points of the lines, parallel segments start from s = 0
+        s = np.where(denom > 1e-9, np.clip((b * f - c * e) / denom, 0, 1), 0.0)
+        t = (b * s + f) / e
+        # t out of the second segment: clamp it and find s again
+        s = np.where(t < 0, np.clip(-c / a, 0, 1), np.where(t > 1, np.clip((b - c) / a, 0, 1), s))
+    t = np.clip(t, 0, 1)
+    return np.sqrt((((p1 + d1 * s[..., None]) - (p2 + d2 * t[..., None])) ** 2).sum(axis=-1))
@@ -0,0 +1,64 @@
+from ArmTrajectory import MAX_ACC, MAX_VEL
+
+
+class ArmHandle:
+    """
+    Commands of one arm of KUKA robot\n
+    Every arm has its own send slots, so handles of different arms can be used from different threads
+    at full rate without overwriting each other's commands
+    """
+
+    def __init__(self, robot, arm_ID, /):
+        """
+        :param robot: KUKA
+        :param arm_ID: arm number
+        """
+        self.robot = robot
+        self.arm_ID = arm_ID
+
+    def move(self, *args, **kwargs):
+        """
+        Sets arm position, same arguments as KUKA.move_arm without arm_ID
+        """
+        self.robot.move_arm(*args, arm_ID=self.arm_ID, **kwargs)
+
+    def set_vel(self, *args, **kwargs):
+        """
+        Sets arm velocities, same arguments as KUKA.set_arm_vel without arm_ID
+        """
+        self.robot.set_arm_vel(*args, arm_ID=self.arm_ID, **kwargs)
+
+    def move_trajectory(self, waypoints, /, durations=None, max_vel=MAX_VEL, max_acc=MAX_ACC, velocity=False):
+        """
+        Streams arm along joint waypoints, same arguments as KUKA.move_arm_trajectory without arm_ID
+
+        :return: concurrent.futures.Future of the trajectory
+        """
+        return self.robot.move_arm_trajectory(waypoints, durations=durations, max_vel=max_vel, max_acc=max_acc,
+                                              arm_ID=self.arm_ID, velocity=velocity)
+
+    @property
+    def trajectory_progress(self):
+        """
+        :return: part of current trajectory duration passed or None
+        """
+        return self.robot.arm_trajectory_progress(self.arm_ID)
+
+    @property
+    def pos(self):
+        """
+        :return: last sent position (joint 1 - 5, grip)
+        """
+        return list(self.robot.arm_pos[self.arm_ID])
+
+    @property
+    def state(self):
+        """
+        :return: arm position received from the robot
+        """
+        if not self.robot.connected:
+            return None, None, None, None, None
+        self.robot.data_lock.acquire()
+        out = self.robot.corr_arm_pos[self.arm_ID]
+        self.robot.data_lock.release()
+        return out
@@ -0,0 +1,268 @@
+import numpy as np
+
+M2_LEN = 155  # link lengths (mm), the same as in KUKA and GUI
+M3_LEN = 135
+M4_LEN = 200
+M1_RANGE = (-134, 157)  # joint limits (degrees) of KUKA.solve_arm and move_arm, bounds are not included
+M2_RANGE = (-84, 63)
+M3_RANGE = (-135, 110)
+M4_RANGE = (-90, 95)
+
+
+class ArmKinematics:
+    """
+    Inverse and forward kinematics of the arm for arrays of targets and joint angles\n
+    Cylindrical coordinates: x - distance from joint 2 axis, y - height above it (mm).
+    Cartesian coordinates: x, y - horizontal with y along joint 1 at zero angle, z - height (mm).
+    Joint angles are in degrees from upright position, out of reach targets give nan instead of math errors
+    and all solutions are returned with masks of solutions within joint limits
+    """
+
+    def __init__(self, /, m2_len=M2_LEN, m3_len=M3_LEN, m4_len=M4_LEN,
+                 m1_range=M1_RANGE, m2_range=M2_RANGE, m3_range=M3_RANGE, m4_range=M4_RANGE):
+        """
+        :param m2_len: length of link after joint 2 (mm)
+        :param m3_len: length of link after joint 3 (mm)
+        :param m4_len: length from joint 4 to the gripper (mm)
+        :param m1_range: (min, max) of joint 1 (degrees)
+        :param m2_range: (min, max) of joint 2 (degrees)
+        :param m3_range: (min, max) of joint 3 (degrees)
+        :param m4_range: (min, max) of joint 4 (degrees)
+        """
+        self.m2_len = m2_len
+        self.m3_len = m3_len
+        self.m4_len = m4_len
+        self.m1_range = m1_range
+        self.lower = np.array([m2_range[0], m3_range[0], m4_range[0]], dtype=float)
+        self.upper = np.array([m2_range[1], m3_range[1], m4_range[1]], dtype=float)
+
+    def solve(self, x, y, ang):
+        """
+        Solves inverse kinematics for both elbow solutions
+        :param x: distance from joint 2 axis (mm), array
+        :param y: height above joint 2 axis (mm), array broadcastable with x
+        :param ang: angle from last joint to horizon (rad), array broadcastable with x
+        :return: (..., 2, 3) joint 2 - 4 angles (degrees) of the first and the second elbow solution,
+            (..., 2) bool mask of solutions within joint limits
+        """
+        x, y, ang = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (x, y, ang)))
+        x = x - self.m4_len * np.sin(ang)
+        y = y + self.m4_len * np.cos(ang)
+        dist2 = x ** 2 + y ** 2
+        fi = np.arctan2(y, x)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            # nan outside of acos range, the same targets make solve_arm fail with math error
+            b = np.arccos((self.m2_len ** 2 + self.m3_len ** 2 - dist2) / (2 * self.m2_len * self.m3_len))
+            a = np.arccos((self.m2_len ** 2 - self.m3_len ** 2 + dist2) / (2 * self.m2_len * np.sqrt(dist2)))
+        joints = np.empty(x.shape + (2, 3))
+        joints[..., 0, 0] = fi + a - np.pi / 2
+        joints[..., 0, 1] = b - np.pi
+        joints[..., 0, 2] = ang - joints[..., 0, 0] - joints[..., 0, 1] - np.pi
+        joints[..., 1, 0] = fi - a - np.pi / 2
+        joints[..., 1, 1] = np.pi - b
+        joints[..., 1, 2] = ang + a + b - fi - 3 * np.pi / 2
+        joints = np.degrees(joints)
+        valid = ((joints > self.lower) & (joints < self.upper)).all(axis=-1)
+        return joints, valid
+
+    def best(self, x, y, ang):
+        """
+        Solves inverse kinematics choosing the solution like solve_arm (the first elbow solution if it is valid)
+        :param x: distance from joint 2 axis (mm), array
+        :param y: height above joint 2 axis (mm), array broadcastable with x
+        :param ang: angle from last joint to horizon (rad), array broadcastable with x
+        :return: (..., 3) joint 2 - 4 angles (degrees, nan if not reachable), (..., ) bool mask of reachable targets
+        """
+        joints, valid = self.solve(x, y, ang)
+        second = ~valid[..., 0] & valid[..., 1]
+        out = np.where(second[..., None], joints[..., 1, :], joints[..., 0, :])
+        reachable = valid.any(axis=-1)
+        out[~reachable] = np.nan
+        return out, reachable
+
+    def solve_3d(self, x, y, z, ang):
+        """
+        Solves inverse kinematics in cartesian coordinates: joint 1 turned to the target and turned back
+        (reaching over), both with both elbow solutions
+        :param x: array (mm)
+        :param y: array broadcastable with x (mm)
+        :param z: height above joint 2 axis (mm), array broadcastable with x
+        :param ang: angle from last joint to horizon (rad), array broadcastable with x
+        :return: (..., 4, 4) joint 1 - 4 angles (degrees), (..., 4) bool mask of solutions within joint limits
+        """
+        x, y, z, ang = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (x, y, z, ang)))
+        r = np.hypot(x, y)
+        m1 = np.degrees(np.arctan2(x, y))
+        # turned back joint 1 sees the target at negative distance with mirrored approach angle
+        m1_back = np.where(m1 > 0, m1 - 180, m1 + 180)
+        front, front_valid = self.solve(r, z, ang)
+        back, back_valid = self.solve(-r, z, -ang)
+        joints = np.empty(x.shape + (4, 4))
+        joints[..., :2, 0] = m1[..., None]
+        joints[..., 2:, 0] = m1_back[..., None]
+        joints[..., :2, 1:] = front
+        joints[..., 2:, 1:] = back
+        m1_valid = (joints[..., 0] > self.m1_range[0]) & (joints[..., 0] < self.m1_range[1])
+        return joints, m1_valid & np.concatenate([front_valid, back_valid], axis=-1)
+
+    def best_3d(self, x, y, z, ang):
+        """
+        Solves inverse kinematics in cartesian coordinates choosing the first valid of solve_3d solutions
+        (joint 1 to the target, first elbow solution preferred)
+        :return: (..., 4) joint 1 - 4 angles (degrees, nan if not reachable), (..., ) bool mask of reachable targets
+        """
+        joints, valid = self.solve_3d(x, y, z, ang)
+        first = np.argmax(valid, axis=-1)
+        out = np.take_along_axis(joints, first[..., None, None], axis=-2)[..., 0, :]
+        reachable = valid.any(axis=-1)
+        out[~reachable] = np.nan
+        return out, reachable
+
+    def forward(self, m2, m3, m4):
+        """
+        Forward kinematics in cylindrical coordinates
+        :param m2: joint 2 angles (degrees), array
+        :param m3: joint 3 angles (degrees), array broadcastable with m2
+        :param m4: joint 4 angles (degrees), array broadcastable with m2
+        :return: (..., 4, 2) x, y (mm) of joints 2, 3, 4 and of the gripper end
+        """
+        m2, m3, m4 = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (m2, m3, m4)))
+        # absolute link angles from upright position, positive leans back
+        theta = np.radians(np.stack([m2, m2 + m3, m2 + m3 + m4], axis=-1))
+        links = np.array([self.m2_len, self.m3_len, self.m4_len])
+        points = np.zeros(m2.shape + (4, 2))
+        points[..., 1:, 0] = np.cumsum(-links * np.sin(theta), axis=-1)
+        points[..., 1:, 1] = np.cumsum(links * np.cos(theta), axis=-1)
+        return points
+
+    def forward_3d(self, m1, m2, m3, m4):
+        """
+        Forward kinematics in cartesian coordinates
+        :param m1: joint 1 angles (degrees), array
+        :param m2: joint 2 angles (degrees), array broadcastable with m1
+        :param m3: joint 3 angles (degrees), array broadcastable with m1
+        :param m4: joint 4 angles (degrees), array broadcastable with m1
+        :return: (..., 4, 3) x, y, z (mm) of joints 2, 3, 4 and of the gripper end
+        """
+        m1, m2, m3, m4 = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (m1, m2, m3, m4)))
+        planar = self.forward(m2, m3, m4)
+        m1 = np.radians(m1)[..., None]
+        return np.stack([planar[..., 0] * np.sin(m1), planar[..., 0] * np.cos(m1), planar[..., 1]], axis=-1)
+
+
+class ReachabilityMap:
+    """
+    Precomputed reachability of the arm workspace\n
+    Cells of the cylindrical workspace (x - distance from joint 2 axis, y - height) for a set of quantized
+    approach angles are solved once with ArmKinematics, queries are single array lookups of the nearest cell
+    """
+
+    def __init__(self, kinematics=None, /, resolution=5.0, angles=72, x_range=None, y_range=None, collision=None):
+        """
+        :param kinematics: ArmKinematics, default link lengths and joint limits if None
+        :param collision: ArmCollision, solutions colliding with joint 1 at zero angle are not reachable if given
+        :param resolution: cell size (mm)
+        :param angles: number of approach angles over the full turn
+        :param x_range: (min, max) x (mm), whole reach of the arm by default
+        :param y_range: (min, max) y (mm), whole reach of the arm by default
+        """
+        self.kinematics = kinematics or ArmKinematics()
+        reach = self.kinematics.m2_len + self.kinematics.m3_len + self.kinematics.m4_len
+        self.resolution = float(resolution)
+        self.x_range = tuple(x_range or (-reach, reach))
+        self.y_range = tuple(y_range or (-reach, reach))
+        self.angles = np.arange(angles) * (2 * np.pi / angles)
+        cols = int(np.ceil((self.x_range[1] - self.x_range[0]) / self.resolution))
+        rows = int(np.ceil((self.y_range[1] - self.y_range[0]) / self.resolution))
+        x = self.x_range[0] + (np.arange(cols) + 0.5) * self.resolution
+        y = self.y_range[0] + (np.arange(rows) + 0.5) * self.resolution
+        # (angles, rows, cols), solved angle by angle to keep memory low
+        self.grid = np.zeros((angles, rows, cols), dtype=bool)
+        for i, ang in enumerate(self.angles):
+            joints, valid = self.kinematics.solve(x[None, :], y[:, None], ang)
+            if collision is not None:
+                # only solutions within limits are checked
+                solutions = joints[valid]
+                valid[valid] = collision.free(0, solutions[:, 0], solutions[:, 1], solutions[:, 2])
+            self.grid[i] = valid.any(axis=-1)
+        self.any_angle = self.grid.any(axis=0)
+
+    def _cell(self, x, y, ang):
+        """
+        :return: (angle index, row, column) of the nearest cell or None if outside of the map
+        """
+        col = int((x - self.x_range[0]) // self.resolution)
+        row = int((y - self.y_range[0]) // self.resolution)
+        if not (0 <= row < self.grid.shape[1] and 0 <= col < self.grid.shape[2]):
+            return None
+        return int(round(ang / (2 * np.pi) * len(self.angles))) % len(self.angles), row, col
+
+    def reachable(self, x, y, ang):
+        """
+        :param x: distance from joint 2 axis (mm)
+        :param y: height above joint 2 axis (mm)
+        :param ang: angle from last joint to horizon (rad)
+        :return: True if the target is reachable with the nearest quantized approach angle
+        """
+        cell = self._cell(x, y, ang)
+        return cell is not None and bool(self.grid[cell])
+
+    def region(self, ang):
+        """
+        :param ang: approach angle (rad)
+        :return: (rows, cols) bool mask of reachable cells with the nearest quantized angle, row 0 is the lowest
+        """
+        return self.grid[int(round(ang / (2 * np.pi) * len(self.angles))) % len(self.angles)]
+
+    def angles_at(self, x, y):
+        """
+        :param x: distance from joint 2 axis (mm)
+        :param y: height above joint 2 axis (mm)
+        :return: approach angles (rad) the point is reachable with
+        """
+        cell = self._cell(x, y, 0)
+        if cell is None:
+            return self.angles[:0]
+        return self.angles[self.grid[:, cell[1], cell[2]]]
+
+    def best_angle(self, x, y, preferred):
+        """
+        Approach angle for grasp planning
+        :param x: distance from joint 2 axis (mm)
+        :param y: height above joint 2 axis (mm)
+        :param preferred: wanted approach angle (rad)
+        :return: reachable angle closest to preferred or None if point is not reachable
+        """
+        angles = self.angles_at(x, y)
+        if not len(angles):
+            return None
+        diff = np.abs((angles - preferred + np.pi) % (2 * np.pi) - np.pi)
+        return float(angles[np.argmin(diff)])
+
+    def save(self, path):
+        """
+        Saves map to .npz file
+        :param path: name and path to file
+        """
+        np.savez_compressed(path, grid=np.packbits(self.grid, axis=-1), shape=self.grid.shape,
+                            resolution=self.resolution, x_range=self.x_range, y_range=self.y_range)
+
+    @classmethod
+    def load(cls, path, kinematics=None):
+        """
+        Loads map saved with save
+        :param path: name and path to file
+        :param kinematics: ArmKinematics the map was built for
+        :return: ReachabilityMap
+        """
+        data = np.load(path)
+        shape = tuple(data["shape"])
+        reach_map = cls.__new__(cls)
+        reach_map.kinematics = kinematics or ArmKinematics()
+        reach_map.resolution = float(data["resolution"])
+        reach_map.x_range = tuple(data["x_range"])
+        reach_map.y_range = tuple(data["y_range"])
+        reach_map.angles = np.arange(shape[0]) * (2 * np.pi / shape[0])
+        reach_map.grid = np.unpackbits(data["grid"], axis=-1, count=shape[2]).astype(bool)
+        reach_map.any_angle = reach_map.grid.any(axis=0)
+        return reach_map
@@ -0,0 +1,56 @@
+import numpy as np
+
+JOINTS = 5
+MAX_VEL = 30.0  # default joint speed limit (degrees/s)
+MAX_ACC = 60.0  # default joint acceleration limit (degrees/s^2)
+
+
+class ArmTrajectory:
+    """
+    Time parameterized joint trajectory through waypoints\n
+    Every segment is a minimum jerk move (zero velocity and acceleration at waypoints) of all joints together,
+    its duration is given or the shortest one that keeps every joint within speed and acceleration limits
+    """
+
+    def __init__(self, waypoints, /, durations=None, max_vel=MAX_VEL, max_acc=MAX_ACC, start=None):
+        """
+        :param waypoints: list of joint 1 - 5 angles (degrees)
+        :param durations: duration of every segment (s), one value for all segments or None to use limits
+        :param max_vel: speed limit (degrees/s), one value or one per joint
+        :param max_acc: acceleration limit (degrees/s^2), one value or one per joint
+        :param start: joint angles the trajectory starts from (first segment goes from start to the first waypoint)
+        """
+        points = [start] + list(waypoints) if start is not None else list(waypoints)
+        self.points = np.array([p[:JOINTS] for p in points], dtype=float)
+        if len(self.points) == 1:
+            self.points = np.repeat(self.points, 2, axis=0)
+        self.steps = np.diff(self.points, axis=0)
+        if durations is None:
+            dist = np.abs(self.steps)
+            # peak speed of minimum jerk move is 1.875 * d / T, peak acceleration 5.77 * d / T^2
+            durations = np.maximum(1.875 * dist / max_vel, np.sqrt(5.7735 * dist / max_acc)).max(axis=1)
+        self.durations = np.broadcast_to(np.asarray(durations, dtype=float), (len(self.steps),)).copy()
+        self.times = np.concatenate([[0.0], np.cumsum(self.durations)])
+        self.duration = float(self.times[-1])
+        self.progress = 0.0  # part of duration passed, updated by the executor
+
+    def sample(self, t):
+        """
+        :param t: time from trajectory start (s), scalar or array
+        :return: joint angles (degrees) and joint speeds (degrees/s), (..., 5)
+        """
+        t = np.asarray(t, dtype=float)
+        ind = np.clip(np.searchsorted(self.times, t, side="right") - 1, 0, len(self.steps) - 1)
+        duration = self.durations[ind]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            tau = np.where(duration > 0, np.clip((t - self.times[ind]) / duration, 0, 1), 1.0)
+            speed = np.where(duration > 0, 30 * tau ** 2 * (1 - tau) ** 2 / duration, 0.0)
+        s = tau ** 3 * (10 - 15 * tau + 6 * tau ** 2)
+        return self.points[ind] + self.steps[ind] * s[..., None], self.steps[ind] * speed[..., None]
+
+    @property
+    def end(self):
+        """
+        :return: last waypoint
+        """
+        return self.points[-1]
@@ -0,0 +1,253 @@
+import math
+import threading as thr
+import time
+
+from Odometry import wrap_angle
+
+
+class RateLoop:
+    """
+    Fixed rate loop timing\n
+    Every iteration waits for its own deadline (start + n * period), so the period doesn't drift
+    with the work time of the loop body. Late iterations are counted as overruns and the schedule restarts
+    """
+
+    def __init__(self, frequency):
+        """
+        :param frequency: loop frequency (Hz)
+        """
+        self.period = 1 / frequency
+        self.iterations = 0
+        self.overruns = 0
+        self._deadline = None
+        self._last = None
+        self._jitter_sum = 0.0
+        self._jitter_sq_sum = 0.0
+        self._jitter_max = 0.0
+
+    def sleep(self):
+        """
+        Waits for the next deadline
+        :return: time since the previous call (s)
+        """
+        now = time.perf_counter()
+        if self._deadline is None:
+            self._deadline = self._last = now
+        self._deadline += self.period
+        delay = self._deadline - now
+        if delay > 0:
+            time.sleep(delay)
+        elif -delay > self.period:
+            self.overruns += 1
+            self._deadline = now
+        now = time.perf_counter()
+        dt = now - self._last
+        self._last = now
+        jitter = abs(dt - self.period)
+        self.iterations += 1
+        self._jitter_sum += jitter
+        self._jitter_sq_sum += jitter ** 2
+        self._jitter_max = max(self._jitter_max, jitter)
+        return dt
+
+    @property
+    def stats(self):
+        """
+        :return: dict with number of iterations, overruns, mean, rms and max absolute deviation
+            of the period (s)
+        """
+        n = max(1, self.iterations)
+        return {"iterations": self.iterations,
+                "overruns": self.overruns,
+                "jitter_mean": self._jitter_sum / n,
+                "jitter_rms": math.sqrt(self._jitter_sq_sum / n),
+                "jitter_max": self._jitter_max}
+
+
+class TrapezoidalController:
+    """
+    Point to point base controller with trapezoidal velocity profile\n
+    Speed towards the target is limited by max speed, by the speed the robot can still stop from
+    at the target with max acceleration and by proportional approach near the target.
+    Changes of commanded velocity are limited by max acceleration
+    """
+
+    def __init__(self, /, max_speed=0.2, max_acc=0.3, max_ang_speed=0.6, max_ang_acc=1.0, k=1.0):
+        """
+        :param max_speed: linear speed limit (m/s)
+        :param max_acc: linear acceleration limit (m/s^2)
+        :param max_ang_speed: angular speed limit (rad/s)
+        :param max_ang_acc: angular acceleration limit (rad/s^2)
+        :param k: proportional coefficient of the final approach (1/s)
+        """
+        self.max_speed = max_speed
+        self.max_acc = max_acc
+        self.max_ang_speed = max_ang_speed
+        self.max_ang_acc = max_ang_acc
+        self.k = k
+        self.velocity = [0.0, 0.0, 0.0]  # last commanded vx, vy (world frame) and angular speed
+
+    def reset(self, velocity=(0.0, 0.0, 0.0)):
+        """
+        :param velocity: current vx, vy (world frame) and angular speed
+        """
+        self.velocity = list(velocity)
+
+    @staticmethod
+    def profile_speed(dist, max_speed, max_acc, k, end_speed=0.0):
+        """
+        :return: speed allowed at distance dist from target that is passed with end_speed
+        """
+        return min(max_speed, math.sqrt(end_speed ** 2 + 2 * max_acc * dist), end_speed + k * dist)
+
+    def step(self, pose, target, dt, /, end_speed=0.0):
+        """
+        Computes next velocity command
+        :param pose: current [x, y, ang]
+        :param target: target [x, y, ang]
+        :param dt: time since the previous step (s)
+        :param end_speed: speed to pass the target with (for blended waypoints)
+        :return: world frame velocity [vx, vy, w]
+        """
+        dx, dy = target[0] - pose[0], target[1] - pose[1]
+        dist = math.hypot(dx, dy)
+        d_ang = wrap_angle(target[2] - pose[2])
+
+        speed = self.profile_speed(dist, self.max_speed, self.max_acc, self.k, end_speed)
+        vx, vy = (dx / dist * speed, dy / dist * speed) if dist > 0 else (0.0, 0.0)
+        w = math.copysign(self.profile_speed(abs(d_ang), self.max_ang_speed, self.max_ang_acc, self.k), d_ang)
+
+        # acceleration limits
+        ax, ay = vx - self.velocity[0], vy - self.velocity[1]
+        acc = math.hypot(ax, ay)
+        if acc > self.max_acc * dt:
+            scale = self.max_acc * dt / acc
+            vx, vy = self.velocity[0] + ax * scale, self.velocity[1] + ay * scale
+        max_dw = self.max_ang_acc * dt
+        w = min(self.velocity[2] + max_dw, max(self.velocity[2] - max_dw, w))
+        self.velocity = [vx, vy, w]
+        return self.velocity
+
+
+def world_to_base_command(velocity, ang):
+    """
+    Converts world frame velocity to move_base arguments
+    :param velocity: [vx, vy, w] in world frame
+    :param ang: robot angle
+    :return: forward, sideways and rotation speed as move_base expects them
+    """
+    vx, vy, w = velocity
+    cos, sin = math.cos(ang), math.sin(ang)
+    # move_base sideways and rotation axes point to the right and clockwise
+    return cos * vx + sin * vy, sin * vx - cos * vy, -w
+
+
+class BasePath:
+    """
+    Waypoints executed by the base control thread\n
+    Intermediate waypoints are passed without stopping: the next one becomes the target inside blend radius
+    and the speed at every corner is limited so that the direction change fits max acceleration
+    """
+
+    def __init__(self, poses, /, start=None, blend_radius=0.1, prec=0.005, max_speed=0.2, max_acc=0.3, k=4.0,
+                 on_done=None, on_waypoint=None):
+        """
+        :param poses: list of [x, y, ang] (or [x, y] keeping the previous angle)
+        :param start: robot [x, y, ang] when path starts
+        :param blend_radius: distance (m) to intermediate waypoint at which the next one becomes the target
+        :param prec: position (m) and angle (rad) precision of the last waypoint
+        :param max_speed: linear speed limit (m/s)
+        :param max_acc: linear acceleration limit (m/s^2)
+        :param k: proportional coefficient of the final approach
+        :param on_done: called as on_done(reached) from the control thread when path is finished or cancelled
+        :param on_waypoint: called as on_waypoint(index) from the control thread when waypoint is passed
+        """
+        self.start = list(start) if start is not None else None
+        self.poses = []
+        ang = start[2] if start is not None else 0.0
+        for pose in poses:
+            ang = pose[2] if len(pose) > 2 else ang
+            self.poses.append([pose[0], pose[1], ang])
+        self.blend_radius = blend_radius
+        self.prec = prec
+        self.max_speed = max_speed
+        self.max_acc = max_acc
+        self.k = k
+        self.on_done = on_done
+        self.on_waypoint = on_waypoint
+        self.index = 0
+        self.reached = None  # True - last waypoint reached, False - cancelled
+        self.done = thr.Event()
+        self.lengths = [math.hypot(b[0] - a[0], b[1] - a[1]) for a, b in zip(self.poses, self.poses[1:])]
+        self.end_speeds = self._corner_speeds()
+
+    def _corner_speeds(self):
+        """
+        :return: max speed at every waypoint (0 at the last one)
+        """
+        speeds = [0.0] * len(self.poses)
+        for i in range(len(self.poses) - 2, -1, -1):
+            a = self.poses[i - 1] if i else self.start
+            b, c = self.poses[i], self.poses[i + 1]
+            if a is None or (a[0], a[1]) == (b[0], b[1]):
+                turn = math.pi  # direction to the waypoint is unknown
+            else:
+                turn = abs(wrap_angle(math.atan2(c[1] - b[1], c[0] - b[0]) - math.atan2(b[1] - a[1], b[0] - a[0])))
+            # velocity change 2 * v * sin(turn / 2) in time 2 * blend_radius / v
+            sin = math.sin(turn / 2)
+            corner = math.sqrt(self.max_acc * self.blend_radius / sin) if sin > 1e-6 else self.max_speed
+            reachable = math.sqrt(speeds[i + 1] ** 2 + 2 * self.max_acc * self.lengths[i])
+            speeds[i] = min(self.max_speed, corner, reachable)
+        return speeds
+
+    @property
+    def target(self):
+        """
+        :return: current waypoint
+        """
+        return self.poses[self.index]
+
+    @property
+    def last(self):
+        """
+        :return: True if current waypoint is the last one
+        """
+        return self.index == len(self.poses) - 1
+
+    def remaining(self, pose):
+        """
+        :param pose: current [x, y, ang]
+        :return: path length (m) left from pose
+        """
+        target = self.target
+        return math.hypot(target[0] - pose[0], target[1] - pose[1]) + sum(self.lengths[self.index:])
+
+    def next_waypoint(self):
+        """
+        Switches to the next waypoint
+        """
+        self.index += 1
+        if self.on_waypoint:
+            self.on_waypoint(self.index - 1)
+
+    def replanned(self, poses, /, start=None):
+        """
+        :param poses: new list of [x, y, ang] (or [x, y])
+        :param start: robot [x, y, ang] now
+        :return: path along poses with the same parameters, done event and callbacks (waypoints are counted anew)
+        """
+        path = BasePath(poses, start=start, blend_radius=self.blend_radius, prec=self.prec, max_speed=self.max_speed,
+                        max_acc=self.max_acc, k=self.k, on_done=self.on_done, on_waypoint=self.on_waypoint)
+        path.done = self.done
+        return path
+
+    def finish(self, reached):
+        """
+        :param reached: True if the last waypoint was reached, False if path was cancelled
+        """
+        if self.done.is_set():
+            return
+        self.reached = reached
+        self.done.set()
+        if self.on_done:
+            self.on_done(reached)
@@ -4,6 +4,7 @@ import time
 import cv2
 import numpy as np
 
+from LidarGeometry import LidarGeometry
 from Objects import *
 from Screen import Screen
 
@@ -35,17 +36,13 @@ class GuiControl:
         # canvases
         self.arm_background = np.array([[[20, 70, 190]] * 600] * 480, dtype=np.uint8)
         self.arm_screen = np.copy(self.arm_background)
+        self.reach_background = None  # arm_background with reachable region of reach_background_ind angle
+        self.reach_background_ind = None
 
         self.body_pos_background = np.array([[[20, 70, 190]] * 300] * 300, dtype=np.uint8)
         self.body_pos_screen = np.copy(self.body_pos_background)
 
-        # arm parameters
-        self.m2_ang_offset = - math.pi
-        self.m3_ang_offset = 2 * math.pi
-        self.m4_ang_offset = 0
-        self.m2_len = 155
-        self.m3_len = 135
-        self.m4_len = 200
+        # arm parameters (link geometry is in robot.kinematics)
         self.m2_range = [-65, 90]
         self.m3_range = [-150, 146]
 
@@ -58,6 +55,7 @@ class GuiControl:
 
         # flags, counters, service
         self.old_lidar = None
+        self.lidar_geometry = LidarGeometry()
         self.old_body_pos = [0, 0, 0]
         self.last_checked_pressed_keys = None
         self.robot.going_to_pos_sent = False
@@ -281,18 +279,32 @@ class GuiControl:
                 else:
                     self.old_body_pos = buff
                     self.old_lidar = lidar
-                cent_y, cent_x = y * self.move_body_scale + 150, -x * self.move_body_scale + 150
-                cent_y = int(cent_y - 0.3 * self.move_body_scale * math.cos(ang + math.pi / 2))
-                cent_x = int(cent_x - 0.3 * self.move_body_scale * math.sin(ang + math.pi / 2))
-                for l in range(0, len(lidar), 5):
-                    if not 0.01 < lidar[l] < 5.5:
-                        continue
-                    color = (0, max(255, 255 - int(45.5 * l)), min(255, int(45.5 * l)))
-                    cv2.ellipse(self.body_pos_screen, (cent_y, cent_x),
-                                (int(lidar[l] * self.move_body_scale), int(lidar[l] * self.move_body_scale)),
-                                math.degrees(ang), 30 + int(-240 / len(lidar) * l),
-                                30 + int(-240 / len(lidar) * (l + 1)), color,
-                                max(1, int(0.1 * self.move_body_scale)))
+                points = self.lidar_geometry.valid_points(lidar, pose=(x, y, ang), step=5)
+                screen = np.empty(points.shape, dtype=np.int32)
+                screen[:, 0] = points[:, 1] * self.move_body_scale + 150
+                screen[:, 1] = -points[:, 0] * self.move_body_scale + 150
+                # every point is drawn as zero length polyline
+                cv2.polylines(self.body_pos_screen, list(np.repeat(screen[:, None], 2, axis=1)), False,
+                              (0, 255, 255), max(1, int(0.1 * self.move_body_scale)))
+
+    def map_background(self):
+        """
+        draws robot occupancy grid (if it is built) over body_pos_background
+        :return: new body_pos_screen
+        """
+        screen = np.copy(self.body_pos_background)
+        grid = getattr(self.robot, "occupancy_grid", None)
+        if grid is None or not grid.scans:
+            return screen
+        # map cell (row, column) -> body_pos_screen pixel, the same transform as for robot position
+        scale = grid.resolution * self.move_body_scale
+        c_u = (grid.origin[1] + 0.5 * grid.resolution) * self.move_body_scale + 150
+        c_v = -(grid.origin[0] + 0.5 * grid.resolution) * self.move_body_scale + 150
+        m = np.array([[0, scale, c_u], [-scale, 0, c_v]], dtype=np.float32)
+        log_odds = cv2.warpAffine(grid.log_odds, m, screen.shape[1::-1], flags=cv2.INTER_NEAREST)
+        screen[log_odds < -1] = (60, 110, 210)
+        screen[log_odds > 1] = (0, 0, 0)
+        return screen
 
     def update_body_pos(self, *args):
         """
@@ -310,11 +322,14 @@ class GuiControl:
                 self.robot.going_to_pos_sent = True
         else:
             self.robot.going_to_pos_sent = False
-        self.body_pos_screen = np.copy(self.body_pos_background)
+        self.body_pos_screen = self.map_background()
         buff = self.robot.increment
         if buff:
             x, y, ang = self.target_body_pos
             cv2.circle(self.body_pos_screen, (x, y), 3, (100, 255, 100), -1)
+            path = self.robot.base_path
+            if path:
+                self.draw_path(self.robot.fused_increment, path.poses[path.index:])
             x, y, ang = self.robot.increment
             cv2.circle(self.body_pos_screen,
                        (int(y * self.move_body_scale + 150), int(-x * self.move_body_scale + 150)),
@@ -354,6 +369,17 @@ class GuiControl:
                      max(1, int(0.02 * self.move_body_scale)))
             self.update_lidar()
 
+    def draw_path(self, pos, poses):
+        """
+        draws remaining path of the robot on body_pos_screen
+        :param pos: current robot position
+        :param poses: remaining waypoints
+        """
+        points = np.array([pos[:2]] + [p[:2] for p in poses])
+        screen = np.column_stack([points[:, 1] * self.move_body_scale + 150,
+                                  -points[:, 0] * self.move_body_scale + 150]).astype(np.int32)
+        cv2.polylines(self.body_pos_screen, [screen], False, (100, 255, 100), 1)
+
     def go_to_pos(self, x, y):
         """
         configures and sends "go to position" command for robot
@@ -363,7 +389,7 @@ class GuiControl:
         """
         self.target_body_pos = [int(x), int(y), 0]
         x, y = (x - 150) / self.move_body_scale, (-y + 150) / self.move_body_scale
-        self.robot.go_to(y, x)
+        self.robot.navigate_to(y, x)
 
     def update_arm(self, scale=1.0):
         """
@@ -371,35 +397,39 @@ class GuiControl:
         :param scale: drawing scale
         :return:
         """
-        self.arm_screen = np.copy(self.arm_background)
-        m1_ang, m2_ang, m3_ang, m4_ang, m5_ang, grip = *map(math.radians, self.robot.arm_pos[0][:-1]), self.robot.arm_pos[0][
-            -1]
-        color = (100, 100, 255)
-
-        for i in range(2):
-            m2_ang += self.m2_ang_offset
-            m3_ang += self.m3_ang_offset
-            m4_ang += self.m4_ang_offset
-
-            m3_ang += m2_ang
-            m4_ang += m3_ang
-            m2x = self.start_point_x
-            m2y = self.height - self.start_point_y
-            m3x = int(m2x + self.m2_len * math.sin(m2_ang) / scale)
-            m3y = int(m2y + self.m2_len * math.cos(m2_ang) / scale)
-            m4x = int(m3x + self.m3_len * math.sin(m3_ang) / scale)
-            m4y = int(m3y + self.m3_len * math.cos(m3_ang) / scale)
-            m5x = int(m4x + self.m4_len * math.sin(m4_ang) / scale)
-            m5y = int(m4y + self.m4_len * math.cos(m4_ang) / scale)
-
-            cv2.line(self.arm_screen, (m2x, m2y), (m3x, m3y), color, 2)
-            cv2.line(self.arm_screen, (m3x, m3y), (m4x, m4y), color, 2)
-            cv2.line(self.arm_screen, (m4x, m4y), (m5x, m5y), color, 2)
-            try:
-                m1_ang, m2_ang, m3_ang, m4_ang, m5_ang = map(math.radians, self.robot.arm)
-            except:
-                break
-            color = (255, 255, 255)
+        self.arm_screen = self.arm_reach_background()
+        joints = [self.robot.arm_pos[0][1:4]]
+        try:
+            m1_ang, m2_ang, m3_ang, m4_ang, m5_ang = map(float, self.robot.arm)
+            joints.append([m2_ang, m3_ang, m4_ang])
+        except:
+            pass
+        # joint 2, joint 3, joint 4 and gripper end of sent and measured arm positions
+        points = self.robot.kinematics.forward(*np.array(joints, dtype=float).T)
+        origin = np.array([self.start_point_x, self.height - self.start_point_y])
+        screen = (points * (1, -1) / scale + origin).astype(np.int32)
+        for line, color in zip(screen, ((100, 100, 255), (255, 255, 255))):
+            cv2.polylines(self.arm_screen, [line], False, color, 2)
+
+    def arm_reach_background(self):
+        """
+        draws reachable region of the current approach angle over arm_background
+        :return: new arm_screen
+        """
+        reach = self.robot.reachability
+        ind = int(round(self.target[1] / (2 * math.pi) * len(reach.angles))) % len(reach.angles)
+        if ind != self.reach_background_ind:
+            # reachability cell (row, column) -> arm_screen pixel, the same transform as in mouse_on_arm
+            scale = reach.resolution / self.cylindrical_scale
+            c_u = self.start_point_x + (reach.x_range[0] + 0.5 * reach.resolution) / self.cylindrical_scale
+            c_v = self.height - self.start_point_y - (reach.y_range[0] + 0.5 * reach.resolution) / self.cylindrical_scale
+            m = np.array([[scale, 0, c_u], [0, -scale, c_v]], dtype=np.float32)
+            region = cv2.warpAffine(reach.grid[ind].astype(np.uint8), m, self.arm_background.shape[1::-1],
+                                    flags=cv2.INTER_NEAREST)
+            self.reach_background = np.copy(self.arm_background)
+            self.reach_background[region > 0] = (40, 100, 210)
+            self.reach_background_ind = ind
+        return np.copy(self.reach_background)
 
     def mouse_on_arm(self, *args):
         """
@@ -415,7 +445,7 @@ class GuiControl:
         self.target[1] = (self.screen.mouse_wheel_pos / 10 + math.pi / 2) % (2 * math.pi)
         target = [[(pos[0] - self.start_point_x) * self.cylindrical_scale,
                    (-pos[1] + self.height - self.start_point_y) * self.cylindrical_scale], self.target[1]]
-        _, _, _, available = self.robot.solve_arm(target)
+        available = self.robot.reachability.reachable(*target[0], target[1])
         if pressed:
             color = ((0, 230, 0) if available else (230, 0, 0))
             self.target[0] = [(pos[0] - self.start_point_x) * self.cylindrical_scale,
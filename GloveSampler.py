@@ -0,0 +1,106 @@
+import threading as thr
+import time
+
+import numpy as np
+
+from BaseController import RateLoop
+
+
+class GloveSampler:
+    """
+    Glove potentiometer sampling at fixed rate (thread)\n
+    Pins are read in their own thread independent of GUI and robot loops, every sample is stored
+    with its time.perf_counter() stamp in a ring buffer, the oldest samples are overwritten.
+    pyfirmata pins keep the last value reported by the board (every 19 ms by default),
+    samples taken before all pins reported are skipped
+    """
+
+    def __init__(self, pins, /, frequency=50, size=500):
+        """
+        :param pins: pyfirmata analog input pins
+        :param frequency: sampling frequency (Hz)
+        :param size: number of samples kept
+        """
+        self.pins = pins
+        self.frequency = frequency
+        self.times = np.zeros(size)
+        self.values = np.zeros((size, len(pins)))
+        self.count = 0  # samples taken since start
+        self.missed = 0  # samples skipped because some pin had no value
+        self.loop = None  # RateLoop of the sampling thread
+        self.cond = thr.Condition()  # notified on every sample
+        self.main_thr = thr.main_thread()
+        self.running = False
+        self.sample_thr = None
+
+    def start(self):
+        """
+        Starts sampling thread
+        """
+        if self.sample_thr and self.sample_thr.is_alive():
+            return
+        self.running = True
+        self.sample_thr = thr.Thread(target=self.sample, args=(), daemon=True)
+        self.sample_thr.start()
+
+    def stop(self):
+        """
+        Stops sampling thread
+        """
+        self.running = False
+        if self.sample_thr:
+            self.sample_thr.join()
+
+    def sample(self):
+        """
+        Reads all pins every period (thread)
+        """
+        self.loop = RateLoop(self.frequency)
+        while self.running and self.main_thr.is_alive():
+            self.loop.sleep()
+            values = [pin.read() for pin in self.pins]
+            stamp = time.perf_counter()
+            if None in values:
+                self.missed += 1
+                continue
+            with self.cond:
+                ind = self.count % len(self.times)
+                self.times[ind] = stamp
+                self.values[ind] = values
+                self.count += 1
+                self.cond.notify_all()
+
+    def wait_sample(self, count, timeout=None):
+        """
+        Waits for samples newer than count
+        :param count: number of samples already processed
+        :param timeout: max waiting time (s)
+        :return: number of samples taken (equal to count on timeout)
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.count != count, timeout)
+            return self.count
+
+    def latest(self):
+        """
+        :return: time and values of pins of the last sample, None if there are no samples yet
+        """
+        with self.cond:
+            if not self.count:
+                return None
+            ind = (self.count - 1) % len(self.times)
+            return float(self.times[ind]), self.values[ind].tolist()
+
+    def window(self, duration):
+        """
+        :param duration: length of the window (s) before the last sample
+        :return: (N, ) times and (N, pins) values of samples in the window, the oldest first
+        """
+        with self.cond:
+            n = min(self.count, len(self.times))
+            ind = np.arange(self.count - n, self.count) % len(self.times)
+            times, values = self.times[ind], self.values[ind]
+        if not n:
+            return times, values
+        inside = times >= times[-1] - duration
+        return times[inside], values[inside]
@@ -1,8 +1,10 @@
 import io
 import math
+import os
 import socket
 import threading as thr
 import time
+from concurrent.futures import Future, InvalidStateError
 
 import cv2
 import numpy as np
@@ -10,7 +12,22 @@ import paramiko
 from PIL import Image
 from mjpeg.client import MJPEGClient
 
+from ArmCollision import ArmCollision
+from ArmHandle import ArmHandle
+from ArmKinematics import ArmKinematics, ReachabilityMap
+from ArmTrajectory import MAX_ACC, MAX_VEL, ArmTrajectory
+from BaseController import BasePath, RateLoop, TrapezoidalController, world_to_base_command
+from KukaLog import open_log, open_log_writer, play, unpack_record
+from Localization import MonteCarloLocalization
+from OccupancyGrid import OccupancyGrid
+from Odometry import OdometryFilter, PoseEstimator, wrap_angle
+from PathPlanner import GridPlanner
+from SafetyStop import SafetyStop
+from ScanMatcher import ScanMatcher
+from SessionRecorder import INBOUND, OUTBOUND, SESSION_START, SessionReader, SessionRecorder
+
 deb = True
+ARM_DRIVER_SIGNS = (-1, -1, -1, -1, 1)  # direction of joints 1 - 5 in /arm: and /arm_vel: relative to move_arm angles
 
 
 def debug(inf, /, end="\n"):
@@ -46,6 +63,14 @@ class KUKA:
                  advanced=False,
                  log=None,
                  read_from_log=None,
+                 record=None,
+                 replay=None,
+                 mapping=None,
+                 scan_matching=None,
+                 localize=None,
+                 safety_stop=True,
+                 reachability=None,
+                 arm_collision=True,
                  **kwargs):
         """
         Initializes robot KUKA youbot\n
@@ -59,8 +84,25 @@ class KUKA:
         :param read_depth: if false doesn't start depth client
         :param camera_enable: enables mjpeg client if True
         :param advanced: disables all safety checks in the sake of time saving
-        :param log: if [path, freq] logs odometry and lidar data to set path with set frequency
-        :param read_from_log: if [path, freq] streams odometry and lidar data from set log path with set frequency
+        :param log: if [path, freq] logs odometry and lidar data to set path with set frequency,
+            [path, freq, fmt] sets the format: "zlib" (default) / "lzma" compressed chunks, "binary" fixed width records
+            or "text" old text lines
+        :param read_from_log: if [path, freq] streams odometry and lidar data from set log path with set frequency,
+            optional [path, freq, speed, start, start_time, batch] sets playback speed (None - unthrottled),
+            first record and batch block processing
+        :param record: if path records every received telemetry line and every sent command to set path
+        :param replay: if [path, speed] feeds recorded telemetry through the parser (speed None - unthrottled)
+        :param mapping: if True (or dict of OccupancyGrid parameters) builds occupancy grid from lidar scans
+        :param scan_matching: if True (or dict of ScanMatcher parameters) corrects wheel odometry drift
+            by matching lidar scans
+        :param localize: path to map saved with OccupancyGrid.save (or [path, [x, y, ang]] with approximate
+            initial pose), localizes robot on the map by particle filter and moves odometry to the map frame
+        :param safety_stop: if True (or dict of SafetyStop parameters) slows down and stops base commands
+            in front of obstacles seen by lidar (off in advanced mode)
+        :param reachability: path to .npz file of arm ReachabilityMap, it is built on first use and saved there
+            if the file doesn't exist
+        :param arm_collision: if True (or dict of ArmCollision parameters) drops arm commands and trajectories
+            that drive the arm into itself, the base or the floor (off in advanced mode)
         """
         if advanced:
             debug("WARNING!!! ADVANCED MODE ENABLED, ALL SAFETY CHECKS ARE SUSPENDED")
@@ -75,8 +117,10 @@ class KUKA:
         self.data_lock = thr.Lock()
         self.connected = True
 
-        # data from this variable one by one to avoid data loss (order: base, arm, grip)
-        self.send_queue = [None, None, None]
+        # latest command of every type, all pending ones are sent every period
+        # (order: base, arm 0, grip 0, arm 1, grip 1)
+        self.send_queue = [None, None, None, None, None]
+        self.send_lock = thr.Lock()
         self.send_time = 0  # last time data was sent (service)
 
         # camera receive buffer
@@ -89,19 +133,51 @@ class KUKA:
         self.cam_depth = np.array([[[190, 70, 20]] * 640] * 480, dtype=np.uint8)
 
         # control
-        self.arm_ID = 0
         self.arm_pos = [[0, 56, -80, -90, 0, 1.98], [0, 56, -80, -90, 0, 1.98]]  # last sent arm position
         self.arm_vel = [[0, 0, 0, 0, 0, 0], [0, 0, 0, 0, 0, 0]]
+        self.arms = [ArmHandle(self, 0), ArmHandle(self, 1)]  # per arm command API: robot.arms[1].move(...)
+        self.arm_deadband = [0.3, 0.3, 0.3, 0.3, 0.3]  # arm commands closer than this (degrees) to the sent one are dropped
+        self.sent_arm_cmd = [None, None]  # last posted /arm: joint values of every arm
+        self.sent_grip = [None, None]  # last posted /grip: value of every arm
+        self.arm_colliding = [False, False]  # last command of every arm was dropped by collision check
+        self.suppressed_commands = {"arm": 0, "grip": 0, "collision": 0}
+        self.arm_tolerance = 1.0  # joint error (degrees) at which arm counts as arrived
+        self.arm_target = [None, None]  # joint 1 - 5 angles of the last sent /arm: command
+        self.arm_target_time = [None, None]  # time.perf_counter() the target was sent
+        self.arm_arrival_times = [[None] * 5, [None] * 5]  # time (s) from target to arrival of every joint
+        self.arm_arrived = [thr.Event(), thr.Event()]  # set when all joints are within arm_tolerance of the target
+        self.arm_cond = thr.Condition()  # notified on every arm feedback and target
         self.body_target_pos = [0, 0, 0]  # current body target position
+        self.body_target_pos_lock = thr.Lock()
         self.going_to_target_pos = False
+        self.base_path = None  # BasePath executed by move_base_to_pos thread
+        self.base_path_posted = thr.Event()
+        self.go_to_tr = None
+        self.arm_trajectories = {}  # arm_ID: [ArmTrajectory, Future, velocity mode, start time]
+        self.arm_trajectories_lock = thr.Lock()
+        self.arm_trajectory_posted = thr.Event()
+        self.arm_trajectory_tr = None
+        self.path_planner = None  # GridPlanner of navigate_to
+        self.navigation_done = None  # done event of the path sent by navigate_to
         self.move_speed = (0, 0, 0)  # last sent move speed
         self.move_to_target_max_speed = 0.2  # max move to target speed
-        self.move_to_target_k = 1  # move to target proportional coefficient
+        self.move_to_target_k = 4  # move to target proportional coefficient of the final approach (1/s)
+        self.move_to_target_max_acc = 0.3  # m/s^2
+        self.move_to_target_max_ang_speed = 0.6  # rad/s
+        self.move_to_target_max_ang_acc = 1.0  # rad/s^2
+        self.base_loop_stats = None  # timing of the last move to target
 
         # dimensions (lengths of joints)
         self.m2_len = 155
         self.m3_len = 135
         self.m4_len = 200
+        self.kinematics = ArmKinematics(self.m2_len, self.m3_len, self.m4_len)
+        self.arm_collision = None
+        if arm_collision and not advanced:
+            self.arm_collision = ArmCollision(self.kinematics,
+                                              **(arm_collision if isinstance(arm_collision, dict) else {}))
+        self.reachability_file = reachability
+        self._reachability = None
 
         # sensor data
         self.lidar_data = None
@@ -110,14 +186,46 @@ class KUKA:
         self.corr_arm_pos = [None, None]
         self.wheels_data = None
         self.wheels_data_lidar = None
-        self.trace = 0
+        self.lidar_cond = thr.Condition()  # notified on every new scan
+        self.lidar_seq = 0  # number of scans received
 
         # for position correction
-        self.wheels_old = None
-        self.calculation_pos = False
-        self.calculated_pos = [0, 0, 0]
+        self.pose_estimator = PoseEstimator()  # wheel odometry, stamped with time.perf_counter()
+        self.odometry_filter = OdometryFilter()  # fuses .odom# with wheel odometry
+        self.fused_in_map_frame = False  # fused pose was moved to the wheel odometry (map) frame
         self.calculated_pos_lidar = [0, 0, 0]
 
+        self.recorder = SessionRecorder(record) if record else None
+        self.replayed_commands = []  # commands sent in replayed session
+
+        self.occupancy_grid = None
+        if mapping:
+            self.occupancy_grid = OccupancyGrid(**(mapping if isinstance(mapping, dict) else {}))
+            self.mapping_thr = thr.Thread(target=self.build_map, args=())
+            self.mapping_thr.start()
+
+        self.scan_matcher = None
+        if scan_matching:
+            self.scan_matcher = ScanMatcher(**(scan_matching if isinstance(scan_matching, dict) else {}))
+            self.scan_matching_thr = thr.Thread(target=self.correct_pose, args=())
+            self.scan_matching_thr.start()
+
+        self.safety_stop = None
+        if safety_stop and not advanced:
+            self.safety_stop = SafetyStop(**(safety_stop if isinstance(safety_stop, dict) else {}))
+
+        self.localizer = None
+        if localize:
+            if isinstance(localize, (list, tuple)):
+                self.init_localization(*localize)
+            else:
+                self.init_localization(localize)
+
+        if replay:
+            self.connected = False
+            self.replay_thr = thr.Thread(target=self.replay_session, args=replay)
+            self.replay_thr.start()
+            return
         if read_from_log:
             self.connected = False
             self.log_stream_thr = thr.Thread(target=self.stream_from_log, args=read_from_log)
@@ -328,49 +436,46 @@ class KUKA:
 
     # receiving and parsing sensor data
 
-    def post_to_send_data(self, ind, data):
+    def post_to_send_data(self, ind, data, /, arm_ID=0):
         """
         Updates send queue
 
         :param ind: data type: 0-base, 1-arm, 2-grip
         :param data: message contents
+        :param arm_ID: arm of arm and grip data (every arm has its own slots)
         """
-        if self.connected:
-            # self.send_lock.acquire()
-            self.send_queue[ind] = data
-            # self.send_lock.release()
-        else:
-            self.send_queue[ind] = data
+        if ind:
+            ind += 2 * arm_ID
+        self.send_lock.acquire()
+        self.send_queue[ind] = data
+        self.send_lock.release()
 
     def send_data(self):
         """
         Sends all available commands (thread)
         """
 
-        send_ind = 0
+        loop = RateLoop(self.frequency)
         while self.main_thr.is_alive():
-            to_send = None
-            while not to_send and self.main_thr.is_alive():
-                # self.send_lock.acquire()
-                to_send = self.send_queue[send_ind]
-                self.send_queue[send_ind] = None
-                # self.send_lock.release()
-                send_ind += 1
-                self.send_time = time.time_ns()
-                if send_ind == 3:
-                    send_ind = 0
-                time.sleep(1 / self.frequency)
+            loop.sleep()
+            self.send_lock.acquire()
+            to_send = [data for data in self.send_queue if data]
+            self.send_queue = [None] * len(self.send_queue)
+            self.send_lock.release()
+            self.send_time = time.time_ns()
             if self.connected:
                 try:
-                    if to_send:
-                        self.conn.send(to_send)
+                    for data in to_send:
+                        self.conn.send(data)
+                        if self.recorder:
+                            self.recorder.record(OUTBOUND, data)
                 except BrokenPipeError:
                     debug("send_data thread died due to broken pipe")
                     break
 
             else:
-                debug(f"message:{to_send}")
-                pass
+                for data in to_send:
+                    debug(f"message:{data}")
 
         self.threads_number -= 1
         debug(f"send_data thread terminated, {self.threads_number} threads remain")
@@ -381,46 +486,33 @@ class KUKA:
         :return: None
         '''
         wheels = self.wheels
-        if wheels and not self.wheels_old:
-            self.wheels_old = wheels
-        elif not wheels:
-            return
-
-        last_wheel_positions = self.wheels_old
-        wheel_positions = wheels
-
-        wheel_radius_per4 = 0.0475 / 4.0
-
-        geom_factor = (0.47 / 2.0) + (0.3 / 2.0)
-        ang = self.calculated_pos[2]
-
-        delta_positionW1 = (wheel_positions[0] - last_wheel_positions[0])
-        delta_positionW2 = (wheel_positions[1] - last_wheel_positions[1])
-        delta_positionW3 = (wheel_positions[2] - last_wheel_positions[2])
-        delta_positionW4 = (wheel_positions[3] - last_wheel_positions[3])
-        self.trace += abs(delta_positionW1)+abs(delta_positionW2)+abs(delta_positionW3)+abs(delta_positionW4)
-        deltaLongitudinalPos = (
-                                           delta_positionW1 + delta_positionW2 + delta_positionW3 + delta_positionW4) * wheel_radius_per4
-        deltaTransversalPos = (
-                                          -delta_positionW1 + delta_positionW2 + delta_positionW3 - delta_positionW4) * wheel_radius_per4
-        ang -= (-delta_positionW1 + delta_positionW2 - delta_positionW3 + delta_positionW4) * (
-                    wheel_radius_per4 / geom_factor)
+        if wheels:
+            self.pose_estimator.update(time.perf_counter(), wheels)
 
-        ang = (abs(ang + 2 * math.pi)) % (2 * math.pi)
-
-        self.calculated_pos[0] += deltaLongitudinalPos * math.cos(ang) + deltaTransversalPos * math.sin(ang)
-        self.calculated_pos[1] += deltaLongitudinalPos * math.sin(ang) - deltaTransversalPos * math.cos(ang)
-        self.calculated_pos[2] = ang
+    @property
+    def calculated_pos(self):
+        """
+        :return: [x, y, ang] calculated from wheel positions
+        """
+        return self.pose_estimator.pose
 
-        self.wheels_old = wheels
+    @property
+    def trace(self):
+        """
+        :return: sum of absolute wheel transitions
+        """
+        return self.pose_estimator.trace
 
-    def _parse_data(self, data):
+    def _parse_data(self, data, stamp=None):
         """
         Parses all received data and write values to variables\n
-        keys available: ".laser#", ".odom#", ".manip#"
+        keys available: ".laser#", ".odom#", ".manip#", ".wheels#"
 
         :param data: received data
+        :param stamp: time.perf_counter() time of receiving
         """
+        if stamp is None:
+            stamp = time.perf_counter()
         write_lidar = None
         write_increment = None
         write_arm1 = None
@@ -466,8 +558,10 @@ class KUKA:
             self.data_lock.acquire()
             if write_lidar:
                 self.lidar_data = write_lidar
+                if self.safety_stop:
+                    self.safety_stop.set_scan(write_lidar, stamp)
                 self.increment_data_lidar = self.increment_data
-                self.calculated_pos_lidar = self.calculated_pos[:]
+                self.calculated_pos_lidar = self.pose_estimator.pose_at(stamp)
                 self.wheels_data_lidar = self.wheels_data
             if write_increment:
                 self.increment_data = write_increment
@@ -491,10 +585,203 @@ class KUKA:
                 m5 = write_arm2[4] - 166
                 self.corr_arm_pos[1] = [m1, m2, m3, m4, m5]
             self.data_lock.release()
-            if wheels and not self.calculation_pos:
-                self.calculation_pos = True
-                self.wheelPositionsToCartesianPosition()
-                self.calculation_pos = False
+            if write_lidar:
+                self._notify_lidar()
+            if write_arm1:
+                self._notify_arm(0, stamp)
+            if write_arm2:
+                self._notify_arm(1, stamp)
+            self._update_pose(stamp, write_increment, wheels)
+
+    def _notify_lidar(self):
+        """
+        Wakes up threads waiting for new lidar scan
+        """
+        with self.lidar_cond:
+            self.lidar_seq += 1
+            self.lidar_cond.notify_all()
+
+    def wait_lidar(self, seq, timeout=None):
+        """
+        Waits for lidar scan newer than seq
+        :param seq: number of the last processed scan
+        :param timeout: max waiting time (s)
+        :return: number of the last received scan (equal to seq on timeout)
+        """
+        with self.lidar_cond:
+            self.lidar_cond.wait_for(lambda: self.lidar_seq != seq, timeout)
+            return self.lidar_seq
+
+    def _notify_arm(self, arm_ID, stamp):
+        """
+        Updates arrival of every joint at the arm target and wakes up threads waiting for the arm
+        :param arm_ID: arm with new feedback
+        :param stamp: time.perf_counter() time of receiving
+        """
+        with self.arm_cond:
+            target = self.arm_target[arm_ID]
+            if target is not None and not self.arm_arrived[arm_ID].is_set():
+                times = self.arm_arrival_times[arm_ID]
+                for i, (pos, goal) in enumerate(zip(self.corr_arm_pos[arm_ID], target)):
+                    if times[i] is None and abs(pos - goal) <= self.arm_tolerance:
+                        times[i] = stamp - self.arm_target_time[arm_ID]
+                if None not in times:
+                    self.arm_arrived[arm_ID].set()
+                    debug(f"arm {arm_ID} arrived in {max(times):.2f} s, joints: "
+                          + ", ".join(f"{t:.2f}" for t in times))
+            self.arm_cond.notify_all()
+
+    def _set_arm_target(self, arm_ID, target):
+        """
+        Starts arrival detection of a new arm target
+        :param arm_ID: arm
+        :param target: joint 1 - 5 angles or None for velocity commands (arrival is not detected)
+        """
+        with self.arm_cond:
+            self.arm_target[arm_ID] = target
+            self.arm_target_time[arm_ID] = time.perf_counter()
+            self.arm_arrival_times[arm_ID] = [None] * 5
+            self.arm_arrived[arm_ID].clear()
+            self.arm_cond.notify_all()
+
+    def arm_reached(self, arm_ID=0, tolerance=None):
+        """
+        :param arm_ID: arm
+        :param tolerance: max joint error (degrees), arm_tolerance by default
+        :return: True if arm feedback is within tolerance of the last sent target
+        """
+        tolerance = self.arm_tolerance if tolerance is None else tolerance
+        target = self.arm_target[arm_ID]
+        pos = self.corr_arm_pos[arm_ID]
+        if target is None or pos is None:
+            return False
+        return all(abs(p - goal) <= tolerance for p, goal in zip(pos, target))
+
+    def wait_arm_reached(self, tolerance=None, timeout=None, arm_ID=0):
+        """
+        Waits until the arm arrives at the last sent /arm: target (by .manip# feedback)
+        :param tolerance: max joint error (degrees), arm_tolerance by default
+        :param timeout: max waiting time (s)
+        :param arm_ID: arm
+        :return: True if arrived, False on timeout (or if there is no target or feedback)
+        """
+        with self.arm_cond:
+            return self.arm_cond.wait_for(lambda: self.arm_reached(arm_ID, tolerance), timeout)
+
+    def build_map(self):
+        """
+        Integrates every new lidar scan into occupancy_grid (thread)
+        """
+        self.threads_number += 1
+        seq = 0
+        while self.main_thr.is_alive():
+            new_seq = self.wait_lidar(seq, timeout=0.5)
+            if new_seq == seq:
+                continue
+            seq = new_seq
+            pose, scan = self.lidar
+            if scan:
+                self.occupancy_grid.update(pose, scan)
+                self._replan_navigation()
+        self.threads_number -= 1
+        debug(f"build_map thread terminated, {self.threads_number} threads remain")
+
+    def _update_pose(self, stamp, odom, wheels):
+        """
+        Feeds odometry and wheel positions to pose estimators
+        :param stamp: time.perf_counter() time of the data
+        :param odom: .odom# values or None
+        :param wheels: wheel positions or None
+        """
+        if odom:
+            self.odometry_filter.update_odom(stamp, odom)
+        if wheels and self.pose_estimator.update(stamp, wheels):
+            wheels_stamp, *pose = self.pose_estimator.stamped_pose
+            self.odometry_filter.update_wheels(wheels_stamp, pose)
+
+    def _correct_pose(self, pose_from, pose_to):
+        """
+        Moves wheel odometry and fused pose to the corrected frame
+        :param pose_from: [x, y, ang] as estimated by wheel odometry
+        :param pose_to: corrected [x, y, ang]
+        """
+        self.pose_estimator.correct(pose_from, pose_to)
+        self._align_fused_pose()
+
+    def _align_fused_pose(self):
+        """
+        Moves fused pose to wheel odometry pose, the frame maps and corrections are in
+        """
+        # wheel steps are measured from the moved pose anew
+        self.odometry_filter.reset(self.pose_estimator.pose)
+        self.odometry_filter.reset_wheels()
+        self.fused_in_map_frame = True
+
+    def correct_pose(self):
+        """
+        Matches every new lidar scan and moves wheel odometry pose by the found correction (thread)
+        """
+        self.threads_number += 1
+        seq = 0
+        while self.main_thr.is_alive():
+            new_seq = self.wait_lidar(seq, timeout=0.5)
+            if new_seq == seq:
+                continue
+            seq = new_seq
+            pose, scan = self.lidar
+            if not scan:
+                continue
+            corrected = self.scan_matcher.update(pose, scan)
+            if corrected:
+                self._correct_pose(pose, corrected)
+                self.data_lock.acquire()
+                if self.lidar_data is scan:
+                    self.calculated_pos_lidar = corrected
+                self.data_lock.release()
+        self.threads_number -= 1
+        debug(f"correct_pose thread terminated, {self.threads_number} threads remain")
+
+    def init_localization(self, grid, pose=None, **kwargs):
+        """
+        Starts particle filter localization thread
+        :param grid: OccupancyGrid or path to map saved with OccupancyGrid.save
+        :param pose: approximate initial [x, y, ang] on the map, None - anywhere on the map
+        :param kwargs: MonteCarloLocalization parameters
+        """
+        if isinstance(grid, str):
+            grid = OccupancyGrid.load(grid)
+        self.localizer = MonteCarloLocalization(grid, **kwargs)
+        self.localizer.initialize(pose)
+        if pose is not None:
+            self._correct_pose(self.pose_estimator.pose, pose)
+        self.localization_thr = thr.Thread(target=self.localize_pose, args=())
+        self.localization_thr.start()
+
+    def localize_pose(self):
+        """
+        Updates particle filter with every new lidar scan and moves wheel odometry pose
+        to the estimate when particles converged (thread)
+        """
+        self.threads_number += 1
+        seq = 0
+        while self.main_thr.is_alive():
+            new_seq = self.wait_lidar(seq, timeout=0.5)
+            if new_seq == seq:
+                continue
+            seq = new_seq
+            pose, scan = self.lidar
+            if not scan:
+                continue
+            estimate = self.localizer.update(pose, scan)
+            if self.localizer.converged:
+                self._correct_pose(pose, estimate)
+                self.localizer.rebase(estimate)
+                self.data_lock.acquire()
+                if self.lidar_data is scan:
+                    self.calculated_pos_lidar = estimate
+                self.data_lock.release()
+        self.threads_number -= 1
+        debug(f"localize_pose thread terminated, {self.threads_number} threads remain")
 
     def _receive_data(self):
         """
@@ -521,71 +808,163 @@ class KUKA:
                 data_buff_len += 1
             if data_buff_len > 0 and self.data_buff[-1] == 13:
                 self.conn.recv(1)
+                stamp = time.perf_counter()
+                if self.recorder:
+                    self.recorder.record(INBOUND, self.data_buff[:-1], stamp)
 
                 try:
                     str_data = str(self.data_buff[:-1], encoding='utf-8')
-                    self.data_parser_tht = thr.Thread(target=self._parse_data, args=(str_data,))
+                    self.data_parser_tht = thr.Thread(target=self._parse_data, args=(str_data, stamp))
                     self.data_parser_tht.start()
                 except:
                     pass
                 self.data_buff = b''
                 data_buff_len = 0
+        if self.recorder:
+            self.recorder.close()
         self.threads_number -= 1
         debug(f"_receive_data thread terminated, {self.threads_number} threads remain")
 
-    def logger(self, path, freq):
+    def logger(self, path, freq, fmt="zlib"):
         '''
         Logs odometry and lidar data to path with set frequency
         :param path: name and path to log file
         :param freq: logging frequency
+        :param fmt: "zlib"/"lzma" (chunked compressed records), "binary" (fixed width records, lidar in mm)
+            or "text" (odometry; lidar lines)
         :return: None
         '''
         self.threads_number += 1
-        while not (self.increment_data_lidar and self.lidar):
+        while not (self.increment_data_lidar and self.lidar[-1]):
             time.sleep(0.2)
-        debug(f"writing log to {path} with 1/{freq}Hz")
-        self.log_file = open(path, "a")
+        debug(f"writing {fmt} log to {path} with 1/{freq}Hz")
+        self.log_writer = open_log_writer(path, fmt)
         while self.main_thr.is_alive():
-            self.log_file.write(", ".join(map(str, self.increment_data_lidar)) + "; " + ", ".join(map(str, self.lidar[-1])) + "\n")
+            self.data_lock.acquire()
+            odom = self.increment_data_lidar
+            wheels = self.wheels_data_lidar
+            lidar = self.lidar_data
+            self.data_lock.release()
+            self.log_writer.write(time.time(), odom, wheels, lidar)
             time.sleep(1 / freq)
-        self.log_file.close()
+        self.log_writer.close()
         self.threads_number -= 1
         debug(f"logger thread terminated, {self.threads_number} threads remain")
 
-    def stream_from_log(self, path, freq):
+    def stream_from_log(self, path, freq=1, speed=1.0, start=0, start_time=None, batch=False):
         '''
-        streams odometry and lidar data from path with set frequency
+        streams odometry and lidar data from path\n
+        binary logs are memory-mapped and paced by their timestamps, text logs are read lazily with set frequency
         :param path: name and path to log file
-        :param freq: logging frequency
+        :param freq: logging frequency (used for text logs which have no timestamps)
+        :param speed: playback speed multiplier, None or 0 streams as fast as possible
+        :param start: index of the first streamed record
+        :param start_time: if set, streaming starts from this time (seconds from log start)
+        :param batch: processes the whole binary log in blocks with batch wheel odometry (ignores speed and start),
+            only the last record of every block reaches lidar consumers and odometry filter
         :return: None
         '''
         self.threads_number += 1
-        debug(f"streaming log from {path} with 1/{freq}Hz")
-        log_file = open(path, "r")
-        log_data = []
-        for i in log_file:
-            sp_log_data = i.split(';')
-            if sp_log_data[-1] == '':
+        debug(f"streaming log from {path} with x{speed} speed")
+        self.log_reader = open_log(path, freq=freq)
+        if batch:
+            self._stream_log_blocks()
+            records = ()
+        else:
+            records = play(self.log_reader, start=start, start_time=start_time, speed=speed)
+        for stamp, odom, wheels, lidar in records:
+            if not self.main_thr.is_alive():
                 break
-            odom = sp_log_data[0].split(',')
-            lidar = sp_log_data[1].split(',')
-            odom = list(map(float, odom))
-            lidar = list(map(float, lidar))
-            log_data.append([odom, lidar])
-        self.log_data = log_data[:]
-        i = 0
-        while self.main_thr.is_alive() and i < len(self.log_data):
             self.data_lock.acquire()
-            self.wheels_data, self.lidar_data = self.log_data[i]
-            self.wheels_data_lidar = self.wheels_data
-            i += 1
+            if odom:
+                self.increment_data = odom
+                self.increment_data_lidar = odom
+            if wheels:
+                self.wheels_data = wheels
+                self.wheels_data_lidar = wheels
             self.data_lock.release()
-            self.wheelPositionsToCartesianPosition()
-            time.sleep(1 / freq)
-        log_file.close()
+            self._update_pose(stamp, odom, wheels)
+            self.data_lock.acquire()
+            self.lidar_data = lidar
+            if lidar and self.safety_stop:
+                # replayed scan is received now, log stamps are in another clock
+                self.safety_stop.set_scan(lidar)
+            self.calculated_pos_lidar = self.pose_estimator.pose_at(stamp)
+            self.data_lock.release()
+            self._notify_lidar()
+        self.log_reader.close()
         self.threads_number -= 1
         debug(f"logger thread terminated, {self.threads_number} threads remain")
 
+    def _stream_log_blocks(self):
+        '''
+        Batch log streaming: wheel odometry of every block is integrated in one batch,
+        the state, odometry filter and lidar consumers are updated with the last record of the block only
+        :return: None
+        '''
+        for block in self.log_reader.blocks():
+            if not self.main_thr.is_alive():
+                break
+            wheels = np.asarray(block["wheels"])
+            valid = ~np.isnan(wheels).any(axis=1)
+            self.pose_estimator.update_batch(np.asarray(block["time"])[valid], wheels[valid])
+            stamp, odom, last_wheels, lidar = unpack_record(block[-1], self.log_reader.lidar_scale)
+            self.data_lock.acquire()
+            if last_wheels:
+                self.wheels_data = last_wheels
+                self.wheels_data_lidar = last_wheels
+            if odom:
+                self.increment_data = odom
+                self.increment_data_lidar = odom
+            self.lidar_data = lidar
+            if lidar and self.safety_stop:
+                self.safety_stop.set_scan(lidar)
+            self.calculated_pos_lidar = self.pose_estimator.pose
+            self.data_lock.release()
+            if odom:
+                self.odometry_filter.update_odom(stamp, odom)
+            if valid.any():
+                wheels_stamp, *pose = self.pose_estimator.stamped_pose
+                self.odometry_filter.update_wheels(wheels_stamp, pose)
+            self._notify_lidar()
+
+    def replay_session(self, path, speed=1.0):
+        '''
+        Feeds recorded telemetry lines through _parse_data in recorded order\n
+        recorded commands are collected to replayed_commands
+        :param path: name and path to session recording
+        :param speed: playback speed multiplier, None or 0 replays as fast as possible
+        :return: None
+        '''
+        self.threads_number += 1
+        debug(f"replaying session from {path} with x{speed} speed")
+        reader = SessionReader(path)
+        t0 = None
+        wall0 = None
+        for stamp, direction, data in reader.read():
+            if not self.main_thr.is_alive():
+                break
+            if direction == SESSION_START:
+                # monotonic clock of appended session is unrelated to the previous one
+                t0 = None
+                continue
+            if speed:
+                if t0 is None:
+                    t0, wall0 = stamp, time.perf_counter()
+                delay = wall0 + (stamp - t0) / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            if direction == INBOUND:
+                try:
+                    self._parse_data(str(data, encoding='utf-8'), stamp)
+                except UnicodeDecodeError:
+                    pass
+            elif direction == OUTBOUND:
+                self.replayed_commands.append((stamp, data))
+        reader.close()
+        self.threads_number -= 1
+        debug(f"replay_session thread terminated, {self.threads_number} threads remain")
+
     # get functions
 
     @property
@@ -620,14 +999,20 @@ class KUKA:
     @property
     def increment_by_wheels(self):
         """
-        Acquires variable data lock and reads increment values
+        Reads last pose published by wheel odometry estimator (no locking needed)
 
         :return: increment values
         """
-        self.data_lock.acquire()
-        out = self.calculated_pos[:]
-        self.data_lock.release()
-        return out
+        return self.pose_estimator.pose
+
+    @property
+    def fused_increment(self):
+        """
+        Reads pose fused from .odom# and wheel odometry (no locking needed)
+
+        :return: [x, y, ang]
+        """
+        return self.odometry_filter.pose
 
     @property
     def wheels(self):
@@ -712,66 +1097,200 @@ class KUKA:
         f = range_cut(-1, 1, f)
         s = range_cut(-1, 1, s)
         r = range_cut(-1, 1, r)
+        if self.safety_stop:
+            f, s, r = self.safety_stop.check(f, s, r)
         self.post_to_send_data(0, bytes(f'/base:{f};{s};{r}^^^', encoding='utf-8'))
         self.move_speed = (f, s, r)
 
     # go to set coordinates
-    def go_to(self, x, y, ang=0, /, prec=0.005, k=1, initial_speed=None):
+    def go_to(self, x, y, ang=0, /, prec=0.005, k=None, initial_speed=None):
         """
-        Sends robot to given coordinates
+        Sends robot to given coordinates (replaces current path)
         :param x: x position in relative coordinates
         :param y: y position in relative coordinates
         :param ang: angle from x axes
+        :param prec: position (m) and angle (rad) precision
+        :param k: proportional coefficient of the final approach (move_to_target_k by default)
+        :param initial_speed: max speed (move_to_target_max_speed by default)
+        :return: threading.Event set when the target is reached or the move is cancelled
         """
-        if not initial_speed:
-            initial_speed = self.move_to_target_max_speed
-        if self.main_thr.is_alive():
-            if self.going_to_target_pos:
-                self.body_target_pos_lock.acquire()
-                self.body_target_pos = [x, y, ang]
-                self.body_target_pos_lock.release()
-            else:
-                self.body_target_pos_lock = thr.Lock()
-                self.going_to_target_pos = True
-                self.body_target_pos = [x, y, ang]
-                self.go_to_tr = thr.Thread(target=self.move_base_to_pos, args=([prec, k, initial_speed]))
-                self.threads_number += 1
-                self.go_to_tr.start()
+        return self.follow_path([[x, y, ang]], prec=prec, k=k, max_speed=initial_speed)
 
-    def move_base_to_pos(self, prec=0.005, k=None, initial_speed=0.05):
+    def follow_path(self, poses, /, blend_radius=0.1, prec=0.005, k=None, max_speed=None,
+                    on_done=None, on_waypoint=None):
         """
-        Moving to point thread
+        Sends robot along waypoints (replaces current path), intermediate waypoints are passed without stopping
+        :param poses: list of [x, y, ang] or [x, y] (keeps the previous angle)
+        :param blend_radius: distance (m) to intermediate waypoint at which robot turns to the next one
+        :param prec: position (m) and angle (rad) precision of the last waypoint
+        :param k: proportional coefficient of the final approach (move_to_target_k by default)
+        :param max_speed: max speed (move_to_target_max_speed by default)
+        :param on_done: called as on_done(reached) from the control thread when path is finished or cancelled
+        :param on_waypoint: called as on_waypoint(index) from the control thread when waypoint is passed
+        :return: threading.Event set when the path is finished or cancelled
+        """
+        path = BasePath(poses, start=self.fused_increment, blend_radius=blend_radius, prec=prec,
+                        max_speed=max_speed or self.move_to_target_max_speed, max_acc=self.move_to_target_max_acc,
+                        k=k or self.move_to_target_k, on_done=on_done, on_waypoint=on_waypoint)
+        if not self.main_thr.is_alive():
+            path.finish(False)
+            return path.done
+        self.body_target_pos_lock.acquire()
+        old_path = self.base_path
+        self.base_path = path
+        self.body_target_pos = path.target
+        self.going_to_target_pos = True
+        self.body_target_pos_lock.release()
+        if old_path:
+            old_path.finish(False)
+        self.base_path_posted.set()
+        if not (self.go_to_tr and self.go_to_tr.is_alive()):
+            self.go_to_tr = thr.Thread(target=self.move_base_to_pos, args=())
+            self.threads_number += 1
+            self.go_to_tr.start()
+        return path.done
+
+    def navigate_to(self, x, y, ang=0, /, prec=0.005, max_speed=None):
+        """
+        Plans path around obstacles of the map (occupancy_grid or localization map) and sends robot along it,
+        the path is replanned when new scans block it. Without map works as go_to
+        :param x: x position in relative coordinates
+        :param y: y position in relative coordinates
+        :param ang: angle from x axes
+        :param prec: position (m) and angle (rad) precision
+        :param max_speed: max speed (move_to_target_max_speed by default)
+        :return: threading.Event set when the target is reached or the move is cancelled, None if target is unreachable
+        """
+        grid = self.occupancy_grid or (self.localizer.grid if self.localizer else None)
+        if grid is None:
+            return self.go_to(x, y, ang, prec=prec, initial_speed=max_speed)
+        if self.path_planner is None or self.path_planner.grid is not grid:
+            self.path_planner = GridPlanner(grid)
+        if not self.fused_in_map_frame:
+            # maps are built from wheel odometry poses, the path is planned and followed in their frame
+            self._align_fused_pose()
+        path = self.path_planner.plan(self.fused_increment, [x, y])
+        if path is None:
+            debug(f"navigate_to: no path to {x:.2f}, {y:.2f}")
+            return None
+        self.navigation_done = self.follow_path(path[:-1] + [[x, y, ang]], prec=prec, max_speed=max_speed)
+        return self.navigation_done
+
+    def _replan_navigation(self):
+        """
+        Replans path of navigate_to if the map changed and blocked it
+        """
+        path = self.base_path
+        if path is None or path.done is not self.navigation_done:
+            return
+        pose = self.fused_increment
+        poses = self.path_planner.replan(pose)
+        if poses is None:
+            if self.path_planner.path is None:
+                debug("navigate_to: target became unreachable")
+                path.finish(False)
+            return
+        self.body_target_pos_lock.acquire()
+        if self.base_path is path:
+            self.base_path = path.replanned(poses[:-1] + [path.poses[-1]], start=pose)
+            self.body_target_pos = self.base_path.target
+        self.body_target_pos_lock.release()
+
+    def cancel_path(self):
         """
-        if not k:
-            k = self.move_to_target_k
-        while self.main_thr.is_alive() and self.going_to_target_pos:
+        Stops current go_to or follow_path
+        """
+        self.going_to_target_pos = False
+        self.base_path_posted.set()
+
+    @property
+    def path_progress(self):
+        """
+        :return: (index of current waypoint, number of waypoints, remaining path length) or None if no path
+        """
+        path = self.base_path
+        if path is None:
+            return None
+        return path.index, len(path.poses), path.remaining(self.fused_increment)
+
+    def move_base_to_pos(self):
+        """
+        Base control thread, executes paths posted by go_to and follow_path\n
+        trapezoidal velocity profile with acceleration limits, runs at self.frequency with fixed deadlines
+        """
+        controller = None
+        loop = None
+        dt = 1 / self.frequency
+        while self.main_thr.is_alive():
             self.body_target_pos_lock.acquire()
-            x, y, ang = self.body_target_pos
+            path = self.base_path
+            dropped = path is not None and (not self.going_to_target_pos or path.done.is_set())
+            if dropped:
+                self.base_path = None
+            if self.base_path is None:
+                # cleared under the lock, so a path posted right after is not taken for cancelled
+                self.going_to_target_pos = False
             self.body_target_pos_lock.release()
-            inc = self.increment
-            loc_x = x - inc[0]
-            loc_y = y - inc[1]
-            rob_ang = inc[2]
-            dist = math.sqrt(loc_x ** 2 + loc_y ** 2)
-            speed = min(initial_speed, dist * k)
-
-            targ_ang = math.atan2(loc_y, loc_x)
-            loc_ang = targ_ang - rob_ang
-            if dist < prec and (ang - rob_ang) < prec:
-                break
-            fov_speed = speed * math.cos(loc_ang)
-            side_speed = -speed * math.sin(loc_ang)
-            total_speed = math.sqrt(fov_speed ** 2 + side_speed ** 2)
-            ang_speed = -(ang - rob_ang) / (dist / total_speed)
-            self.move_base(fov_speed, side_speed, ang_speed)
-            time.sleep(1 / self.frequency)
-        self.move_base(0, 0, 0)
-        time.sleep(0.01)
-        self.move_base(0, 0, 0)
+            if dropped:
+                if loop:
+                    self._stop_base_path(loop)
+                    loop = controller = None
+                path.finish(False)
+                continue
+
+            if path is None:
+                if loop:
+                    self._stop_base_path(loop)
+                    loop = controller = None
+                self.base_path_posted.wait(0.5)
+                self.base_path_posted.clear()
+                continue
+            if loop is None:
+                loop = RateLoop(self.frequency)
+                dt = loop.period
+                controller = TrapezoidalController(max_ang_speed=self.move_to_target_max_ang_speed,
+                                                   max_ang_acc=self.move_to_target_max_ang_acc)
+            controller.max_speed, controller.max_acc, controller.k = path.max_speed, path.max_acc, path.k
+
+            inc = self.fused_increment
+            target = path.target
+            dist = math.hypot(target[0] - inc[0], target[1] - inc[1])
+            if path.last:
+                if dist < path.prec and abs(wrap_angle(target[2] - inc[2])) < path.prec:
+                    self._stop_base_path(loop)
+                    loop = controller = None
+                    path.finish(True)
+                    continue
+            elif dist < path.blend_radius:
+                path.next_waypoint()
+                self.body_target_pos_lock.acquire()
+                if self.base_path is path:
+                    self.body_target_pos = path.target
+                self.body_target_pos_lock.release()
+                continue
+            velocity = controller.step(inc, target, dt, end_speed=path.end_speeds[path.index])
+            self.move_base(*world_to_base_command(velocity, inc[2]))
+            dt = loop.sleep()
+        if loop:
+            self._stop_base_path(loop)
+        if self.base_path:
+            self.base_path.finish(False)
         self.going_to_target_pos = False
         self.threads_number -= 1
         debug(f"move_base_to_pos thread terminated, {self.threads_number} threads remain")
 
+    def _stop_base_path(self, loop):
+        """
+        Stops base after path and stores loop timing
+        :param loop: RateLoop of the path
+        """
+        self.base_loop_stats = loop.stats
+        debug(f"move_base_to_pos loop: {loop.iterations} iterations, "
+              f"max jitter {loop.stats['jitter_max'] * 1000:.1f} ms, {loop.overruns} overruns")
+        self.move_base(0, 0, 0)
+        time.sleep(0.01)
+        self.move_base(0, 0, 0)
+
     # move arm forward or inverse kinetic
     def move_arm(self, *args, **kwargs):
      
@@ -782,47 +1301,77 @@ class KUKA:
         by keywords:
             m1, m2, m3, m4, m5 - for joints\n
             grip - (0 - 2) for grip\n
-            target - ((x, y), ang) to set arm position in cylindrical coordinates (ang - angle from last joint to horizon)\n
+            arm_ID - arm (0 by default)\n
+            target - ((x, y), ang) to set arm position in cylindrical coordinates (ang - angle from last joint to horizon)
+            or ((x, y, z), ang) in cartesian coordinates\n
+            force - sends the command even if it is within arm_deadband of the last sent one
+            (or grip didn't change)\n
         (all joint parameters are in degrees from upright position)
         """
         grip = False
+        force = kwargs.get("force", False)
 
-        if list(kwargs.keys()).count("arm_ID") > 0:
-            self.arm_ID = kwargs["arm_ID"]
-        else:
-            self.arm_ID = 0
+        arm_ID = kwargs.get("arm_ID", 0)
+        previous = self.arm_pos[arm_ID][:]
         if args:
-            self.arm_pos[self.arm_ID][:len(args)] = args
+            self.arm_pos[arm_ID][:len(args)] = args
             if len(args) == 6:
                 grip = True
         if list(kwargs.keys()).count("m1") > 0:
-            self.arm_pos[self.arm_ID][0] = kwargs["m1"]
+            self.arm_pos[arm_ID][0] = kwargs["m1"]
         if list(kwargs.keys()).count("m2") > 0:
-            self.arm_pos[self.arm_ID][1] = kwargs["m2"]
+            self.arm_pos[arm_ID][1] = kwargs["m2"]
         if list(kwargs.keys()).count("m3") > 0:
-            self.arm_pos[self.arm_ID][2] = kwargs["m3"]
+            self.arm_pos[arm_ID][2] = kwargs["m3"]
         if list(kwargs.keys()).count("m4") > 0:
-            self.arm_pos[self.arm_ID][3] = kwargs["m4"]
+            self.arm_pos[arm_ID][3] = kwargs["m4"]
         if list(kwargs.keys()).count("m5") > 0:
-            self.arm_pos[self.arm_ID][4] = kwargs["m5"]
+            self.arm_pos[arm_ID][4] = kwargs["m5"]
         if list(kwargs.keys()).count("grip") > 0:
-            self.arm_pos[self.arm_ID][5] = kwargs["grip"]
-            self.post_to_send_data(2, bytes(f'/grip:{self.arm_ID};{self.arm_pos[self.arm_ID][5]}^^^', encoding='utf-8'))
-        if grip:
-            self.arm_pos[self.arm_ID][5] = args[-1]
-            self.post_to_send_data(2, bytes(f'/grip:{self.arm_ID};{self.arm_pos[self.arm_ID][5]}^^^', encoding='utf-8'))
-
+            self.arm_pos[arm_ID][5] = kwargs["grip"]
+            grip = True
         if list(kwargs.keys()).count("target") > 0:
             if len(kwargs["target"][0]) == 2:
-                m2, m3, m4, _ = self.solve_arm(kwargs["target"])
-                self.arm_pos[self.arm_ID][1:4] = m2, m3, m4
-
-        m1 = range_cut(11, 302, -self.arm_pos[self.arm_ID][0] + 168)
-        m2 = range_cut(3, 150, -self.arm_pos[self.arm_ID][1] + 66)
-        m3 = range_cut(-260, -15, -self.arm_pos[self.arm_ID][2] - 150)
-        m4 = range_cut(10, 195, -self.arm_pos[self.arm_ID][3] + 105)
-        m5 = range_cut(21, 292, self.arm_pos[self.arm_ID][4] + 166)
-        self.post_to_send_data(1, bytes(f'/arm:{self.arm_ID};{m1};{m2};{m3};{m4};{m5}^^^', encoding='utf-8'))
+                m2, m3, m4, _ = self.solve_arm(kwargs["target"], arm_ID=arm_ID)
+                self.arm_pos[arm_ID][1:4] = m2, m3, m4
+            elif len(kwargs["target"][0]) == 3:
+                m1, m2, m3, m4, _ = self.solve_arm(kwargs["target"], cartesian=True, arm_ID=arm_ID)
+                self.arm_pos[arm_ID][0:4] = m1, m2, m3, m4
+
+        m1 = range_cut(11, 302, -self.arm_pos[arm_ID][0] + 168)
+        m2 = range_cut(3, 150, -self.arm_pos[arm_ID][1] + 66)
+        m3 = range_cut(-260, -15, -self.arm_pos[arm_ID][2] - 150)
+        m4 = range_cut(10, 195, -self.arm_pos[arm_ID][3] + 105)
+        m5 = range_cut(21, 292, self.arm_pos[arm_ID][4] + 166)
+        target = [168 - m1, 66 - m2, -150 - m3, 105 - m4, m5 - 166]
+        if self.arm_collision and not self.arm_collision.free(*target[:4]):
+            self.suppressed_commands["collision"] += 1
+            if not self.arm_colliding[arm_ID]:
+                # reported once per colliding streak, teleoperation repeats the pose at full rate
+                self.arm_colliding[arm_ID] = True
+                debug(f"arm {arm_ID} command {target} collides, not sent")
+            # arm and grip stay where they were
+            self.arm_pos[arm_ID][:] = previous
+            return
+        self.arm_colliding[arm_ID] = False
+        if grip:
+            # grip is sent only on change
+            if force or self.arm_pos[arm_ID][5] != self.sent_grip[arm_ID]:
+                self.sent_grip[arm_ID] = self.arm_pos[arm_ID][5]
+                self.post_to_send_data(2, bytes(f'/grip:{arm_ID};{self.arm_pos[arm_ID][5]}^^^',
+                                                encoding='utf-8'), arm_ID=arm_ID)
+            else:
+                self.suppressed_commands["grip"] += 1
+        # commands within deadband of the last sent one are dropped, small changes add up until they exceed it
+        sent = self.sent_arm_cmd[arm_ID]
+        if not force and sent and all(abs(new - old) < band for new, old, band in
+                                      zip((m1, m2, m3, m4, m5), sent, self.arm_deadband)):
+            self.suppressed_commands["arm"] += 1
+            return
+        self.sent_arm_cmd[arm_ID] = (m1, m2, m3, m4, m5)
+        self._set_arm_target(arm_ID, target)
+        self.post_to_send_data(1, bytes(f'/arm:{arm_ID};{m1};{m2};{m3};{m4};{m5}^^^', encoding='utf-8'),
+                                arm_ID=arm_ID)
 
     def set_arm_vel(self, *args, **kwargs):
         """
@@ -831,95 +1380,191 @@ class KUKA:
         array of values: (joint 1, joint 2, joint 3, joint 4, joint 5)\n
         by keywords:
             m1, m2, m3, m4, m5 - for joints\n
+            arm_ID - arm (0 by default)\n
         (all joint parameters are in degrees/second)
         """
 
-        if list(kwargs.keys()).count("arm_ID") > 0:
-            self.arm_ID = kwargs["arm_ID"]
-
+        arm_ID = kwargs.get("arm_ID", 0)
         if args:
-            self.arm_vel[self.arm_ID][:len(args)] = args
-
-        else:
-            self.arm_ID = 0
+            self.arm_vel[arm_ID][:len(args)] = args
         if list(kwargs.keys()).count("m1") > 0:
-            self.arm_vel[self.arm_ID][0] = kwargs["m1"]
+            self.arm_vel[arm_ID][0] = kwargs["m1"]
         if list(kwargs.keys()).count("m2") > 0:
-            self.arm_vel[self.arm_ID][1] = kwargs["m2"]
+            self.arm_vel[arm_ID][1] = kwargs["m2"]
         if list(kwargs.keys()).count("m3") > 0:
-            self.arm_vel[self.arm_ID][2] = kwargs["m3"]
+            self.arm_vel[arm_ID][2] = kwargs["m3"]
         if list(kwargs.keys()).count("m4") > 0:
-            self.arm_vel[self.arm_ID][3] = kwargs["m4"]
+            self.arm_vel[arm_ID][3] = kwargs["m4"]
         if list(kwargs.keys()).count("m5") > 0:
-            self.arm_vel[self.arm_ID][4] = kwargs["m5"]
+            self.arm_vel[arm_ID][4] = kwargs["m5"]
+
+        m1 = range_cut(-90, 90, self.arm_vel[arm_ID][0])
+        m2 = range_cut(-90, 90, self.arm_vel[arm_ID][1])
+        m3 = range_cut(-90, 90, self.arm_vel[arm_ID][2])
+        m4 = range_cut(-90, 90, self.arm_vel[arm_ID][3])
+        m5 = range_cut(-90, 90, self.arm_vel[arm_ID][4])
+        # position after velocity motion is unknown, the next /arm: command is always sent
+        self.sent_arm_cmd[arm_ID] = None
+        self._set_arm_target(arm_ID, None)
+        self.post_to_send_data(1, bytes(f'/arm_vel:{arm_ID};{m1};{m2};{m3};{m4};{m5}^^^', encoding='utf-8'),
+                                arm_ID=arm_ID)
+
+    def move_arm_trajectory(self, waypoints, /, durations=None, max_vel=MAX_VEL, max_acc=MAX_ACC, arm_ID=0,
+                            velocity=False):
+        """
+        Streams arm along joint waypoints from arm trajectory thread at self.frequency
+        (replaces current trajectory of the arm)
+
+        :param waypoints: list of joint 1 - 5 angles (degrees) or ArmTrajectory, starts from the last sent position
+        :param durations: duration of every segment (s), one value for all segments or None to use limits
+        :param max_vel: speed limit (degrees/s), one value or one per joint
+        :param max_acc: acceleration limit (degrees/s^2), one value or one per joint
+        :param arm_ID: arm
+        :param velocity: streams /arm_vel: speeds instead of /arm: positions, the last waypoint is sent as position
+        :return: concurrent.futures.Future, result is True when the last waypoint is sent, cancel() stops the arm,
+            ValueError exception if trajectory collides (current trajectory is kept)
+        """
+        if isinstance(waypoints, ArmTrajectory):
+            trajectory = waypoints
+        else:
+            trajectory = ArmTrajectory(waypoints, durations=durations, max_vel=max_vel, max_acc=max_acc,
+                                       start=self.arm_pos[arm_ID][:5])
+        future = Future()
+        if self.arm_collision:
+            free, collision_time = self.arm_collision.check_trajectory(trajectory, dt=1 / self.frequency)
+            if not free:
+                self.suppressed_commands["collision"] += 1
+                future.set_exception(ValueError(f"arm trajectory collides at {collision_time:.2f} s"))
+                return future
+        self.arm_trajectories_lock.acquire()
+        old = self.arm_trajectories.get(arm_ID)
+        self.arm_trajectories[arm_ID] = [trajectory, future, velocity, None]
+        self.arm_trajectories_lock.release()
+        if old:
+            old[1].cancel()
+        self.arm_trajectory_posted.set()
+        if not (self.arm_trajectory_tr and self.arm_trajectory_tr.is_alive()):
+            self.arm_trajectory_tr = thr.Thread(target=self.stream_arm_trajectories, args=())
+            self.threads_number += 1
+            self.arm_trajectory_tr.start()
+        return future
+
+    def arm_trajectory_progress(self, arm_ID=0):
+        """
+        :param arm_ID: arm
+        :return: part of current trajectory duration passed (0 - 1) or None if the arm has no trajectory
+        """
+        job = self.arm_trajectories.get(arm_ID)
+        return job[0].progress if job else None
+
+    def stream_arm_trajectories(self):
+        """
+        Arm trajectory thread, sends setpoints of trajectories of all arms with fixed rate
+        """
+        loop = None
+        while self.main_thr.is_alive():
+            self.arm_trajectories_lock.acquire()
+            jobs = list(self.arm_trajectories.items())
+            self.arm_trajectories_lock.release()
+            if not jobs:
+                loop = None
+                self.arm_trajectory_posted.wait(0.5)
+                self.arm_trajectory_posted.clear()
+                continue
+            if loop is None:
+                loop = RateLoop(self.frequency)
+            now = time.perf_counter()
+            for arm_ID, job in jobs:
+                trajectory, future, velocity, start = job
+                if start is None:
+                    start = job[3] = now
+                t = now - start
+                if future.cancelled():
+                    if velocity:
+                        self.set_arm_vel(0, 0, 0, 0, 0, arm_ID=arm_ID)
+                    self._drop_arm_trajectory(arm_ID, job)
+                elif t >= trajectory.duration:
+                    self.move_arm(*map(float, trajectory.end), arm_ID=arm_ID, force=True)
+                    trajectory.progress = 1.0
+                    self._drop_arm_trajectory(arm_ID, job)
+                    try:
+                        future.set_result(True)
+                    except InvalidStateError:
+                        # cancelled at the same moment
+                        pass
+                else:
+                    trajectory.progress = t / trajectory.duration
+                    pos, vel = trajectory.sample(t)
+                    if velocity:
+                        # speeds in driver joint directions, the same mapping as in move_arm
+                        self.set_arm_vel(*(sign * float(v) for sign, v in zip(ARM_DRIVER_SIGNS, vel)), arm_ID=arm_ID)
+                    else:
+                        self.move_arm(*map(float, pos), arm_ID=arm_ID)
+            loop.sleep()
+        for trajectory, future, velocity, start in self.arm_trajectories.values():
+            future.cancel()
+        self.threads_number -= 1
+        debug(f"stream_arm_trajectories thread terminated, {self.threads_number} threads remain")
 
-        m1 = range_cut(-90, 90, self.arm_vel[self.arm_ID][0])
-        m2 = range_cut(-90, 90, self.arm_vel[self.arm_ID][1])
-        m3 = range_cut(-90, 90, self.arm_vel[self.arm_ID][2])
-        m4 = range_cut(-90, 90, self.arm_vel[self.arm_ID][3])
-        m5 = range_cut(-90, 90, self.arm_vel[self.arm_ID][4])
-        self.post_to_send_data(1, bytes(f'/arm_vel:{self.arm_ID};{m1};{m2};{m3};{m4};{m5}^^^', encoding='utf-8'))
+    def _drop_arm_trajectory(self, arm_ID, job):
+        """
+        Removes finished trajectory unless it was already replaced
+        """
+        self.arm_trajectories_lock.acquire()
+        if self.arm_trajectories.get(arm_ID) is job:
+            del self.arm_trajectories[arm_ID]
+        self.arm_trajectories_lock.release()
 
     # solve inverse kinetic
-    def solve_arm(self, target, cartesian=False):
+    def solve_arm(self, target, cartesian=False, arm_ID=0):
         """
         Solves inverse kinematics
 
         :param target: ((x, y), ang) to set arm position in cylindrical coordinates (ang - angle from last joint to horizon)
+            or ((x, y, z), ang) in cartesian coordinates
         :param cartesian: if true solves in cartesian else solves in cylindrical
+        :param arm_ID: arm whose last sent angles are returned if target is not reachable
+        :return: m2, m3, m4, reachable (m1, m2, m3, m4, reachable in cartesian), current angles if not reachable
         """
         if not cartesian:
-            x = target[0][0]
-            y = target[0][1]
-            ang = target[1]
-            try:
-                x -= self.m4_len * math.sin(ang)
-                y += self.m4_len * math.cos(ang)
-                fi = math.atan2(y, x)
-                b = math.acos((self.m2_len ** 2 + self.m3_len ** 2 - x ** 2 - y ** 2) / (2 * self.m2_len * self.m3_len))
-                a = math.acos((self.m2_len ** 2 - self.m3_len ** 2 + x ** 2 + y ** 2) / (
-                        2 * self.m2_len * math.sqrt(x ** 2 + y ** 2)))
-                m2_ang = fi + a - math.pi / 2
-                m3_ang = b - math.pi
-                m4_ang = (ang - m2_ang - m3_ang - math.pi)
-                m2_ang_neg = fi - a - 3 * math.pi / 2 + math.pi
-                m3_ang_neg = -b + math.pi
-                m4_ang_neg = (ang + a + b - fi - 3 * math.pi / 2)
-                m2_ang, m3_ang, m4_ang = map(math.degrees, (m2_ang, m3_ang, m4_ang))
-                m2_ang_neg, m3_ang_neg, m4_ang_neg = map(math.degrees, (m2_ang_neg, m3_ang_neg, m4_ang_neg))
-                if -84 < m2_ang < 63 and -135 < m3_ang < 110 and -90 < m4_ang < 95:
-                    return m2_ang, m3_ang, m4_ang, True
-                elif -84 < m2_ang_neg < 63 and -135 < m3_ang_neg < 110 and -90 < m4_ang_neg < 95:
-                    return m2_ang_neg, m3_ang_neg, m4_ang_neg, True
-                else:
-                    return *self.arm_pos[self.arm_ID][1:4], False
-                # m2_ang = range_cut(-84, 63, m2_ang)
-                # m3_ang = range_cut(-135, 110, m3_ang)
-                # m4_ang = range_cut(-120, 90, m4_ang)
-            except:
-                # debug("math error, out of range")
-                return *self.arm_pos[self.arm_ID][1:4], False
-        else:  # (not tested, probably not working)
-            x = target[0][0]
-            y = target[0][1]
-            z = target[0][2]
-            ang = target[1]
-            xy = math.sqrt(x ** 2 + y ** 2)
-            try:
-                self.arm_pos[self.arm_ID][0] = math.degrees(math.asin(x / xy))
-                z -= self.m4_len * math.sin(ang)
-                xy += self.m4_len * math.cos(ang)
-                fi = math.atan2(z, xy)
-                b = math.acos(
-                    (self.m2_len ** 2 + self.m3_len ** 2 - xy ** 2 - z ** 2) / (2 * self.m2_len * self.m3_len))
-                a = math.acos((self.m2_len ** 2 - self.m3_len ** 2 + xy ** 2 + z ** 2) / (
-                        2 * self.m2_len * math.sqrt(xy ** 2 + z ** 2)))
-                m2_ang = fi + a - 3 * math.pi / 2 + math.pi
-                m3_ang = b - math.pi
-                return list(map(math.degrees, (m2_ang, m3_ang, ang - a - b - fi + math.pi / 2)))
-            except:
-                debug("math error, out of range")
-                return self.arm_pos[self.arm_ID][1:4]
+            joints, reachable = self.kinematics.best(*target[0], target[1])
+            if reachable:
+                return (*map(float, joints), True)
+            return (*self.arm_pos[arm_ID][1:4], False)
+        else:
+            joints, reachable = self.kinematics.best_3d(*target[0], target[1])
+            if reachable:
+                return (*map(float, joints), True)
+            return (*self.arm_pos[arm_ID][0:4], False)
+
+    @property
+    def reachability(self):
+        """
+        ReachabilityMap of the arm, loaded from reachability file or built on first use
+
+        :return: ReachabilityMap
+        """
+        if self._reachability is None:
+            if self.reachability_file and os.path.exists(self.reachability_file):
+                self._reachability = ReachabilityMap.load(self.reachability_file, self.kinematics)
+            else:
+                self._reachability = ReachabilityMap(self.kinematics, collision=self.arm_collision)
+                if self.reachability_file:
+                    self._reachability.save(self.reachability_file)
+        return self._reachability
+
+    def solve_arm_batch(self, x, y, ang):
+        """
+        Solves inverse kinematics in cylindrical coordinates for arrays of targets (joint limits of solve_arm)
+
+        :param x: distances from joint 2 axis (mm)
+        :param y: heights above joint 2 axis (mm)
+        :param ang: angles from last joint to horizon (rad)
+        :return: (..., 2, 3) joint 2 - 4 angles (degrees) of both elbow solutions, (..., 2) mask of solutions
+            within joint limits, (..., ) mask of reachable targets
+        """
+        joints, valid = self.kinematics.solve(x, y, ang)
+        return joints, valid, valid.any(axis=-1)
 
     # video capture
 
@@ -980,10 +1625,12 @@ class KUKA:
         Disconnects from robot
         """
         if self.connected:
-            self.connected = False
             self.move_base()
-            self.move_arm(0, 56, -80, -90, 0, 2)
-            time.sleep(1)
+            self.move_arm(0, 56, -80, -90, 0, 2, force=True)
+            self.wait_arm_reached(timeout=3)
+            self.connected = False
             self.conn.shutdown(socket.SHUT_RDWR)
             self.conn.close()
+            if self.recorder:
+                self.recorder.close()
             debug(f"robot {self.ip} disconnected")
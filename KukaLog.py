@@ -0,0 +1,707 @@
+import abc
+import bisect
+import lzma
+import math
+import os
+import queue
+import struct
+import threading as thr
+import time
+import zlib
+
+import numpy as np
+
+# binary log layout: fixed size header followed by fixed width records
+BINARY_MAGIC = b"KUKABIN1"
+BINARY_HEADER = struct.Struct("<8sIId")  # magic, version, lidar length, lidar scale
+BINARY_VERSION = 2
+# lidar ranges are stored as uint16 multiples of the scale written in the header
+LIDAR_SCALE = 0.001  # m, lidar reports millimetres
+LIDAR_MISSING = 0xFFFF  # beams missing in shorter scans
+
+# chunked compressed layout: header, chunks (chunk header + compressed records), chunk index, trailer
+CHUNKED_MAGIC = b"KUKACLG1"
+CHUNKED_HEADER = struct.Struct("<8sIIId")  # magic, version, lidar length, codec, lidar scale
+CHUNK_HEADER = struct.Struct("<4sIIdd")  # marker, records, compressed length, first time, last time
+CHUNK_MARKER = b"CHNK"
+INDEX_TRAILER = struct.Struct("<Q8s")  # index offset, magic
+INDEX_MAGIC = b"KUKAIDX1"
+INDEX_DTYPE = np.dtype([("offset", "<u8"), ("first", "<u8"), ("n", "<u4"), ("t_first", "<f8"), ("t_last", "<f8")])
+CODECS = {"zlib": (0, lambda b: zlib.compress(b, 6), zlib.decompress),
+          "lzma": (1, lambda b: lzma.compress(b, preset=1), lzma.decompress)}
+
+LOG_FORMATS = ("binary", "text", "zlib", "lzma")
+
+
+def record_dtype(lidar_len):
+    """
+    Numpy dtype of one telemetry record
+    :param lidar_len: number of lidar beams stored per record
+    :return: structured dtype (time, odom, wheels, lidar), lidar in uint16 units of lidar scale
+    """
+    return np.dtype([("time", "<f8"),
+                     ("odom", "<f8", (3,)),
+                     ("wheels", "<f8", (4,)),
+                     ("lidar", "<u2", (lidar_len,))])
+
+
+class LogWriter(abc.ABC):
+    """
+    Buffered telemetry log writer\n
+    Records are collected in chunks on the caller side and written to disk by a background thread,
+    so the control process only pays for copying values into the buffer
+    """
+
+    def __init__(self, path, /, chunk_size=64):
+        """
+        :param path: name and path to log file
+        :param chunk_size: number of records handed to the writing thread at once
+        """
+        self.path = path
+        self.chunk_size = chunk_size
+        self.records_written = 0
+        self._chunk = []
+        self._lock = thr.Lock()
+        self._queue = queue.Queue()
+        self._closed = False
+        self._file = self._open()
+        self._thr = thr.Thread(target=self._write_loop, args=(), daemon=True)
+        self._thr.start()
+
+    @abc.abstractmethod
+    def _open(self):
+        """
+        Opens log file (called from constructor)
+        :return: file object
+        """
+
+    @abc.abstractmethod
+    def _encode(self, chunk):
+        """
+        Converts list of records to bytes (called from writing thread)
+        :param chunk: list of (time, odom, wheels, lidar)
+        :return: bytes to write
+        """
+
+    def write(self, stamp, odom, wheels, lidar):
+        """
+        Adds record to log
+        :param stamp: record time (seconds)
+        :param odom: [x, y, ang] odometry or None
+        :param wheels: 4 wheel positions or None
+        :param lidar: lidar ranges
+        """
+        self._add((stamp, odom, wheels, lidar))
+
+    def _add(self, record):
+        """
+        Adds record to current chunk (may be called from several threads)
+        :param record: record tuple understood by _encode
+        """
+        if self._closed:
+            return
+        self._lock.acquire()
+        self._chunk.append(record)
+        if len(self._chunk) >= self.chunk_size:
+            self._queue.put(self._chunk)
+            self._chunk = []
+        self._lock.release()
+
+    def flush(self):
+        """
+        Hands collected records to writing thread
+        """
+        self._lock.acquire()
+        if self._chunk:
+            self._queue.put(self._chunk)
+            self._chunk = []
+        self._lock.release()
+
+    def _write_loop(self):
+        """
+        Writes queued chunks to file (thread)
+        """
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            self._write_chunk(chunk)
+            self.records_written += len(chunk)
+        self._finish()
+        self._file.close()
+
+    def _write_chunk(self, chunk):
+        self._file.write(self._encode(chunk))
+
+    def _finish(self):
+        pass
+
+    def close(self):
+        """
+        Writes remaining records and closes file
+        """
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._queue.put(None)
+        self._thr.join()
+
+
+class TextLogWriter(LogWriter):
+    """
+    Writes "odom; lidar" text lines (original logger format)
+    """
+
+    def _open(self):
+        return open(self.path, "a")
+
+    def _encode(self, chunk):
+        lines = []
+        for stamp, odom, wheels, lidar in chunk:
+            lines.append(", ".join(map(str, odom)) + "; " + ", ".join(map(str, lidar)) + "\n")
+        return "".join(lines)
+
+
+class BinaryLogWriter(LogWriter):
+    """
+    Writes fixed width binary records: float64 time, odometry and wheels, uint16 lidar block
+    """
+
+    def __init__(self, path, /, chunk_size=64, lidar_len=623, lidar_scale=LIDAR_SCALE):
+        """
+        :param path: name and path to log file
+        :param chunk_size: number of records handed to the writing thread at once
+        :param lidar_len: number of lidar beams per record (longer scans are cut, shorter padded)
+        :param lidar_scale: lidar range unit (m)
+        """
+        self.lidar_len = lidar_len
+        self.lidar_scale = lidar_scale
+        self.dtype = record_dtype(lidar_len)
+        super().__init__(path, chunk_size=chunk_size)
+
+    def _open(self):
+        file = open(self.path, "ab")
+        if file.tell() == 0:
+            file.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, self.lidar_len, self.lidar_scale))
+        else:
+            layout = read_binary_header(self.path)
+            if layout != (self.lidar_len, self.lidar_scale):
+                file.close()
+                raise ValueError(f"{self.path} holds other lidar length or scale")
+        return file
+
+    def _encode(self, chunk):
+        return pack_records(chunk, self.dtype, self.lidar_scale).tobytes()
+
+
+class ChunkedLogWriter(LogWriter):
+    """
+    Writes binary records in independently compressed chunks followed by a chunk index,
+    so any record can be reached by decompressing one chunk.
+    Compression runs in the writing thread
+    """
+
+    def __init__(self, path, /, chunk_size=256, lidar_len=623, codec="zlib", lidar_scale=LIDAR_SCALE):
+        """
+        :param path: name and path to log file
+        :param chunk_size: number of records per compressed chunk
+        :param lidar_len: number of lidar beams per record
+        :param codec: "zlib" or "lzma"
+        :param lidar_scale: lidar range unit (m)
+        """
+        self.lidar_len = lidar_len
+        self.lidar_scale = lidar_scale
+        self.dtype = record_dtype(lidar_len)
+        self.codec = codec
+        self.codec_id, self.compress, _ = CODECS[codec]
+        self.index = []
+        super().__init__(path, chunk_size=chunk_size)
+
+    def _open(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            file = open(self.path, "wb")
+            file.write(CHUNKED_HEADER.pack(CHUNKED_MAGIC, BINARY_VERSION, self.lidar_len, self.codec_id,
+                                           self.lidar_scale))
+            return file
+        # appending: reuse chunk index of existing file and overwrite its trailer
+        file = open(self.path, "r+b")
+        if read_chunked_header(file) != (self.lidar_len, self.codec_id, self.lidar_scale):
+            file.close()
+            raise ValueError(f"{self.path} holds other lidar length, codec or scale")
+        index, end = scan_chunks(file)
+        self.index = index.tolist()
+        file.seek(end)
+        file.truncate()
+        return file
+
+    def _encode(self, chunk):
+        records = pack_records(chunk, self.dtype, self.lidar_scale)
+        payload = self.compress(shuffle(records))
+        first = self.index[-1][1] + self.index[-1][2] if self.index else 0
+        # the chunk is written right after encoding, at the current end of file
+        self.index.append((self._file.tell(), first, len(records), records["time"][0], records["time"][-1]))
+        return CHUNK_HEADER.pack(CHUNK_MARKER, len(records), len(payload),
+                                 records["time"][0], records["time"][-1]) + payload
+
+    def _finish(self):
+        offset = self._file.tell()
+        self._file.write(np.array(self.index, dtype=INDEX_DTYPE).tobytes())
+        self._file.write(INDEX_TRAILER.pack(offset, INDEX_MAGIC))
+
+
+def pack_records(chunk, dtype, lidar_scale=LIDAR_SCALE):
+    """
+    Converts list of records to structured array
+    :param chunk: list of (time, odom, wheels, lidar)
+    :param dtype: record dtype
+    :param lidar_scale: lidar range unit (m)
+    :return: numpy array of records
+    """
+    out = np.empty(len(chunk), dtype=dtype)
+    for i, (stamp, odom, wheels, lidar) in enumerate(chunk):
+        rec = out[i]
+        rec["time"] = stamp
+        rec["odom"] = odom[:3] if odom else np.nan
+        rec["wheels"] = wheels[:4] if wheels else np.nan
+        fill_lidar(rec["lidar"], lidar, lidar_scale)
+    return out
+
+
+def unpack_record(rec, lidar_scale=LIDAR_SCALE):
+    """
+    Converts structured record to (time, odom, wheels, lidar), missing values are None
+    :param rec: numpy record
+    :param lidar_scale: lidar range unit (m) of the log
+    """
+    odom = rec["odom"]
+    wheels = rec["wheels"]
+    lidar = rec["lidar"]
+    return (float(rec["time"]),
+            None if np.isnan(odom[0]) else odom.tolist(),
+            None if np.isnan(wheels[0]) else wheels.tolist(),
+            (lidar[lidar != LIDAR_MISSING] * lidar_scale).tolist())
+
+
+def lidar_ranges(lidar, lidar_scale=LIDAR_SCALE):
+    """
+    :param lidar: uint16 lidar field of records
+    :param lidar_scale: lidar range unit (m) of the log
+    :return: float ranges (m), missing beams are nan
+    """
+    return np.where(lidar == LIDAR_MISSING, np.nan, lidar * lidar_scale)
+
+
+def shuffle(records):
+    """
+    Groups bytes of the same record position together (much better compression of float data)
+    :param records: numpy array of records
+    :return: shuffled bytes
+    """
+    return records.view(np.uint8).reshape(len(records), -1).T.tobytes()
+
+
+def unshuffle(raw, n, dtype):
+    """
+    Inverse of shuffle
+    :param raw: shuffled bytes
+    :param n: number of records
+    :param dtype: record dtype
+    :return: numpy array of records
+    """
+    return np.frombuffer(raw, dtype=np.uint8).reshape(dtype.itemsize, n).T.copy().view(dtype).reshape(n)
+
+
+def read_chunked_header(file):
+    """
+    Reads chunked log header
+    :param file: file opened in binary mode
+    :return: lidar length, codec id, lidar scale
+    """
+    file.seek(0)
+    raw = file.read(CHUNKED_HEADER.size)
+    if len(raw) < CHUNKED_HEADER.size:
+        raise ValueError(f"{file.name} is not a chunked KUKA log")
+    magic, version, lidar_len, codec_id, lidar_scale = CHUNKED_HEADER.unpack(raw)
+    if magic != CHUNKED_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"{file.name} is not a chunked KUKA log")
+    return lidar_len, codec_id, lidar_scale
+
+
+def scan_chunks(file):
+    """
+    Builds chunk index by walking chunk headers (used when the index was not written, e.g. after a crash)
+    :param file: file opened in binary mode
+    :return: index array, offset of the end of the last complete chunk
+    """
+    size = os.fstat(file.fileno()).st_size
+    index_offset, magic = 0, b""
+    if size >= CHUNKED_HEADER.size + INDEX_TRAILER.size:
+        file.seek(size - INDEX_TRAILER.size)
+        index_offset, magic = INDEX_TRAILER.unpack(file.read(INDEX_TRAILER.size))
+    if magic == INDEX_MAGIC:
+        file.seek(index_offset)
+        raw = file.read(size - INDEX_TRAILER.size - index_offset)
+        return np.frombuffer(raw, dtype=INDEX_DTYPE).copy(), index_offset
+    index = []
+    offset = CHUNKED_HEADER.size
+    first = 0
+    while offset + CHUNK_HEADER.size <= size:
+        file.seek(offset)
+        marker, n, length, t_first, t_last = CHUNK_HEADER.unpack(file.read(CHUNK_HEADER.size))
+        if marker != CHUNK_MARKER or offset + CHUNK_HEADER.size + length > size:
+            break
+        index.append((offset, first, n, t_first, t_last))
+        offset += CHUNK_HEADER.size + length
+        first += n
+    return np.array(index, dtype=INDEX_DTYPE), offset
+
+
+def fill_lidar(dst, lidar, lidar_scale=LIDAR_SCALE):
+    """
+    Quantizes lidar scan into fixed width block, ranges out of uint16 are clipped, not finite ones are missing
+    :param dst: uint16 block
+    :param lidar: lidar ranges (m)
+    :param lidar_scale: lidar range unit (m)
+    """
+    n = min(len(dst), len(lidar)) if lidar else 0
+    ranges = np.asarray(lidar[:n], dtype=float) / lidar_scale
+    finite = np.isfinite(ranges)
+    dst[:n] = np.where(finite, np.clip(np.rint(np.where(finite, ranges, 0)), 0, LIDAR_MISSING - 1), LIDAR_MISSING)
+    dst[n:] = LIDAR_MISSING
+
+
+def read_binary_header(path):
+    """
+    Reads binary log header
+    :param path: name and path to log file
+    :return: lidar length and lidar scale of log records
+    """
+    with open(path, "rb") as file:
+        raw = file.read(BINARY_HEADER.size)
+    if len(raw) < BINARY_HEADER.size:
+        raise ValueError(f"{path} is not a binary KUKA log")
+    magic, version, lidar_len, lidar_scale = BINARY_HEADER.unpack(raw)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError(f"{path} is not a binary KUKA log")
+    return lidar_len, lidar_scale
+
+
+def open_log_writer(path, fmt="binary", /, **kwargs):
+    """
+    Creates log writer for set format
+    :param path: name and path to log file
+    :param fmt: "binary", "text" or compressed "zlib", "lzma"
+    :return: log writer
+    """
+    if fmt == "binary":
+        return BinaryLogWriter(path, **kwargs)
+    elif fmt in CODECS:
+        return ChunkedLogWriter(path, codec=fmt, **kwargs)
+    elif fmt == "text":
+        return TextLogWriter(path, **kwargs)
+    raise ValueError(f"unknown log format {fmt}, expected one of {LOG_FORMATS}")
+
+
+class BinaryLogReader:
+    """
+    Memory-mapped binary log reader\n
+    Nothing is read until a record is accessed, so playback of any log size starts immediately
+    """
+
+    def __init__(self, path):
+        """
+        :param path: name and path to log file
+        """
+        self.path = path
+        self.lidar_len, self.lidar_scale = read_binary_header(path)
+        self.dtype = record_dtype(self.lidar_len)
+        n = (os.path.getsize(path) - BINARY_HEADER.size) // self.dtype.itemsize
+        if n:
+            self.records = np.memmap(path, dtype=self.dtype, mode="r", offset=BINARY_HEADER.size, shape=(n,))
+        else:
+            self.records = np.empty(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, ind):
+        """
+        :param ind: record index
+        :return: (time, odom, wheels, lidar), missing values are None
+        """
+        return unpack_record(self.records[ind], self.lidar_scale)
+
+    def time_at(self, ind):
+        return float(self.records[ind]["time"])
+
+    def index_at_time(self, stamp):
+        """
+        Finds first record not older than stamp (binary search, touches log(n) records)
+        :param stamp: time in seconds
+        :return: record index
+        """
+        return bisect.bisect_left(_TimeView(self), stamp)
+
+    def read(self, start=0):
+        """
+        Iterates over records
+        :param start: first record index
+        """
+        for i in range(start, len(self)):
+            yield self[i]
+
+    def blocks(self, size=4096):
+        """
+        Iterates over log in structured arrays of records (for batch processing)
+        :param size: records per block
+        """
+        for i in range(0, len(self), size):
+            yield self.records[i:i + size]
+
+    def close(self):
+        self.records = None
+
+
+class _TimeView:
+    """
+    Sequence of record times used for bisect
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __getitem__(self, ind):
+        return self.reader.time_at(ind)
+
+
+class ChunkedLogReader:
+    """
+    Chunked compressed log reader\n
+    Keeps only the chunk index in memory and decompresses one chunk at a time
+    """
+
+    def __init__(self, path):
+        """
+        :param path: name and path to log file
+        """
+        self.path = path
+        self.file = open(path, "rb")
+        self.lidar_len, codec_id, self.lidar_scale = read_chunked_header(self.file)
+        self.dtype = record_dtype(self.lidar_len)
+        self.decompress = [dec for ind, _, dec in CODECS.values() if ind == codec_id][0]
+        self.index, _ = scan_chunks(self.file)
+        self._chunk_ind = None
+        self._chunk = None
+
+    def __len__(self):
+        if not len(self.index):
+            return 0
+        return int(self.index["first"][-1] + self.index["n"][-1])
+
+    def chunk(self, chunk_ind):
+        """
+        Decompresses chunk (the last one is cached)
+        :param chunk_ind: chunk number
+        :return: numpy array of records
+        """
+        if chunk_ind != self._chunk_ind:
+            offset, n = int(self.index["offset"][chunk_ind]), int(self.index["n"][chunk_ind])
+            self.file.seek(offset)
+            _, _, length, _, _ = CHUNK_HEADER.unpack(self.file.read(CHUNK_HEADER.size))
+            self._chunk = unshuffle(self.decompress(self.file.read(length)), n, self.dtype)
+            self._chunk_ind = chunk_ind
+        return self._chunk
+
+    def _locate(self, ind):
+        chunk_ind = int(np.searchsorted(self.index["first"], ind, side="right")) - 1
+        return chunk_ind, ind - int(self.index["first"][chunk_ind])
+
+    def __getitem__(self, ind):
+        if not 0 <= ind < len(self):
+            raise IndexError(ind)
+        chunk_ind, rec_ind = self._locate(ind)
+        return unpack_record(self.chunk(chunk_ind)[rec_ind], self.lidar_scale)
+
+    def time_at(self, ind):
+        chunk_ind, rec_ind = self._locate(ind)
+        return float(self.chunk(chunk_ind)["time"][rec_ind])
+
+    def index_at_time(self, stamp):
+        """
+        Finds first record not older than stamp, decompresses at most one chunk
+        :param stamp: time in seconds
+        :return: record index
+        """
+        chunk_ind = int(np.searchsorted(self.index["t_last"], stamp))
+        if chunk_ind == len(self.index):
+            return len(self)
+        times = self.chunk(chunk_ind)["time"]
+        return int(self.index["first"][chunk_ind]) + int(np.searchsorted(times, stamp))
+
+    def read(self, start=0):
+        """
+        Iterates over records
+        :param start: first record index
+        """
+        if start >= len(self):
+            return
+        chunk_ind, rec_ind = self._locate(start)
+        for i in range(chunk_ind, len(self.index)):
+            for rec in self.chunk(i)[rec_ind:]:
+                yield unpack_record(rec, self.lidar_scale)
+            rec_ind = 0
+
+    def blocks(self):
+        """
+        Iterates over log chunk by chunk in structured arrays of records (for batch processing)
+        """
+        for i in range(len(self.index)):
+            yield self.chunk(i)
+
+    def close(self):
+        self.file.close()
+
+
+class TextLogReader:
+    """
+    Lazy text log reader\n
+    Lines are parsed only when played, offsets of already seen lines are kept for seeking.
+    Text logs have no timestamps, records are stamped as index / freq
+    """
+
+    def __init__(self, path, /, freq=1):
+        """
+        :param path: name and path to log file
+        :param freq: frequency the log was written with
+        """
+        self.path = path
+        self.freq = freq
+        self.lidar_scale = LIDAR_SCALE  # of blocks
+        self.file = open(path, "rb")
+        self._offsets = [0]  # byte offsets of records found so far
+
+    def _scan_to(self, ind):
+        """
+        Finds offsets of records up to ind without parsing them
+        :param ind: record index
+        :return: True if offset of record ind is known
+        """
+        if ind < len(self._offsets):
+            return True
+        self.file.seek(self._offsets[-1])
+        while len(self._offsets) <= ind:
+            line = self.file.readline()
+            if not line.endswith(b"\n"):
+                return False
+            self._offsets.append(self._offsets[-1] + len(line))
+        return True
+
+    @staticmethod
+    def parse(line):
+        """
+        Parses "values; lidar" line
+        :param line: log line
+        :return: (values, lidar) or None if line is broken
+        """
+        sp_log_data = line.split(b';')
+        if len(sp_log_data) < 2:
+            return None
+        try:
+            values = list(map(float, sp_log_data[0].split(b',')))
+            lidar = list(map(float, sp_log_data[1].split(b',')))
+        except ValueError:
+            return None
+        return values, lidar
+
+    def time_at(self, ind):
+        return ind / self.freq
+
+    def index_at_time(self, stamp):
+        return max(0, math.ceil(stamp * self.freq))
+
+    def read(self, start=0):
+        """
+        Iterates over records, 3 values are treated as odometry and 4 as wheel positions
+        :param start: first record index
+        """
+        if not self._scan_to(start):
+            return
+        self.file.seek(self._offsets[start])
+        i = start
+        for line in self.file:
+            if not line.endswith(b"\n"):
+                break
+            if i == len(self._offsets) - 1:
+                self._offsets.append(self._offsets[-1] + len(line))
+            parsed = self.parse(line)
+            if parsed:
+                values, lidar = parsed
+                odom, wheels = (values, None) if len(values) == 3 else (None, values)
+                yield self.time_at(i), odom, wheels, lidar
+            i += 1
+
+    def blocks(self, size=4096):
+        """
+        Iterates over log in structured arrays of records (for batch processing),
+        lidar block width is taken from the first record
+        :param size: records per block
+        """
+        batch = []
+        dtype = None
+        for rec in self.read():
+            if dtype is None:
+                dtype = record_dtype(len(rec[3]))
+            batch.append(rec)
+            if len(batch) >= size:
+                yield pack_records(batch, dtype)
+                batch = []
+        if batch:
+            yield pack_records(batch, dtype)
+
+    def close(self):
+        self.file.close()
+
+
+def open_log(path, /, freq=1):
+    """
+    Opens log for reading, format is detected by file header
+    :param path: name and path to log file
+    :param freq: frequency of text logs (they have no timestamps)
+    :return: log reader
+    """
+    with open(path, "rb") as file:
+        magic = file.read(len(BINARY_MAGIC))
+    if magic == BINARY_MAGIC:
+        return BinaryLogReader(path)
+    if magic == CHUNKED_MAGIC:
+        return ChunkedLogReader(path)
+    return TextLogReader(path, freq=freq)
+
+
+def play(reader, /, start=0, start_time=None, speed=1.0):
+    """
+    Yields log records paced by their timestamps
+    :param reader: log reader
+    :param start: first record index
+    :param start_time: if set, playback starts from first record at this time (seconds from log start)
+    :param speed: playback speed multiplier (1 - real-time), None or 0 - unthrottled
+    """
+    if start_time is not None:
+        if hasattr(reader, "__len__") and not len(reader):
+            # empty log has no first record time, lazy text reader stamps records by index
+            return
+        start = reader.index_at_time(reader.time_at(0) + start_time)
+    t0 = None
+    wall0 = time.monotonic()
+    for rec in reader.read(start):
+        if speed:
+            if t0 is None:
+                t0 = rec[0]
+            delay = wall0 + (rec[0] - t0) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        yield rec
@@ -0,0 +1,103 @@
+import math
+
+import numpy as np
+
+LIDAR_MIN = 0.01  # ranges outside (LIDAR_MIN, LIDAR_MAX) are not hits, same as in GUI
+LIDAR_MAX = 5.5
+LIDAR_OFFSET = 0.3  # lidar is mounted 0.3 m in front of robot center
+LIDAR_FOV = 240  # degrees, first beam is +120 from robot direction, the last one is -120
+
+
+class LidarGeometry:
+    """
+    Beam geometry of the lidar\n
+    sin/cos tables are computed once per scan length, scans are converted to points in one vectorized call
+    """
+
+    def __init__(self, /, fov=LIDAR_FOV, offset=LIDAR_OFFSET, r_min=LIDAR_MIN, r_max=LIDAR_MAX):
+        """
+        :param fov: field of view (degrees)
+        :param offset: distance from robot center to lidar along robot direction (m)
+        :param r_min: ranges not greater than r_min are invalid
+        :param r_max: ranges not less than r_max are invalid
+        """
+        self.fov = fov
+        self.offset = offset
+        self.r_min = r_min
+        self.r_max = r_max
+        self._tables = {}
+
+    def tables(self, n):
+        """
+        :param n: number of beams
+        :return: (n,) beam angles in robot frame (rad), their cos and sin
+        """
+        table = self._tables.get(n)
+        if table is None:
+            angles = np.radians(self.fov / 2 - self.fov / n * np.arange(n))
+            table = (angles, np.cos(angles), np.sin(angles))
+            for arr in table:
+                arr.setflags(write=False)
+            self._tables[n] = table
+        return table
+
+    def angles(self, n):
+        """
+        :param n: number of beams
+        :return: (n,) beam angles in robot frame (rad)
+        """
+        return self.tables(n)[0]
+
+    def valid(self, scan):
+        """
+        :param scan: lidar ranges
+        :return: bool mask of ranges that are hits
+        """
+        scan = np.asarray(scan)
+        return (scan > self.r_min) & (scan < self.r_max)
+
+    def origin(self, pose=None):
+        """
+        :param pose: [x, y, ang] of the robot, None for robot frame
+        :return: (2,) lidar position
+        """
+        if pose is None:
+            return np.array([self.offset, 0.0])
+        return np.array([pose[0] + self.offset * math.cos(pose[2]), pose[1] + self.offset * math.sin(pose[2])])
+
+    def directions(self, n, /, ang=0.0, step=1):
+        """
+        :param n: number of beams
+        :param ang: robot angle, 0 for robot frame
+        :param step: use every step-th beam
+        :return: (n / step, 2) unit beam vectors
+        """
+        _, cos, sin = self.tables(n)
+        cos, sin = cos[::step], sin[::step]
+        if not ang:
+            return np.stack([cos, sin], axis=1)
+        c, s = math.cos(ang), math.sin(ang)
+        return np.stack([cos * c - sin * s, cos * s + sin * c], axis=1)
+
+    def points(self, scan, /, pose=None, step=1):
+        """
+        Converts scan to points
+        :param scan: lidar ranges
+        :param pose: [x, y, ang] of the robot when scan was taken, None for robot frame
+        :param step: use every step-th beam
+        :return: (n / step, 2) points of every beam, bool mask of valid ones
+        """
+        scan = np.asarray(scan, dtype=np.float64)
+        ranges = scan[::step]
+        direction = self.directions(len(scan), ang=pose[2] if pose is not None else 0.0, step=step)
+        return self.origin(pose) + direction * ranges[:, None], self.valid(ranges)
+
+    def valid_points(self, scan, /, pose=None, step=1):
+        """
+        :param scan: lidar ranges
+        :param pose: [x, y, ang] of the robot when scan was taken, None for robot frame
+        :param step: use every step-th beam
+        :return: (M, 2) points of valid beams only
+        """
+        points, valid = self.points(scan, pose=pose, step=step)
+        return points[valid]
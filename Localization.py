@@ -0,0 +1,210 @@
+import math
+
+import cv2
+import numpy as np
+
+from LidarGeometry import LidarGeometry
+from Odometry import wrap_angle
+
+
+class MonteCarloLocalization:
+    """
+    Particle filter localization on a known occupancy grid\n
+    Particles are moved by wheel odometry steps and weighted by likelihood field
+    (precomputed distance from every cell to the nearest obstacle), all particles are scored
+    against all used beams with one broadcast lookup
+    """
+
+    def __init__(self, grid, /, particles=3000, beams=60, beam_weight=0.1, sigma_hit=0.1, z_hit=0.9, z_rand=0.1,
+                 motion_noise=(0.1, 0.05, 0.2, 0.05), min_noise=(0.005, 0.005),
+                 update_distance=0.02, update_angle=0.02, converged_std=(0.1, 0.1),
+                 seed=None, geometry=None):
+        """
+        :param grid: OccupancyGrid map
+        :param particles: number of particles
+        :param beams: number of lidar beams used for scoring
+        :param beam_weight: power of every beam likelihood (neighbour beams are not independent,
+            weight 1 makes weights collapse to a single particle)
+        :param sigma_hit: standard deviation of range measurement (m)
+        :param z_hit: weight of measurement hitting the nearest obstacle
+        :param z_rand: weight of random measurement
+        :param motion_noise: odometry noise factors (translation from translation, translation from rotation,
+            rotation from rotation, rotation from translation)
+        :param min_noise: translation (m) and rotation (rad) noise added on every step
+        :param update_distance: scans are scored after robot moved this distance (m)
+        :param update_angle: or turned by this angle (rad)
+        :param converged_std: position (m) and angle (rad) standard deviation of converged estimate
+        :param seed: random generator seed
+        :param geometry: LidarGeometry of the lidar
+        """
+        self.grid = grid
+        self.n = particles
+        self.beams = beams
+        self.beam_weight = beam_weight
+        self.motion_noise = motion_noise
+        self.min_noise = min_noise
+        self.update_distance = update_distance
+        self.update_angle = update_angle
+        self.converged_std = converged_std
+        self.geometry = geometry or LidarGeometry()
+        self.rng = np.random.default_rng(seed)
+        self.updates = 0
+        self.resamples = 0
+        self.particles = np.zeros((particles, 3))
+        self.weights = np.full(particles, 1 / particles)
+        self._last_odom = None
+        self._moved = [0.0, 0.0]  # distance and angle since the last scored scan
+        self._scored = False
+        self.likelihood = self._likelihood_field(sigma_hit, z_hit, z_rand)
+
+    def _likelihood_field(self, sigma_hit, z_hit, z_rand):
+        """
+        :return: flat log-likelihood of a beam ending in every cell
+        """
+        free = np.where(self.grid.occupied(), 0, 255).astype(np.uint8)
+        dist = cv2.distanceTransform(free, cv2.DIST_L2, cv2.DIST_MASK_PRECISE) * self.grid.resolution
+        field = np.log(z_hit * np.exp(-dist ** 2 / (2 * sigma_hit ** 2)) + z_rand / self.geometry.r_max)
+        # flat field with one extra cell for beams ending outside of the map
+        return np.append(field.ravel(), field.min()).astype(np.float32)
+
+    def initialize(self, pose=None, /, std=(0.2, 0.2, 0.2)):
+        """
+        Spreads particles around pose or over the whole free space of the map
+        :param pose: [x, y, ang] or None for global localization
+        :param std: standard deviation of x, y (m) and ang (rad) around pose
+        """
+        if pose is not None:
+            self.particles = np.array(pose, dtype=float) + self.rng.normal(size=(self.n, 3)) * std
+        else:
+            free = np.argwhere(self.grid.log_odds < 0)
+            cells = free[self.rng.integers(len(free), size=self.n)]
+            self.particles = np.empty((self.n, 3))
+            self.particles[:, :2] = self.grid.cell_to_world(cells) + self.rng.uniform(
+                -0.5, 0.5, size=(self.n, 2)) * self.grid.resolution
+            self.particles[:, 2] = self.rng.uniform(0, 2 * math.pi, size=self.n)
+        self.particles[:, 2] %= 2 * math.pi
+        self.weights = np.full(self.n, 1 / self.n)
+        self._scored = False
+
+    def predict(self, odom):
+        """
+        Moves particles by the odometry step since the previous call
+        :param odom: [x, y, ang] from wheel odometry
+        """
+        if self._last_odom is None:
+            self._last_odom = list(odom)
+            return
+        x0, y0, ang0 = self._last_odom
+        self._last_odom = list(odom)
+        # step in robot frame of the previous pose
+        cos, sin = math.cos(ang0), math.sin(ang0)
+        dx, dy = odom[0] - x0, odom[1] - y0
+        fwd, side = cos * dx + sin * dy, -sin * dx + cos * dy
+        turn = wrap_angle(odom[2] - ang0)
+        dist = math.hypot(fwd, side)
+        self._moved[0] += dist
+        self._moved[1] += abs(turn)
+
+        a_tt, a_tr, a_rr, a_rt = self.motion_noise
+        std_xy = a_tt * dist + a_tr * abs(turn) + self.min_noise[0]
+        std_ang = a_rr * abs(turn) + a_rt * dist + self.min_noise[1]
+        noise = self.rng.normal(size=(self.n, 3)) * (std_xy, std_xy, std_ang)
+        fwd = fwd + noise[:, 0]
+        side = side + noise[:, 1]
+        ang = self.particles[:, 2]
+        cos, sin = np.cos(ang), np.sin(ang)
+        self.particles[:, 0] += cos * fwd - sin * side
+        self.particles[:, 1] += sin * fwd + cos * side
+        self.particles[:, 2] = (ang + turn + noise[:, 2]) % (2 * math.pi)
+
+    def correct(self, scan):
+        """
+        Weights particles by the scan and resamples them when effective sample size is low
+        :param scan: lidar ranges
+        """
+        points = self.geometry.valid_points(scan)
+        if len(points) > self.beams:
+            points = points[np.linspace(0, len(points) - 1, self.beams).astype(int)]
+        if not len(points):
+            return
+        # (particles, beams) map cells of beam ends, in cell units
+        points = (points / self.grid.resolution).astype(np.float32)
+        xy = ((self.particles[:, :2] - self.grid.origin) / self.grid.resolution).astype(np.float32)
+        x, y = xy[:, 0, None], xy[:, 1, None]
+        ang = self.particles[:, 2, None]
+        cos, sin = np.cos(ang).astype(np.float32), np.sin(ang).astype(np.float32)
+        # truncation instead of floor is one cell off only in (-1, 0) just outside the map
+        cols = (x + cos * points[:, 0] - sin * points[:, 1]).astype(np.int32)
+        rows = (y + sin * points[:, 0] + cos * points[:, 1]).astype(np.int32)
+        height, width = self.grid.shape
+        outside = (rows < 0) | (rows >= height) | (cols < 0) | (cols >= width)
+        cells = rows * width + cols
+        cells[outside] = height * width
+        log_w = np.take(self.likelihood, cells).sum(axis=1) * self.beam_weight + np.log(self.weights + 1e-300)
+        weights = np.exp(log_w - log_w.max())
+        self.weights = weights / weights.sum()
+        self.updates += 1
+        self._moved = [0.0, 0.0]
+        self._scored = True
+        if 1 / np.square(self.weights).sum() < self.n / 2:
+            self.resample()
+
+    def resample(self):
+        """
+        Systematic resampling
+        """
+        positions = (self.rng.random() + np.arange(self.n)) / self.n
+        indices = np.searchsorted(np.cumsum(self.weights), positions)
+        self.particles = self.particles[np.minimum(indices, self.n - 1)]
+        self.weights = np.full(self.n, 1 / self.n)
+        self.resamples += 1
+
+    def update(self, odom, scan):
+        """
+        Moves particles by odometry and scores scan if robot moved enough since the last scored scan
+        or particles have not converged yet
+        :param odom: [x, y, ang] from wheel odometry when scan was taken
+        :param scan: lidar ranges
+        :return: estimated [x, y, ang]
+        """
+        self.predict(odom)
+        if (not self._scored or self._moved[0] > self.update_distance or self._moved[1] > self.update_angle
+                or not self.converged):
+            self.correct(scan)
+        return self.pose
+
+    def rebase(self, odom):
+        """
+        Odometry frame was moved (pose estimator corrected), the last odometry pose is now odom
+        :param odom: [x, y, ang]
+        """
+        self._last_odom = list(odom)
+
+    @property
+    def pose(self):
+        """
+        :return: weighted mean [x, y, ang]
+        """
+        w = self.weights
+        ang = math.atan2((w * np.sin(self.particles[:, 2])).sum(), (w * np.cos(self.particles[:, 2])).sum())
+        return [float(w @ self.particles[:, 0]), float(w @ self.particles[:, 1]), ang % (2 * math.pi)]
+
+    @property
+    def std(self):
+        """
+        :return: weighted standard deviation of position (m) and angle (rad)
+        """
+        w = self.weights
+        mean = w @ self.particles[:, :2]
+        pos = math.sqrt(w @ np.square(self.particles[:, :2] - mean).sum(axis=1))
+        length = math.hypot((w * np.sin(self.particles[:, 2])).sum(), (w * np.cos(self.particles[:, 2])).sum())
+        ang = math.sqrt(-2 * math.log(min(1.0, max(length, 1e-12))))
+        return pos, ang
+
+    @property
+    def converged(self):
+        """
+        :return: True if particles agree on the pose
+        """
+        pos, ang = self.std
+        return pos < self.converged_std[0] and ang < self.converged_std[1]
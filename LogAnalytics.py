@@ -0,0 +1,259 @@
+"""
+Offline statistics over directories of telemetry logs and session recordings\n
+usage: python LogAnalytics.py LOG_DIR [-j WORKERS] [--freq FREQ] [--csv FILE] [--trajectories DIR]
+"""
+import argparse
+import concurrent.futures
+import os
+
+import numpy as np
+
+from KukaLog import BINARY_MAGIC, CHUNKED_MAGIC, TextLogReader, lidar_ranges, open_log
+from LidarGeometry import LIDAR_MAX, LIDAR_MIN
+from Odometry import integrate_wheels
+from SessionRecorder import INBOUND, SESSION_MAGIC, SessionReader
+
+GAP_FACTOR = 3  # interval longer than GAP_FACTOR median intervals counts as gap
+
+# summary table: key, title, format
+SUMMARY_COLUMNS = [("name", "log", "{}"),
+                   ("kind", "kind", "{}"),
+                   ("records", "records", "{}"),
+                   ("duration", "duration, s", "{:.1f}"),
+                   ("rate", "rate, Hz", "{:.1f}"),
+                   ("gaps", "gaps", "{}"),
+                   ("max_gap", "max gap, s", "{:.2f}"),
+                   ("distance", "odom dist, m", "{:.2f}"),
+                   ("wheels_distance", "wheels dist, m", "{:.2f}"),
+                   ("trace", "trace", "{:.1f}"),
+                   ("lidar_valid", "lidar valid", "{:.1%}")]
+
+
+def log_kind(path):
+    """
+    Detects log type
+    :param path: name and path to file
+    :return: "telemetry", "session" or None if file is not a log
+    """
+    with open(path, "rb") as file:
+        head = file.read(8)
+        file.seek(0)
+        first_line = file.readline(1 << 20)
+    if head in (BINARY_MAGIC, CHUNKED_MAGIC):
+        return "telemetry"
+    if head == SESSION_MAGIC:
+        return "session"
+    if first_line.endswith(b"\n") and TextLogReader.parse(first_line):
+        return "telemetry"
+    return None
+
+
+def wheel_trajectory(wheels):
+    """
+    Reconstructs trajectory from wheel positions
+    :param wheels: (N, 4) wheel positions, rows with nan are skipped
+    :return: (M, 3) poses [x, y, ang] starting from [0, 0, 0], trace
+    """
+    return integrate_wheels(wheels[~np.isnan(wheels).any(axis=1)])
+
+
+def path_length(xy):
+    """
+    :param xy: (N, 2) positions, rows with nan are skipped
+    :return: length of polyline
+    """
+    xy = xy[~np.isnan(xy).any(axis=1)]
+    if len(xy) < 2:
+        return 0.0
+    return float(np.hypot(*np.diff(xy, axis=0).T).sum())
+
+
+def timing_stats(times):
+    """
+    :param times: message or record times
+    :return: duration, rate, number of gaps, longest gap
+    """
+    if len(times) < 2:
+        return 0.0, 0.0, 0, 0.0
+    dt = np.diff(times)
+    duration = float(times[-1] - times[0])
+    gaps = dt[dt > GAP_FACTOR * np.median(dt)]
+    return duration, (len(times) - 1) / duration if duration > 0 else 0.0, len(gaps), float(dt.max())
+
+
+def telemetry_columns(path, freq):
+    """
+    Reads telemetry log in blocks
+    :param path: name and path to log file
+    :param freq: frequency of text logs
+    :return: times, odometry (N, 3), wheels (N, 4), valid lidar ranges, all lidar ranges
+    """
+    reader = open_log(path, freq=freq)
+    times, odom, wheels = [], [], []
+    valid = total = 0
+    for block in reader.blocks():
+        times.append(np.asarray(block["time"]))
+        odom.append(np.asarray(block["odom"]))
+        wheels.append(np.asarray(block["wheels"]))
+        lidar = lidar_ranges(np.asarray(block["lidar"]), reader.lidar_scale)
+        total += np.count_nonzero(~np.isnan(lidar))
+        valid += np.count_nonzero((lidar > LIDAR_MIN) & (lidar < LIDAR_MAX))
+    reader.close()
+    if not times:
+        return np.empty(0), np.empty((0, 3)), np.empty((0, 4)), 0, 0
+    return np.concatenate(times), np.concatenate(odom), np.concatenate(wheels), valid, total
+
+
+def session_columns(path):
+    """
+    Parses telemetry lines of session recording
+    :param path: name and path to session file
+    :return: times of received messages, odometry (N, 3), wheels (N, 4), valid lidar ranges, all lidar ranges
+    """
+    reader = SessionReader(path)
+    times, odom, wheels = [], [], []
+    valid = total = 0
+    for stamp, direction, data in reader.read():
+        if direction != INBOUND:
+            continue
+        times.append(stamp)
+        try:
+            if data[:6] == b".odom#":
+                odom.append(list(map(float, data[6:].split(b';')))[:3])
+            elif data[:8] == b".wheels#":
+                wheels.append(list(map(float, data[8:].split(b';')))[:4])
+            elif data[:7] == b".laser#":
+                lidar = np.array([float(i) for i in data[7:].split(b';') if i], dtype=np.float32)
+                total += len(lidar)
+                valid += np.count_nonzero((lidar > LIDAR_MIN) & (lidar < LIDAR_MAX))
+        except ValueError:
+            pass
+    reader.close()
+    return (np.array(times), np.array(odom, dtype=float).reshape(-1, 3),
+            np.array(wheels, dtype=float).reshape(-1, 4), valid, total)
+
+
+def analyse_log(path, /, freq=1, trajectory=True):
+    """
+    Computes statistics of one log
+    :param path: name and path to telemetry log or session recording
+    :param freq: frequency of text logs (they have no timestamps)
+    :param trajectory: if true result contains trajectory reconstructed from wheel odometry
+    :return: dict with SUMMARY_COLUMNS keys (and "trajectory")
+    """
+    kind = log_kind(path)
+    if kind == "session":
+        times, odom, wheels, valid, total = session_columns(path)
+    elif kind == "telemetry":
+        times, odom, wheels, valid, total = telemetry_columns(path, freq)
+    else:
+        raise ValueError(f"{path} is not a KUKA log")
+    duration, rate, gaps, max_gap = timing_stats(times)
+    poses, trace = wheel_trajectory(wheels)
+    out = {"name": os.path.basename(path),
+           "path": path,
+           "kind": kind,
+           "records": len(times),
+           "duration": duration,
+           "rate": rate,
+           "gaps": gaps,
+           "max_gap": max_gap,
+           "distance": path_length(odom[:, :2]),
+           "wheels_distance": path_length(poses[:, :2]),
+           "trace": trace,
+           "lidar_valid": valid / total if total else float("nan")}
+    if trajectory:
+        out["trajectory"] = poses
+    return out
+
+
+def _analyse_safe(path, freq, trajectory):
+    """
+    analyse_log for pool workers, errors are returned instead of raised
+    """
+    try:
+        return analyse_log(path, freq=freq, trajectory=trajectory)
+    except Exception as err:
+        return {"name": os.path.basename(path), "path": path, "error": f"{type(err).__name__}: {err}"}
+
+
+def find_logs(directory):
+    """
+    :param directory: directory with logs
+    :return: sorted paths of files recognised as logs
+    """
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and log_kind(path):
+            paths.append(path)
+    return paths
+
+
+def analyse_directory(directory, /, workers=None, freq=1, trajectory=False):
+    """
+    Analyses all logs of directory in parallel worker processes
+    :param directory: directory with logs
+    :param workers: number of processes (cpu count by default)
+    :param freq: frequency of text logs
+    :param trajectory: if true results contain trajectories
+    :return: list of analyse_log results (failed logs have "error" key instead of statistics)
+    """
+    paths = find_logs(directory)
+    if not paths:
+        return []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_analyse_safe, paths, [freq] * len(paths), [trajectory] * len(paths)))
+
+
+def format_table(results):
+    """
+    Formats results as aligned summary table
+    :param results: analyse_log results
+    :return: table string
+    """
+    rows = [[title for _, title, _ in SUMMARY_COLUMNS]]
+    for res in results:
+        if "error" not in res:
+            rows.append([fmt.format(res[key]) for key, _, fmt in SUMMARY_COLUMNS])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(SUMMARY_COLUMNS))]
+    lines = ["  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows]
+    for res in results:
+        if "error" in res:
+            lines.append(f"{res['name'].ljust(widths[0])}  {res['error']}")
+    return "\n".join(lines)
+
+
+def write_csv(results, path):
+    """
+    Writes results summary to csv file
+    """
+    with open(path, "w") as file:
+        file.write(",".join(key for key, _, _ in SUMMARY_COLUMNS) + ",error\n")
+        for res in results:
+            file.write(",".join(str(res.get(key, "")) for key, _, _ in SUMMARY_COLUMNS) + f",{res.get('error', '')}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="statistics over a directory of KUKA logs")
+    parser.add_argument("directory", help="directory with telemetry logs and session recordings")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--freq", type=float, default=1, help="frequency text logs were written with")
+    parser.add_argument("--csv", default=None, help="write summary table to csv file")
+    parser.add_argument("--trajectories", default=None, help="save wheel odometry trajectories as .npy to directory")
+    args = parser.parse_args()
+
+    results = analyse_directory(args.directory, workers=args.workers, freq=args.freq,
+                                trajectory=bool(args.trajectories))
+    print(format_table(results))
+    if args.csv:
+        write_csv(results, args.csv)
+    if args.trajectories:
+        os.makedirs(args.trajectories, exist_ok=True)
+        for res in results:
+            if "trajectory" in res:
+                np.save(os.path.join(args.trajectories, res["name"] + ".npy"), res["trajectory"])
+
+
+if __name__ == "__main__":
+    main()
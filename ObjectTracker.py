@@ -1,8 +1,6 @@
 import cv2
 import numpy as np
 
-import time
-
 
 class ObjectTracker:
     def __init__(self, robot, setIsCameraRun):
@@ -69,7 +67,7 @@ class ObjectTracker:
                         if fx < self.center_x - 50:
                             direction_text += "LEFT "
     
-                            self.posX += 1
+                            self.posX = min(self.posX + 1, self.robot.kinematics.m1_range[1])
                             self.robot.move_arm(m1=self.posX)
                             print('left')
                    
@@ -77,7 +75,7 @@ class ObjectTracker:
                         elif fx > self.center_x + 50:
                             direction_text += "RIGHT "
 
-                            self.posX -= 1
+                            self.posX = max(self.posX - 1, self.robot.kinematics.m1_range[0])
                             self.robot.move_arm(m1=self.posX)
                             print(self.posX)
                             print('right')
@@ -88,11 +86,11 @@ class ObjectTracker:
                           if fy < self.center_y:
                               direction_text += "UP"
                               
-                              self.posY -= 2
+                              self.posY = max(self.posY - 2, self.robot.kinematics.lower[2])
                               self.robot.move_arm(m4=self.posY)
                           elif fy > self.center_y:
                               direction_text += "DOWN"
-                              self.posY += 2
+                              self.posY = min(self.posY + 2, self.robot.kinematics.upper[2])
                               self.robot.move_arm(m4=self.posY)
 
                         
@@ -111,7 +109,7 @@ class ObjectTracker:
         if (self.isCameraInitial):
             self.robot.move_arm(m1=195, m2=60, m3=40, m4=20, grip=2)
             self.isCameraInitial = False
-            time.sleep(2)
+            self.robot.wait_arm_reached(timeout=2)
       
 
         frame = self.process_frame()
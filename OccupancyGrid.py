@@ -0,0 +1,139 @@
+import math
+
+import numpy as np
+
+from LidarGeometry import LidarGeometry
+
+
+class OccupancyGrid:
+    """
+    Log-odds occupancy grid built from lidar scans\n
+    Cell [i, j] covers x in [origin_x + j * resolution, origin_x + (j + 1) * resolution) and the same for y with i,
+    so the array can be drawn as image with x to the right and y down
+    """
+
+    def __init__(self, /, resolution=0.05, width=20.0, height=20.0, origin=None,
+                 l_occ=0.85, l_free=-0.4, l_min=-4.0, l_max=4.0, geometry=None):
+        """
+        :param resolution: cell size (m)
+        :param width: map size along x (m)
+        :param height: map size along y (m)
+        :param origin: (x, y) of the map corner, centered around 0 by default
+        :param l_occ: log-odds added to a cell with lidar hit
+        :param l_free: log-odds added to a cell the beam passed through
+        :param l_min: log-odds lower clamp
+        :param l_max: log-odds upper clamp
+        :param geometry: LidarGeometry of the lidar
+        """
+        self.resolution = resolution
+        self.shape = (int(round(height / resolution)), int(round(width / resolution)))
+        self.origin = np.array(origin if origin is not None else (-width / 2, -height / 2), dtype=float)
+        self.l_occ = l_occ
+        self.l_free = l_free
+        self.l_min = l_min
+        self.l_max = l_max
+        self.log_odds = np.zeros(self.shape, dtype=np.float32)
+        self._passed = np.zeros(self.log_odds.size, dtype=bool)
+        self.scans = 0
+        self.geometry = geometry or LidarGeometry()
+        self._steps = None
+
+    def world_to_cell(self, xy):
+        """
+        :param xy: (..., 2) world coordinates
+        :return: (..., 2) integer (row, column), may be out of map
+        """
+        ij = np.floor((np.asarray(xy) - self.origin) / self.resolution).astype(np.int64)
+        return ij[..., ::-1]
+
+    def cell_to_world(self, ij):
+        """
+        :param ij: (..., 2) (row, column)
+        :return: (..., 2) world coordinates of cell centers
+        """
+        return (np.asarray(ij)[..., ::-1] + 0.5) * self.resolution + self.origin
+
+    def update(self, pose, scan, /, step=2):
+        """
+        Integrates one lidar scan: cells along every beam get l_free, cells with hits get l_occ
+        :param pose: [x, y, ang] of the robot when scan was taken
+        :param scan: lidar ranges
+        :param step: use every step-th beam
+        """
+        geometry = self.geometry
+        scan = np.asarray(scan, dtype=np.float32)
+        ranges = scan[::step]
+        hit = geometry.valid(ranges)
+        ranges = np.where(hit, ranges, np.where(ranges >= geometry.r_max, geometry.r_max, 0))
+        origin = geometry.origin(pose)
+        direction = geometry.directions(len(scan), ang=pose[2], step=step)
+
+        # free space: samples every half cell along each beam, up to one cell before the hit
+        if self._steps is None:
+            self._steps = np.arange(0, geometry.r_max, self.resolution / 2, dtype=np.float32)
+        steps = self._steps
+        inside = steps[None, :] < (ranges[:, None] - self.resolution)
+        points = origin + direction[:, None, :] * steps[None, :, None]
+        free = self._flat_indices(points[inside])
+        occ = self._flat_indices(origin + direction[hit] * ranges[hit, None])
+
+        # fancy indexed += applies once per cell even for repeated indices,
+        # cells that are both passed and hit get only l_occ
+        flat = self.log_odds.reshape(-1)
+        self._passed[free] = True
+        flat[free] += self.l_free
+        flat[occ] += self.l_occ - self.l_free * self._passed[occ]
+        self._passed[free] = False
+        np.clip(flat, self.l_min, self.l_max, out=flat)
+        self.scans += 1
+
+    def _flat_indices(self, xy):
+        """
+        :param xy: (N, 2) world points
+        :return: flat indices of cells inside map (with repeats)
+        """
+        ij = self.world_to_cell(xy)
+        valid = (ij[:, 0] >= 0) & (ij[:, 0] < self.shape[0]) & (ij[:, 1] >= 0) & (ij[:, 1] < self.shape[1])
+        ij = ij[valid]
+        return ij[:, 0] * self.shape[1] + ij[:, 1]
+
+    def probability(self):
+        """
+        :return: occupancy probability of every cell (0.5 - unknown)
+        """
+        return 1 / (1 + np.exp(-self.log_odds))
+
+    def occupied(self, threshold=0.65):
+        """
+        :param threshold: occupancy probability threshold
+        :return: bool array of occupied cells
+        """
+        return self.log_odds > math.log(threshold / (1 - threshold))
+
+    def to_image(self):
+        """
+        :return: uint8 gray image, white - free, black - occupied, gray - unknown
+        """
+        return (255 * (1 - self.probability())).astype(np.uint8)
+
+    def save(self, path):
+        """
+        Saves map to .npz file
+        :param path: name and path to file
+        """
+        np.savez_compressed(path, log_odds=self.log_odds, resolution=self.resolution, origin=self.origin)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads map saved with save
+        :param path: name and path to file
+        :return: OccupancyGrid
+        """
+        data = np.load(path)
+        log_odds = data["log_odds"]
+        resolution = float(data["resolution"])
+        grid = cls(resolution=resolution, width=log_odds.shape[1] * resolution,
+                   height=log_odds.shape[0] * resolution, origin=data["origin"])
+        grid.log_odds[:] = log_odds
+        return grid
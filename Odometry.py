@@ -0,0 +1,449 @@
+import bisect
+import math
+import threading as thr
+
+import numpy as np
+
+# youbot base geometry
+WHEEL_RADIUS = 0.0475
+GEOM_FACTOR = (0.47 / 2.0) + (0.3 / 2.0)
+
+
+def wheels_to_pose(pose, last_wheel_positions, wheel_positions):
+    """
+    Converts wheels transition to cartesian position
+    :param pose: [x, y, ang] before transition
+    :param last_wheel_positions: previous positions of 4 wheels
+    :param wheel_positions: current positions of 4 wheels
+    :return: new [x, y, ang], trace (sum of absolute wheel transitions)
+    """
+    wheel_radius_per4 = WHEEL_RADIUS / 4.0
+    x, y, ang = pose
+
+    delta_positionW1 = (wheel_positions[0] - last_wheel_positions[0])
+    delta_positionW2 = (wheel_positions[1] - last_wheel_positions[1])
+    delta_positionW3 = (wheel_positions[2] - last_wheel_positions[2])
+    delta_positionW4 = (wheel_positions[3] - last_wheel_positions[3])
+    trace = abs(delta_positionW1) + abs(delta_positionW2) + abs(delta_positionW3) + abs(delta_positionW4)
+    deltaLongitudinalPos = (delta_positionW1 + delta_positionW2 + delta_positionW3 + delta_positionW4) * wheel_radius_per4
+    deltaTransversalPos = (-delta_positionW1 + delta_positionW2 + delta_positionW3 - delta_positionW4) * wheel_radius_per4
+    ang -= (-delta_positionW1 + delta_positionW2 - delta_positionW3 + delta_positionW4) * (
+            wheel_radius_per4 / GEOM_FACTOR)
+
+    ang = (abs(ang + 2 * math.pi)) % (2 * math.pi)
+
+    x += deltaLongitudinalPos * math.cos(ang) + deltaTransversalPos * math.sin(ang)
+    y += deltaLongitudinalPos * math.sin(ang) - deltaTransversalPos * math.cos(ang)
+    return [x, y, ang], trace
+
+
+def integrate_wheels(wheels, pose=(0, 0, 0), last_wheels=None):
+    """
+    Batch version of wheels_to_pose: integrates whole wheel position sequence at once
+    :param wheels: (N, 4) wheel positions
+    :param pose: [x, y, ang] before first sample
+    :param last_wheels: wheel positions pose corresponds to (first sample if None)
+    :return: (N, 3) poses [x, y, ang] after each sample, trace of whole sequence
+    """
+    wheels = np.asarray(wheels, dtype=float).reshape(-1, 4)
+    wheel_radius_per4 = WHEEL_RADIUS / 4.0
+    d = np.diff(wheels, axis=0, prepend=wheels[:1] if last_wheels is None else [last_wheels])
+    d_long = (d[:, 0] + d[:, 1] + d[:, 2] + d[:, 3]) * wheel_radius_per4
+    d_trans = (-d[:, 0] + d[:, 1] + d[:, 2] - d[:, 3]) * wheel_radius_per4
+    d_ang = (-d[:, 0] + d[:, 1] - d[:, 2] + d[:, 3]) * (wheel_radius_per4 / GEOM_FACTOR)
+    # unwrapped heading after each sample, wrapped only for output
+    ang = pose[2] - np.cumsum(d_ang)
+    cos = np.cos(ang)
+    sin = np.sin(ang)
+    out = np.empty((len(wheels), 3))
+    out[:, 0] = pose[0] + np.cumsum(d_long * cos + d_trans * sin)
+    out[:, 1] = pose[1] + np.cumsum(d_long * sin - d_trans * cos)
+    out[:, 2] = np.mod(ang, 2 * math.pi)
+    return out, float(np.abs(d).sum())
+
+
+def rigid_transform(pose_from, pose_to):
+    """
+    :param pose_from: [x, y, ang]
+    :param pose_to: [x, y, ang]
+    :return: dx, dy, d_ang of the transform that maps pose_from to pose_to (rotation about the origin first)
+    """
+    d_ang = wrap_angle(pose_to[2] - pose_from[2])
+    cos, sin = math.cos(d_ang), math.sin(d_ang)
+    return (pose_to[0] - (cos * pose_from[0] - sin * pose_from[1]),
+            pose_to[1] - (sin * pose_from[0] + cos * pose_from[1]), d_ang)
+
+
+def wrap_angle(ang):
+    """
+    :param ang: angle in radians
+    :return: angle in range [-pi, pi)
+    """
+    return (ang + math.pi) % (2 * math.pi) - math.pi
+
+
+class PoseEstimator:
+    """
+    Wheel odometry pose estimator\n
+    Wheel samples are integrated one by one under internal lock in time order (stale samples are dropped,
+    wheel positions are absolute so the newer sample already contains their motion).
+    Every update publishes immutable (time, x, y, ang) tuple, so readers never see half-updated pose
+    """
+
+    def __init__(self, pose=(0, 0, 0), /, history=256, max_extrapolation=0.5):
+        """
+        :param pose: initial [x, y, ang]
+        :param history: number of stamped poses kept for interpolation
+        :param max_extrapolation: poses are extrapolated at most for this time (seconds) past the last sample
+        """
+        self.history = history
+        self.max_extrapolation = max_extrapolation
+        self.trace = 0
+        self.samples = 0
+        self.skipped = 0  # stale samples
+        self.corrections = 0
+        self._lock = thr.Lock()
+        self._wheels_old = None
+        self._pose = list(pose)
+        self._ang_unwrapped = pose[2]
+        self._times = []
+        self._poses = []  # (x, y, unwrapped ang)
+        self._stamped = (None, *pose)
+
+    def reset(self, pose=(0, 0, 0)):
+        """
+        Sets current pose, keeps wheel reference
+        :param pose: [x, y, ang]
+        """
+        self._lock.acquire()
+        self._pose = list(pose)
+        self._ang_unwrapped = pose[2]
+        self._times = []
+        self._poses = []
+        self._stamped = (self._stamped[0], *pose)
+        self._lock.release()
+
+    def correct(self, pose_from, pose_to):
+        """
+        Moves current pose and pose history by rigid transform that maps pose_from to pose_to
+        (corrections from scan matching or localization)
+        :param pose_from: [x, y, ang] as estimated by wheel odometry
+        :param pose_to: corrected [x, y, ang]
+        """
+        dx, dy, d_ang = rigid_transform(pose_from, pose_to)
+        cos, sin = math.cos(d_ang), math.sin(d_ang)
+        self._lock.acquire()
+        self._poses = [(cos * x - sin * y + dx, sin * x + cos * y + dy, ang + d_ang) for x, y, ang in self._poses]
+        x, y, ang = self._pose
+        self._pose = [cos * x - sin * y + dx, sin * x + cos * y + dy, (ang + d_ang) % (2 * math.pi)]
+        self._ang_unwrapped += d_ang
+        self._stamped = (self._stamped[0], *self._pose)
+        self.corrections += 1
+        self._lock.release()
+
+    def _publish(self, stamp):
+        self._times.append(stamp)
+        self._poses.append((self._pose[0], self._pose[1], self._ang_unwrapped))
+        if len(self._times) > 2 * self.history:
+            del self._times[:self.history]
+            del self._poses[:self.history]
+        self._stamped = (stamp, *self._pose)
+
+    def update(self, stamp, wheels):
+        """
+        Integrates wheel sample
+        :param stamp: sample time (seconds)
+        :param wheels: positions of 4 wheels
+        :return: False if sample was older than the last one and was dropped
+        """
+        self._lock.acquire()
+        if self._times and stamp < self._times[-1]:
+            self.skipped += 1
+            self._lock.release()
+            return False
+        if self._wheels_old is not None:
+            old_ang = self._pose[2]
+            self._pose, trace = wheels_to_pose(self._pose, self._wheels_old, wheels)
+            self._ang_unwrapped += wrap_angle(self._pose[2] - old_ang)
+            self.trace += trace
+        self._wheels_old = wheels
+        self.samples += 1
+        self._publish(stamp)
+        self._lock.release()
+        return True
+
+    def update_batch(self, stamps, wheels):
+        """
+        Integrates sequence of wheel samples at once (see integrate_wheels)
+        :param stamps: (N,) sample times
+        :param wheels: (N, 4) wheel positions
+        """
+        if not len(wheels):
+            return
+        self._lock.acquire()
+        poses, trace = integrate_wheels(wheels, self._pose, self._wheels_old)
+        unwrapped = self._ang_unwrapped + np.cumsum(wrap_angle(np.diff(poses[:, 2], prepend=self._pose[2])))
+        self.trace += trace
+        self.samples += len(wheels)
+        self._wheels_old = np.asarray(wheels[-1], dtype=float).tolist()
+        start = max(0, len(wheels) - self.history)
+        self._times.extend(map(float, stamps[start:]))
+        self._poses.extend(zip(poses[start:, 0].tolist(), poses[start:, 1].tolist(), unwrapped[start:].tolist()))
+        self._pose = poses[-1].tolist()
+        self._ang_unwrapped = float(unwrapped[-1])
+        del self._times[:-self.history]
+        del self._poses[:-self.history]
+        self._stamped = (self._times[-1], *self._pose)
+        self._lock.release()
+
+    @property
+    def pose(self):
+        """
+        :return: latest [x, y, ang]
+        """
+        return list(self._stamped[1:])
+
+    @property
+    def stamped_pose(self):
+        """
+        :return: latest (time, x, y, ang)
+        """
+        return self._stamped
+
+    def pose_at(self, stamp):
+        """
+        Interpolates pose between wheel samples or extrapolates it past the last one
+        :param stamp: time (seconds)
+        :return: [x, y, ang]
+        """
+        self._lock.acquire()
+        times = self._times
+        n = len(times)
+        if n < 2:
+            self._lock.release()
+            return self.pose
+        i = bisect.bisect_left(times, stamp)
+        if i == 0:
+            t0, t1, p0, p1 = times[0], times[1], self._poses[0], self._poses[1]
+            stamp = t0
+        elif i >= n:
+            t0, t1, p0, p1 = times[-2], times[-1], self._poses[-2], self._poses[-1]
+            stamp = min(stamp, t1 + self.max_extrapolation)
+        else:
+            t0, t1, p0, p1 = times[i - 1], times[i], self._poses[i - 1], self._poses[i]
+        self._lock.release()
+        k = (stamp - t0) / (t1 - t0) if t1 > t0 else 1.0
+        return [p0[0] + (p1[0] - p0[0]) * k,
+                p0[1] + (p1[1] - p0[1]) * k,
+                (p0[2] + (p1[2] - p0[2]) * k) % (2 * math.pi)]
+
+
+class OdometryFilter:
+    """
+    Extended Kalman filter fusing .odom# poses with wheel odometry\n
+    State [x, y, ang, vx, vy, w] (velocities in odometry frame) with constant velocity model.
+    .odom# messages are pose measurements, wheel odometry steps are body frame velocity measurements,
+    so the wheel estimator may start from any origin. Corrections (scan matching, localization) move the state
+    by a rigid transform, later .odom# poses are moved by the same transform.
+    Every update publishes immutable (time, pose, velocity, covariance) snapshot
+    """
+
+    def __init__(self, /, odom_std=(0.01, 0.01, 0.02), wheels_std=(0.05, 0.05, 0.1),
+                 acc_std=0.5, ang_acc_std=1.0, min_wheels_dt=0.005):
+        """
+        :param odom_std: standard deviation of .odom# x, y (m) and ang (rad)
+        :param wheels_std: standard deviation of wheel forward, sideways (m/s) and angular (rad/s) speed
+        :param acc_std: process noise, linear acceleration (m/s^2)
+        :param ang_acc_std: process noise, angular acceleration (rad/s^2)
+        :param min_wheels_dt: wheel steps shorter than this (seconds) are accumulated
+        """
+        self.R_odom = np.diag(np.square(odom_std))
+        self.R_wheels = np.diag(np.square(wheels_std))
+        self.acc_var = acc_std ** 2
+        self.ang_acc_var = ang_acc_std ** 2
+        self.min_wheels_dt = min_wheels_dt
+        self.updates = 0
+        self.skipped = 0  # measurements older than filter time
+        self._lock = thr.Lock()
+        self._x = np.zeros(6)
+        self._P = np.diag([1e3, 1e3, 1e3, 1.0, 1.0, 1.0])
+        self._t = None
+        self._odom_initialised = False
+        self._wheels_ref = None  # (time, pose) the next wheel step is measured from
+        self._frame = None  # (dx, dy, d_ang) from .odom# frame to corrected frame, None - not corrected
+        self._snapshot = (None, [0.0, 0.0, 0.0], [0.0, 0.0, 0.0], self._P.copy())
+
+    def reset_wheels(self):
+        """
+        Drops wheel step reference, call it after wheel pose estimator was corrected
+        """
+        self._lock.acquire()
+        self._wheels_ref = None
+        self._lock.release()
+
+    def reset(self, pose):
+        """
+        Moves fused pose to pose (corrections from scan matching or localization) by a rigid transform,
+        velocity and uncertainty are rotated with the frame
+        :param pose: corrected [x, y, ang]
+        """
+        self._lock.acquire()
+        dx, dy, d_ang = rigid_transform(self._x[:3].tolist(), pose)
+        cos, sin = math.cos(d_ang), math.sin(d_ang)
+        J = np.eye(6)
+        J[0:2, 0:2] = J[3:5, 3:5] = [[cos, -sin], [sin, cos]]
+        self._x = J @ self._x
+        self._x[0] += dx
+        self._x[1] += dy
+        self._x[2] = (self._x[2] + d_ang) % (2 * math.pi)
+        self._P = J @ self._P @ J.T
+        # composed with the previous correction: .odom# -> previous frame -> new frame
+        if self._frame is None:
+            self._frame = (dx, dy, d_ang)
+        else:
+            fx, fy, f_ang = self._frame
+            self._frame = (cos * fx - sin * fy + dx, sin * fx + cos * fy + dy, f_ang + d_ang)
+        self._publish()
+        self._lock.release()
+
+    def _odom_to_frame(self, odom):
+        """
+        :return: .odom# pose in corrected frame
+        """
+        if self._frame is None:
+            return np.array(odom[:3], dtype=float)
+        dx, dy, d_ang = self._frame
+        cos, sin = math.cos(d_ang), math.sin(d_ang)
+        return np.array([cos * odom[0] - sin * odom[1] + dx, sin * odom[0] + cos * odom[1] + dy,
+                         (odom[2] + d_ang) % (2 * math.pi)])
+
+    def _predict(self, stamp):
+        """
+        Moves state to stamp
+        :return: False if stamp is older than filter time
+        """
+        if self._t is None:
+            self._t = stamp
+            return True
+        dt = stamp - self._t
+        if dt < 0:
+            return False
+        if dt > 0:
+            F = np.eye(6)
+            F[0, 3] = F[1, 4] = F[2, 5] = dt
+            self._x = F @ self._x
+            q = np.array([self.acc_var, self.acc_var, self.ang_acc_var])
+            Q = np.zeros((6, 6))
+            Q[:3, :3] = np.diag(q * dt ** 4 / 4)
+            Q[:3, 3:] = Q[3:, :3] = np.diag(q * dt ** 3 / 2)
+            Q[3:, 3:] = np.diag(q * dt ** 2)
+            self._P = F @ self._P @ F.T + Q
+            self._t = stamp
+        return True
+
+    def _correct(self, innovation, H, R):
+        S = H @ self._P @ H.T + R
+        K = np.linalg.solve(S, H @ self._P).T
+        self._x = self._x + K @ innovation
+        self._x[2] %= 2 * math.pi
+        # Joseph form keeps covariance symmetric positive definite
+        I_KH = np.eye(6) - K @ H
+        self._P = I_KH @ self._P @ I_KH.T + K @ R @ K.T
+        self.updates += 1
+
+    def _publish(self):
+        self._snapshot = (self._t, self._x[:3].tolist(), self._x[3:].tolist(), self._P.copy())
+
+    def update_odom(self, stamp, odom):
+        """
+        Fuses .odom# pose
+        :param stamp: message time (seconds)
+        :param odom: [x, y, ang]
+        """
+        self._lock.acquire()
+        if not self._predict(stamp):
+            self.skipped += 1
+        elif not self._odom_initialised:
+            if self._frame is None:
+                # first absolute pose defines the frame
+                self._x[:3] = odom[:3]
+                self._x[2] %= 2 * math.pi
+                self._P[:3, :3] = self.R_odom
+            else:
+                # filter was corrected before the first .odom#, it is mapped to the corrected pose
+                self._frame = rigid_transform(odom, self._x[:3].tolist())
+            self._odom_initialised = True
+            self._publish()
+        else:
+            H = np.zeros((3, 6))
+            H[:, :3] = np.eye(3)
+            innovation = self._odom_to_frame(odom) - self._x[:3]
+            innovation[2] = wrap_angle(innovation[2])
+            self._correct(innovation, H, self.R_odom)
+            self._publish()
+        self._lock.release()
+
+    def update_wheels(self, stamp, pose):
+        """
+        Fuses wheel odometry step between previous and current wheel pose
+        :param stamp: wheel sample time (seconds)
+        :param pose: [x, y, ang] from wheel pose estimator
+        """
+        self._lock.acquire()
+        if self._wheels_ref is None:
+            self._wheels_ref = (stamp, pose)
+            self._lock.release()
+            return
+        t0, pose0 = self._wheels_ref
+        dt = stamp - t0
+        if dt < self.min_wheels_dt:
+            self._lock.release()
+            return
+        self._wheels_ref = (stamp, pose)
+        if not self._predict(stamp):
+            self.skipped += 1
+            self._lock.release()
+            return
+        # displacement in robot frame (wheel odometry moves along its new heading)
+        dx, dy = pose[0] - pose0[0], pose[1] - pose0[1]
+        cos, sin = math.cos(pose[2]), math.sin(pose[2])
+        z = np.array([cos * dx + sin * dy, -sin * dx + cos * dy, wrap_angle(pose[2] - pose0[2])]) / dt
+        ang = self._x[2]
+        vx, vy = self._x[3], self._x[4]
+        cos, sin = math.cos(ang), math.sin(ang)
+        v_fwd = cos * vx + sin * vy
+        v_side = -sin * vx + cos * vy
+        H = np.array([[0, 0, v_side, cos, sin, 0],
+                      [0, 0, -v_fwd, -sin, cos, 0],
+                      [0, 0, 0, 0, 0, 1]])
+        self._correct(z - np.array([v_fwd, v_side, self._x[5]]), H, self.R_wheels)
+        self._publish()
+        self._lock.release()
+
+    @property
+    def pose(self):
+        """
+        :return: fused [x, y, ang]
+        """
+        return self._snapshot[1]
+
+    @property
+    def velocity(self):
+        """
+        :return: [vx, vy, w] in odometry frame
+        """
+        return self._snapshot[2]
+
+    @property
+    def covariance(self):
+        """
+        :return: 6x6 state covariance (x, y, ang, vx, vy, w)
+        """
+        return self._snapshot[3]
+
+    @property
+    def stamped(self):
+        """
+        :return: (time, pose, velocity, covariance) of the last update
+        """
+        return self._snapshot
@@ -0,0 +1,231 @@
+import heapq
+import math
+
+import cv2
+import numpy as np
+
+ROBOT_RADIUS = 0.35  # half of the base diagonal (m)
+
+
+class GridPlanner:
+    """
+    A* path planner on occupancy grid\n
+    Obstacles are inflated by robot radius with one distance transform, cells closer than robot radius
+    are not passable and cells within safety distance from them are more expensive, so paths keep away from walls.
+    A* runs on cells of search_resolution (every cell keeps the smallest obstacle distance of the map cells
+    it covers), the found path is shortened on the full resolution map.
+    Maps are recomputed only when the grid got new scans, a planned path is kept until the map change blocks it
+    """
+
+    def __init__(self, grid, /, robot_radius=ROBOT_RADIUS, safety_distance=0.3, cost_factor=4.0, threshold=0.65,
+                 search_resolution=0.1):
+        """
+        :param grid: OccupancyGrid
+        :param robot_radius: cells closer than this to obstacles are not passable (m)
+        :param safety_distance: cells within this distance from inflated obstacles are more expensive (m)
+        :param cost_factor: extra step cost next to inflated obstacles (decreases linearly to 0 at safety distance)
+        :param threshold: occupancy probability of obstacles (unknown cells are passable)
+        :param search_resolution: A* cell size (m), multiple of grid resolution
+        """
+        self.grid = grid
+        self.robot_radius = robot_radius
+        self.safety_distance = safety_distance
+        self.cost_factor = cost_factor
+        self.threshold = threshold
+        self.factor = max(1, int(round(search_resolution / grid.resolution)))
+        self.path = None  # last planned path, list of [x, y]
+        self.goal = None
+        self.plans = 0
+        self.expanded = 0  # cells expanded by the last search
+        self._scans = None
+        self.distance = None
+        self.blocked = None
+        self.cost = None
+        self._search_maps = None
+        self.update()
+
+    def update(self):
+        """
+        Recomputes obstacle distance and cost maps if the grid changed
+        :return: True if maps were recomputed
+        """
+        if self._scans == self.grid.scans and self.distance is not None:
+            return False
+        self._scans = self.grid.scans
+        free = np.where(self.grid.occupied(self.threshold), 0, 255).astype(np.uint8)
+        self.distance = cv2.distanceTransform(free, cv2.DIST_L2, cv2.DIST_MASK_PRECISE) * self.grid.resolution
+        self.blocked = self._blocked(self.distance)
+        self.cost = self._cost(self.distance)
+
+        # search maps, flat lists are faster than arrays for per cell access
+        f = self.factor
+        height, width = self.distance.shape[0] // f, self.distance.shape[1] // f
+        distance = self.distance[:height * f, :width * f].reshape(height, f, width, f).min(axis=(1, 3))
+        # half of the cost, step cost is the mean of two cells
+        self._search_maps = (width, self._blocked(distance).ravel().tolist(),
+                             (0.5 * self._cost(distance)).ravel().tolist(), distance.ravel().tolist())
+        return True
+
+    def _blocked(self, distance):
+        """
+        :return: not passable cells, map border is not passable, so neighbour indices never wrap
+        """
+        blocked = distance < self.robot_radius
+        blocked[[0, -1], :] = True
+        blocked[:, [0, -1]] = True
+        return blocked
+
+    def _cost(self, distance):
+        """
+        :return: step cost factor of cells
+        """
+        near = np.clip((self.robot_radius + self.safety_distance - distance) / self.safety_distance, 0, 1)
+        return (1 + self.cost_factor * near).astype(np.float32)
+
+    def plan(self, start, goal):
+        """
+        Plans path between world points
+        :param start: [x, y] (robot pose can be passed as is)
+        :param goal: [x, y]
+        :return: list of [x, y] waypoints without start, ending exactly at goal, or None if goal is unreachable
+        """
+        self.update()
+        self.goal = [float(goal[0]), float(goal[1])]
+        self.path = None
+        height, width = self.grid.shape
+        f = self.factor
+        (si, sj), (gi, gj) = self.grid.world_to_cell([start[:2], goal[:2]])
+        if not (0 < si < height - 1 and 0 < sj < width - 1 and 0 < gi < height - 1 and 0 < gj < width - 1) \
+                or self.blocked[gi, gj]:
+            return None
+        search_width = self._search_maps[0]
+        cells = self._search(si // f * search_width + sj // f, gi // f * search_width + gj // f)
+        self.plans += 1
+        if cells is None:
+            return None
+        # search cells to map cells in their middle, path starts and ends in the exact cells
+        ij = np.column_stack(np.divmod(cells, search_width)) * f + f // 2
+        ij = np.concatenate([[[si, sj]], ij[1:-1], [[gi, gj]]])
+        ij = self._shortcut(ij)
+        self.path = [list(map(float, p)) for p in self.grid.cell_to_world(ij[1:-1])] + [self.goal]
+        return self.path
+
+    def _search(self, start, goal):
+        """
+        A* over flat search cell indices, 8-connected, step cost is the mean cost of the two cells,
+        goal cell is entered even if it is blocked
+        :return: list of flat indices from start to goal or None
+        """
+        width, blocked, half_cost, distance = self._search_maps
+        n_cells = len(blocked)
+        g = [math.inf] * n_cells
+        parent = [-1] * n_cells
+        closed = bytearray(n_cells)
+        gi, gj = divmod(goal, width)
+        sqrt2 = math.sqrt(2)
+        neighbours = [(1, 1.0), (-1, 1.0), (width, 1.0), (-width, 1.0),
+                      (width + 1, sqrt2), (width - 1, sqrt2), (-width + 1, sqrt2), (-width - 1, sqrt2)]
+        push, pop = heapq.heappush, heapq.heappop
+        g[start] = 0.0
+        heap = [(0.0, start)]
+        expanded = 0
+        while heap:
+            _, cur = pop(heap)
+            if closed[cur]:
+                continue
+            if cur == goal:
+                break
+            closed[cur] = 1
+            expanded += 1
+            g_cur = g[cur]
+            cost_cur = half_cost[cur]
+            # robot may leave inflated area it starts in (moving away from obstacles), but never enters it,
+            # except for the goal cell: plan checked the goal on the full resolution map
+            escaping = blocked[cur]
+            for offset, step in neighbours:
+                n = cur + offset
+                if closed[n] or blocked[n] and n != goal and not (escaping and distance[n] > distance[cur]):
+                    continue
+                g_n = g_cur + step * (cost_cur + half_cost[n])
+                if g_n < g[n]:
+                    g[n] = g_n
+                    parent[n] = cur
+                    di = abs(n // width - gi)
+                    dj = abs(n % width - gj)
+                    # octile distance, admissible because cost is at least 1
+                    push(heap, (g_n + di + dj + (sqrt2 - 2) * (di if di < dj else dj), n))
+        self.expanded = expanded
+        if g[goal] == math.inf:
+            return None
+        cells = [goal]
+        while cells[-1] != start:
+            cells.append(parent[cells[-1]])
+        return cells[::-1]
+
+    def _shortcut(self, ij):
+        """
+        Removes intermediate cells while the straight segment stays in free cells no more expensive
+        than the skipped part of the path
+        :param ij: (N, 2) map cells of the path
+        :return: (M, 2) kept cells
+        """
+        cost = self.cost[ij[:, 0], ij[:, 1]]
+        kept = [0]
+        anchor = 0
+        while anchor < len(ij) - 1:
+            nxt = anchor + 1
+            max_cost = cost[anchor]
+            for j in range(anchor + 2, len(ij)):
+                max_cost = max(max_cost, cost[j - 1])
+                if not self._visible(ij[anchor], ij[j], max(max_cost, cost[j])):
+                    break
+                nxt = j
+            kept.append(nxt)
+            anchor = nxt
+        return ij[kept]
+
+    def _visible(self, a, b, max_cost):
+        """
+        :return: True if segment between cells a and b crosses only passable cells with cost not above max_cost
+        """
+        n = 2 * int(max(abs(b[0] - a[0]), abs(b[1] - a[1]))) + 1
+        i = np.rint(np.linspace(a[0], b[0], n)).astype(np.int64)
+        j = np.rint(np.linspace(a[1], b[1], n)).astype(np.int64)
+        return not self.blocked[i, j].any() and self.cost[i, j].max() <= max_cost + 1e-6
+
+    def path_blocked(self, start, path=None):
+        """
+        Checks the path against current maps
+        :param start: current [x, y]
+        :param path: list of [x, y], last planned path by default
+        :return: True if any segment of the path crosses not passable cells (inflated area the robot
+            is in is ignored)
+        """
+        path = self.path if path is None else path
+        if not path:
+            return False
+        points = np.array([start[:2]] + [p[:2] for p in path], dtype=float)
+        length = np.hypot(*np.diff(points, axis=0).T)
+        samples = []
+        for a, b, d in zip(points, points[1:], length):
+            n = int(d / (self.grid.resolution / 2)) + 1
+            samples.append(a + (b - a) * np.linspace(0, 1, n + 1)[1:, None])
+        ij = self.grid.world_to_cell(np.concatenate(samples))
+        height, width = self.grid.shape
+        inside = (ij[:, 0] >= 0) & (ij[:, 0] < height) & (ij[:, 1] >= 0) & (ij[:, 1] < width)
+        if not inside.all():
+            return True
+        blocked = self.blocked[ij[:, 0], ij[:, 1]]
+        # samples near the robot inside the inflated area it starts in are allowed
+        free = np.flatnonzero(~blocked)
+        return bool(free.size and blocked[free[0]:].any()) or not free.size
+
+    def replan(self, start):
+        """
+        Incremental replanning: updates maps and plans again only if the map changed and blocked the last path
+        :param start: current [x, y]
+        :return: new path or None if it was not changed (path is None as well if goal became unreachable)
+        """
+        if self.goal is None or not self.update() or not self.path_blocked(start):
+            return None
+        return self.plan(start, self.goal)
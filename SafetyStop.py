@@ -0,0 +1,124 @@
+import math
+import time
+
+import numpy as np
+
+from LidarGeometry import LidarGeometry
+
+BASE_LENGTH = 0.58  # youBot base footprint (m)
+BASE_WIDTH = 0.38
+
+
+class SafetyStop:
+    """
+    Lidar safety check of base commands\n
+    Scan points are converted to robot frame once per scan. Every command is checked against the points
+    in a cone along the commanded motion direction: the cone starts at the footprint, widens with distance
+    and reaches as far as the robot needs to stop from the commanded speed. Translation is scaled down
+    to the speed the robot can still stop from before the nearest point in the cone, rotation is not changed
+    (the lidar sees only the front half, motion to the back is not checked).
+    Without a scan or with a scan older than max_scan_age translation is stopped
+    """
+
+    def __init__(self, /, max_acc=0.5, reaction_time=0.1, stop_distance=0.05, side_margin=0.05, cone_angle=15,
+                 max_scan_age=0.5, length=BASE_LENGTH, width=BASE_WIDTH, geometry=None):
+        """
+        :param max_acc: deceleration the robot is assumed to brake with (m/s^2)
+        :param reaction_time: time until the command takes effect (s), distance moved in it is added to the cone
+        :param stop_distance: gap (m) to the nearest point at which the translation is stopped
+        :param side_margin: gap (m) added to footprint sides
+        :param cone_angle: half angle of the cone widening (degrees)
+        :param max_scan_age: scans older than this (s) are not used, translation is stopped
+        :param length: footprint length (m)
+        :param width: footprint width (m)
+        :param geometry: LidarGeometry of the lidar
+        """
+        self.max_acc = max_acc
+        self.reaction_time = reaction_time
+        self.stop_distance = stop_distance
+        self.side_margin = side_margin
+        self.tan_cone = math.tan(math.radians(cone_angle))
+        self.max_scan_age = max_scan_age
+        self.half_length = length / 2
+        self.half_width = width / 2
+        self.geometry = geometry or LidarGeometry()
+        self.commands = 0
+        self.scaled = 0  # commands with reduced translation
+        self.stopped = 0  # commands with translation zeroed
+        self.stale = 0  # commands stopped because there was no fresh scan
+        self.time_max = 0.0  # longest check (s)
+        self.last_scale = 1.0
+        self._scan = None
+        self._scan_time = None
+        self._points = np.zeros((0, 2))
+        self._points_scan = None  # scan the points were converted from
+
+    def set_scan(self, scan, stamp=None):
+        """
+        Sets new scan, it is converted to robot frame points by the first check that uses it
+        :param scan: lidar ranges
+        :param stamp: time.perf_counter() time the scan was received
+        """
+        self._scan = scan
+        self._scan_time = time.perf_counter() if stamp is None else stamp
+
+    def check(self, f, s, r, /):
+        """
+        Limits base command by the latest scan
+        :param f: forward speed (m/s)
+        :param s: sideways speed (m/s), to the right
+        :param r: rotation speed
+        :return: allowed f, s, r
+        """
+        start = time.perf_counter()
+        self.commands += 1
+        speed = math.hypot(f, s)
+        if not speed:
+            self.last_scale = 1.0
+            return f, s, r
+        scan = self._scan
+        if not scan or start - self._scan_time > self.max_scan_age:
+            # no fresh scan, obstacles can not be seen
+            self.stale += 1
+            self.stopped += 1
+            self.last_scale = 0.0
+            return 0.0, 0.0, r
+        if scan is not self._points_scan:
+            self._points = self.geometry.valid_points(scan)
+            self._points_scan = scan
+        if not len(self._points):
+            self.last_scale = 1.0
+            return f, s, r
+        # motion direction in robot frame (y to the left)
+        ux, uy = f / speed, -s / speed
+        # footprint extent along and across the direction
+        front = self.half_length * abs(ux) + self.half_width * abs(uy)
+        side = self.half_length * abs(uy) + self.half_width * abs(ux) + self.side_margin
+        reach = speed ** 2 / (2 * self.max_acc) + speed * self.reaction_time + self.stop_distance
+
+        points = self._points
+        along = points[:, 0] * ux + points[:, 1] * uy - front
+        across = np.abs(points[:, 1] * ux - points[:, 0] * uy)
+        in_cone = (along > -front) & (along < reach) & (across < side + np.maximum(along, 0) * self.tan_cone)
+        scale = 1.0
+        if in_cone.any():
+            gap = along[in_cone].min() - self.reaction_time * speed - self.stop_distance
+            allowed = math.sqrt(2 * self.max_acc * gap) if gap > 0 else 0.0
+            if allowed < speed:
+                scale = allowed / speed
+                if scale:
+                    self.scaled += 1
+                else:
+                    self.stopped += 1
+        self.last_scale = scale
+        self.time_max = max(self.time_max, time.perf_counter() - start)
+        return f * scale, s * scale, r
+
+    @property
+    def stats(self):
+        """
+        :return: dict with numbers of checked, scaled, stopped commands, commands stopped for lack
+            of a fresh scan and the longest check time (s)
+        """
+        return {"commands": self.commands, "scaled": self.scaled, "stopped": self.stopped, "stale": self.stale,
+                "time_max": self.time_max}
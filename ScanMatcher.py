@@ -0,0 +1,226 @@
+import math
+
+import cv2
+import numpy as np
+
+from LidarGeometry import LidarGeometry
+
+NORMAL_NEIGHBOURS = 2  # keyframe normals are taken from points this far along the scan on both sides
+NORMAL_MAX_SPAN = 0.4  # no normal if these points are farther apart (m), they are on different surfaces
+NORMAL_MAX_OFFSET = 0.02  # or if the point is farther than this (m) from the line through them
+POINT_WEIGHT = 0.05  # weight of point-to-point pairs when point-to-line pairs are available
+
+
+def transform_points(points, pose):
+    """
+    :param points: (N, 2) points in robot frame
+    :param pose: [x, y, ang] of the robot
+    :return: (N, 2) points in world frame
+    """
+    cos, sin = math.cos(pose[2]), math.sin(pose[2])
+    out = np.empty_like(points)
+    out[:, 0] = points[:, 0] * cos - points[:, 1] * sin + pose[0]
+    out[:, 1] = points[:, 0] * sin + points[:, 1] * cos + pose[1]
+    return out
+
+
+class ScanMatcher:
+    """
+    ICP of lidar scans against reference points\n
+    Reference points are rasterized and the distance transform with labels stores the nearest reference point
+    of every raster cell, so every nearest neighbour query is a single array lookup.
+    Reference points with normals are matched point-to-line, the others point-to-point.
+    By default the reference is the last keyframe scan (consecutive scan matching),
+    set_reference_grid switches to matching against occupancy grid
+    """
+
+    def __init__(self, /, resolution=0.02, max_distance=0.3, max_iterations=30, tolerance=1e-4, min_points=50,
+                 step=2, keyframe_distance=0.3, keyframe_angle=0.3, max_failures=3, geometry=None):
+        """
+        :param resolution: nearest neighbour raster cell size (m)
+        :param max_distance: point pairs farther than this (m) are rejected
+        :param max_iterations: ICP iterations limit
+        :param tolerance: ICP stops when step is smaller than this (m and rad)
+        :param min_points: match fails if fewer point pairs are found
+        :param step: use every step-th beam
+        :param keyframe_distance: reference scan is replaced after robot moved this distance (m)
+        :param keyframe_angle: or turned by this angle (rad)
+        :param max_failures: after this many failed matches in a row the keyframe is taken anew
+            at the odometry pose (robot moved too far from the old one)
+        :param geometry: LidarGeometry of the lidar
+        """
+        self.resolution = resolution
+        self.max_distance = max_distance
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.min_points = min_points
+        self.step = step
+        self.keyframe_distance = keyframe_distance
+        self.keyframe_angle = keyframe_angle
+        self.max_failures = max_failures
+        self.geometry = geometry or LidarGeometry()
+        self.keyframes = True
+        self.keyframe_pose = None
+        self.matches = 0
+        self.failures = 0
+        self.failures_in_row = 0
+        self.rekeyframes = 0  # keyframes taken after failed matches
+        self.last_rms = None
+        self._reference = None
+        self._corner = None
+        self._nearest = None
+        self._normals = None
+
+    def set_reference(self, points, normals=None):
+        """
+        Builds nearest neighbour raster of reference points
+        :param points: (N, 2) world points
+        :param normals: (N, 2) unit normals of surfaces at points (nan if unknown) or None
+        """
+        points = np.asarray(points, dtype=float)
+        if normals is None:
+            normals = np.full(points.shape, np.nan)
+        self._normals = normals
+        margin = self.max_distance + self.resolution
+        self._corner = points.min(axis=0) - margin
+        cols, rows = np.ceil((points.max(axis=0) + margin - self._corner) / self.resolution).astype(int) + 1
+        ij = np.floor((points - self._corner) / self.resolution).astype(np.int64)
+        image = np.ones((rows, cols), dtype=np.uint8)
+        image[ij[:, 1], ij[:, 0]] = 0
+        owner = np.zeros((rows, cols), dtype=np.int32)
+        owner[ij[:, 1], ij[:, 0]] = np.arange(len(points))
+        # every pixel gets label of the nearest zero pixel, zero pixel labels are mapped to their points
+        _, labels = cv2.distanceTransformWithLabels(image, cv2.DIST_L2, 5, labelType=cv2.DIST_LABEL_PIXEL)
+        zero = image == 0
+        label_owner = np.zeros(labels.max() + 1, dtype=np.int32)
+        label_owner[labels[zero]] = owner[zero]
+        self._nearest = label_owner[labels]
+        self._reference = points
+
+    def set_reference_grid(self, grid, threshold=0.65):
+        """
+        Matches next scans against occupied cells of the map instead of keyframes
+        :param grid: OccupancyGrid
+        :param threshold: occupancy probability threshold
+        """
+        self.keyframes = False
+        self.set_reference(grid.cell_to_world(np.argwhere(grid.occupied(threshold))))
+
+    def match(self, points, pose):
+        """
+        Aligns scan points to reference
+        :param points: (N, 2) scan points in robot frame
+        :param pose: initial guess of robot [x, y, ang]
+        :return: aligned [x, y, ang] and rms distance of point pairs or None if match failed
+        """
+        if self._reference is None or len(points) < self.min_points:
+            return None
+        x, y, ang = pose
+        rows, cols = self._nearest.shape
+        max_dist2 = self.max_distance ** 2
+        for _ in range(self.max_iterations):
+            world = transform_points(points, (x, y, ang))
+            ij = np.floor((world - self._corner) / self.resolution).astype(np.int64)
+            inside = (ij[:, 0] >= 0) & (ij[:, 0] < cols) & (ij[:, 1] >= 0) & (ij[:, 1] < rows)
+            src = world[inside]
+            nearest = self._nearest[ij[inside, 1], ij[inside, 0]]
+            dst = self._reference[nearest]
+            dist2 = np.square(dst - src).sum(axis=1)
+            close = dist2 < max_dist2
+            if np.count_nonzero(close) < self.min_points:
+                return None
+            src, dst, normals = src[close], dst[close], self._normals[nearest[close]]
+            d_ang, dx, dy = self._align(src, dst, normals)
+            cos, sin = math.cos(d_ang), math.sin(d_ang)
+            x, y = cos * x - sin * y + dx, sin * x + cos * y + dy
+            ang += d_ang
+            if abs(d_ang) < self.tolerance and math.hypot(dx, dy) < self.tolerance:
+                break
+        self.last_rms = math.sqrt(dist2[close].mean())
+        return [float(x), float(y), float(ang % (2 * math.pi))], self.last_rms
+
+    @staticmethod
+    def _align(src, dst, normals):
+        """
+        Finds rigid step moving src points to dst
+        :param src: (N, 2) points
+        :param dst: (N, 2) paired reference points
+        :param normals: (N, 2) reference normals, nan rows are matched point-to-point
+        :return: d_ang, dx, dy (rotation about world origin, then translation)
+        """
+        center = src.mean(axis=0)
+        p = src - center
+        line = ~np.isnan(normals[:, 0])
+        if np.count_nonzero(line) < 3:
+            # closed form point-to-point alignment of centered pairs
+            q = dst - dst.mean(axis=0)
+            d_ang = math.atan2((p[:, 0] * q[:, 1] - p[:, 1] * q[:, 0]).sum(), (p * q).sum())
+            shift = dst.mean(axis=0) - center
+        else:
+            # linearized least squares: point-to-line rows for pairs with normals, x and y rows for the others,
+            # point pairs are biased by sampling of surfaces so they only keep degenerate geometry constrained
+            n = normals[line]
+            jac_line = np.column_stack([n, n[:, 1] * p[line, 0] - n[:, 0] * p[line, 1]])
+            res_line = (n * (dst[line] - src[line])).sum(axis=1)
+            pp = p[~line]
+            jac_x = np.column_stack([np.ones(len(pp)), np.zeros(len(pp)), -pp[:, 1]])
+            jac_y = np.column_stack([np.zeros(len(pp)), np.ones(len(pp)), pp[:, 0]])
+            jac = np.concatenate([jac_line, POINT_WEIGHT * jac_x, POINT_WEIGHT * jac_y])
+            res = np.concatenate([res_line, *(POINT_WEIGHT * (dst[~line] - src[~line])).T])
+            shift_x, shift_y, d_ang = np.linalg.lstsq(jac, res, rcond=None)[0]
+            shift = np.array([shift_x, shift_y])
+        # rotation is about center of src, convert to rotation about origin
+        cos, sin = math.cos(d_ang), math.sin(d_ang)
+        dx = center[0] + shift[0] - (cos * center[0] - sin * center[1])
+        dy = center[1] + shift[1] - (sin * center[0] + cos * center[1])
+        return d_ang, dx, dy
+
+    def update(self, pose, scan):
+        """
+        Matches scan taken at odometry pose
+        :param pose: [x, y, ang] of the robot by odometry
+        :param scan: lidar ranges
+        :return: corrected [x, y, ang] or None if match failed
+        """
+        points = self.geometry.valid_points(scan, step=self.step)
+        if self._reference is None and self.keyframes:
+            self._set_keyframe(points, pose)
+            return list(pose)
+        result = self.match(points, pose)
+        if result is None:
+            self.failures += 1
+            self.failures_in_row += 1
+            if self.keyframes and self.failures_in_row >= self.max_failures:
+                # drift since the last match stays uncorrected, later scans are matched from here
+                self._set_keyframe(points, pose)
+                self.failures_in_row = 0
+                self.rekeyframes += 1
+            return None
+        corrected = result[0]
+        self.matches += 1
+        self.failures_in_row = 0
+        if self.keyframes:
+            kx, ky, kang = self.keyframe_pose
+            turn = abs((corrected[2] - kang + math.pi) % (2 * math.pi) - math.pi)
+            if math.hypot(corrected[0] - kx, corrected[1] - ky) > self.keyframe_distance or turn > self.keyframe_angle:
+                self._set_keyframe(points, corrected)
+        return corrected
+
+    def _set_keyframe(self, points, pose):
+        if len(points) >= self.min_points:
+            points = transform_points(points, pose)
+            # normals from neighbour points of the scan, unknown where the neighbours are too far
+            k = NORMAL_NEIGHBOURS
+            tangent = np.zeros_like(points)
+            tangent[k:-k] = points[2 * k:] - points[:-2 * k]
+            length = np.hypot(tangent[:, 0], tangent[:, 1])
+            normals = np.full(points.shape, np.nan)
+            ok = (length > 0) & (length < NORMAL_MAX_SPAN)
+            normals[ok, 0] = -tangent[ok, 1] / length[ok]
+            normals[ok, 1] = tangent[ok, 0] / length[ok]
+            # corners: the point is off the chord of its neighbours
+            offset = np.zeros(len(points))
+            offset[k:-k] = np.abs((normals[k:-k] * (points[k:-k] - points[:-2 * k])).sum(axis=1))
+            normals[offset > NORMAL_MAX_OFFSET] = np.nan
+            self.set_reference(points, normals)
+            self.keyframe_pose = list(pose)
@@ -0,0 +1,139 @@
+import struct
+import time
+
+from KukaLog import LogWriter
+
+# session file layout: magic, then entries of (time.perf_counter() time, direction, length) header + raw bytes
+SESSION_MAGIC = b"KUKAREC1"
+ENTRY_HEADER = struct.Struct("<dBI")
+
+# entry directions
+INBOUND = 0  # telemetry line received from robot (without line end)
+OUTBOUND = 1  # command sent to robot
+SESSION_START = 2  # wall clock time of session start (appended sessions)
+
+
+class SessionRecorder(LogWriter):
+    """
+    Records every received telemetry line and every sent command with monotonic timestamps\n
+    Entries are appended to a binary file by a background thread, several sessions may share one file
+    """
+
+    def __init__(self, path, /, chunk_size=256):
+        """
+        :param path: name and path to session file
+        :param chunk_size: number of entries handed to the writing thread at once
+        """
+        super().__init__(path, chunk_size=chunk_size)
+        self._add((time.perf_counter(), SESSION_START, repr(time.time()).encode("utf-8")))
+
+    def _open(self):
+        file = open(self.path, "ab")
+        if file.tell() == 0:
+            file.write(SESSION_MAGIC)
+        else:
+            with open(self.path, "rb") as check:
+                if check.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+                    file.close()
+                    raise ValueError(f"{self.path} is not a KUKA session recording")
+        return file
+
+    def _encode(self, chunk):
+        out = []
+        for stamp, direction, data in chunk:
+            out.append(ENTRY_HEADER.pack(stamp, direction, len(data)))
+            out.append(data)
+        return b"".join(out)
+
+    def record(self, direction, data, stamp=None):
+        """
+        Adds entry
+        :param direction: INBOUND or OUTBOUND
+        :param data: raw bytes
+        :param stamp: time.perf_counter() time (current time if None)
+        """
+        if stamp is None:
+            stamp = time.perf_counter()
+        self._add((stamp, direction, bytes(data)))
+
+
+class SessionReader:
+    """
+    Sequential reader of session recordings
+    """
+
+    def __init__(self, path):
+        """
+        :param path: name and path to session file
+        """
+        self.path = path
+        self.file = open(path, "rb")
+        if self.file.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+            self.file.close()
+            raise ValueError(f"{path} is not a KUKA session recording")
+        self._offsets = [len(SESSION_MAGIC)]  # offsets of entries found so far
+        self._times = []
+
+    def _entry(self, offset, payload=True):
+        """
+        Reads entry at offset
+        :return: (time, direction, data), size of entry; None if the file ends
+        """
+        self.file.seek(offset)
+        raw = self.file.read(ENTRY_HEADER.size)
+        if len(raw) < ENTRY_HEADER.size:
+            return None, 0
+        stamp, direction, length = ENTRY_HEADER.unpack(raw)
+        data = None
+        if payload:
+            data = self.file.read(length)
+            if len(data) < length:
+                return None, 0
+        return (stamp, direction, data), ENTRY_HEADER.size + length
+
+    def _scan_to(self, ind):
+        """
+        Finds offsets and times of entries up to ind without reading their payload
+        :param ind: entry index
+        :return: True if entry exists
+        """
+        while len(self._times) <= ind:
+            entry, size = self._entry(self._offsets[len(self._times)], payload=False)
+            if entry is None:
+                return False
+            self._times.append(entry[0])
+            self._offsets.append(self._offsets[-1] + size)
+        return True
+
+    def time_at(self, ind):
+        self._scan_to(ind)
+        return self._times[ind]
+
+    def index_at_time(self, stamp):
+        """
+        Finds first entry not older than stamp
+        :param stamp: monotonic time
+        :return: entry index
+        """
+        ind = 0
+        while self._scan_to(ind) and self._times[ind] < stamp:
+            ind += 1
+        return ind
+
+    def read(self, start=0):
+        """
+        Iterates over entries
+        :param start: first entry index
+        """
+        if start and not self._scan_to(start - 1):
+            return
+        offset = self._offsets[start]
+        while True:
+            entry, size = self._entry(offset)
+            if entry is None:
+                return
+            yield entry
+            offset += size
+
+    def close(self):
+        self.file.close()
@@ -1,10 +1,10 @@
 
 from pyfirmata import Arduino, util
-import time
+from GloveSampler import GloveSampler
 
 class ServoController:
 
-    def __init__(self, robot, port="COM8", servo_num=5 ):
+    def __init__(self, robot, port="COM8", servo_num=5, sample_frequency=50):
         self.robot = robot
         self.port = port
         self.board = Arduino(self.port)
@@ -16,6 +16,10 @@ class ServoController:
         self.it = util.Iterator(self.board)
         self.it.start()
 
+        # glove is read in its own thread at fixed rate
+        self.sampler = GloveSampler(self.pins, frequency=sample_frequency)
+        self.sampler.start()
+
         # self.pause = 5
 
     def read_potentiometer(self, pin_index):
@@ -30,17 +34,15 @@ class ServoController:
        
 
 
+        count = 0
         while True:
-          time.sleep(2)
-
-          thumbFingerSignal = self.pins[0].read()
-          indexFingerSignal = self.pins[1].read()
-          middleFingerSignal = self.pins[2].read()
-          ringFingerSignal = self.pins[3].read()
-          testFingerSignal = self.pins[4].read()
-
-          if thumbFingerSignal is None or indexFingerSignal is None or middleFingerSignal is None or ringFingerSignal is None:
+          # every new sample, samples with missing pin values are skipped by the sampler
+          count = self.sampler.wait_sample(count, timeout=1)
+          sample = self.sampler.latest()
+          if sample is None:
             continue
+
+          thumbFingerSignal, indexFingerSignal, middleFingerSignal, ringFingerSignal, testFingerSignal = sample[1][:5]
   
           thumbFinger = min(0.5, thumbFingerSignal) * 2 * 90
           indexFinger = min(0.5, indexFingerSignal) * 2 * 180
@@ -5,12 +5,13 @@ import time
 import pygame
 import cv2
 from ObjectTracker import ObjectTracker 
+from GloveSampler import GloveSampler
 
 # from data import data
 
 class TestServoController:
     # """ robot """
-    def __init__(self, robot, port="COM8", servo_num=5 ):
+    def __init__(self, robot, port="COM8", servo_num=5, sample_frequency=50):
         self.robot = robot
         self.port = port
         self.board = Arduino(self.port)
@@ -34,6 +35,10 @@ class TestServoController:
 
         self.it = util.Iterator(self.board)
         self.it.start()
+
+        # glove is read in its own thread, GUI loop takes the latest sample
+        self.sampler = GloveSampler(self.pins, frequency=sample_frequency)
+        self.sampler.start()
         
         self.startRecord = False
 
@@ -48,9 +53,8 @@ class TestServoController:
     #! Initialization in Queue
     #? USE QUEUE
     def useQueue(self): 
+       waypoints = []
        while (len(self.queue) != 0):
-        time.sleep(int(3))
-        
         data = self.queue.pop(0)
   
         thumbFinger, indexFinger, middleFinger, ringFinger, testFinger = data.values()
@@ -58,8 +62,13 @@ class TestServoController:
         print('QUEUE')
         print(f'{thumbFinger:.3f} thumbFinger, {indexFinger:.3f} indexFinger, {middleFinger:.3f} middleFinger, {ringFinger:.3f} ringFinger')
 
-         #! Достаем из очереди и передаем в KUKA 
-        self.robot.move_arm(m1=ringFinger, m2=middleFinger, m3=indexFinger, m4=thumbFinger, grip=0)
+        waypoints.append([ringFinger, middleFinger, indexFinger, thumbFinger, self.robot.arm_pos[0][4]])
+
+       #! Достаем из очереди и передаем в KUKA одной траекторией
+       if waypoints:
+        self.robot.move_arm(grip=0)
+        self.robot.move_arm_trajectory(waypoints).result()
+        self.robot.wait_arm_reached(timeout=2)
 
        self.setRecordStart(False)
     
@@ -68,6 +77,11 @@ class TestServoController:
         
         time.sleep(int(self.delay))
 
+        # mean of the samples taken after the delay
+        values = self.sampler.window(0.2)[1]
+        if len(values):
+          self.set_fingers(values.mean(axis=0))
+
         print('Append in Queue')
         print(f'{self.thumbFinger:.3f} thumbFinger, {self.indexFinger:.3f} indexFinger, {self.middleFinger:.3f} middleFinger, {self.ringFinger:.3f} ringFinger')
 
@@ -109,29 +123,24 @@ class TestServoController:
        return self.startRecord
     
 
-    def control_servos(self):
-        
-        time.sleep(0.1)
-
-        thumbFingerSignal = self.pins[0].read()
-        indexFingerSignal = self.pins[1].read()
-        middleFingerSignal = self.pins[2].read()
-        ringFingerSignal = self.pins[3].read()
-        testFingerSignal = self.pins[4].read()
+    def set_fingers(self, signals):
+        thumbFingerSignal, indexFingerSignal, middleFingerSignal, ringFingerSignal, testFingerSignal = signals
 
-
-
-        # if (thumbFingerSignal is None or indexFingerSignal is None or
-        # middleFingerSignal is None or ringFingerSignal is None or
-        # testFingerSignal is None):
-        #   continue
-          
         self.thumbFinger = min(0.5, thumbFingerSignal) * 2 * 90
         self.indexFinger = min(0.5, indexFingerSignal) * 2 * 180
         self.middleFinger = min(0.5, middleFingerSignal) * 2 * 180 
         self.ringFinger= min(0.5, ringFingerSignal) * 2 * 180
         self.testFinger= min(0.5, testFingerSignal) * 2 * 180
 
+    def control_servos(self):
+
+        # the latest glove sample, no samples until every pin reported
+        sample = self.sampler.latest()
+        if sample is None:
+          return
+
+        self.set_fingers(sample[1])
+
         if self.startRecord == False:
           
           if (self.isCameraRun): 